@@ -51,7 +51,7 @@ pre() {
     > "$reqs"
     if [ -f "$reqs" ]; then
         echo "Installing collection requirements for ansible-lint from $reqs"
-        ansible-galaxy collection install -vv -p "$TOX_WORK_DIR" --force -r "$reqs"
+        lsr_galaxy_install_cached "$TOX_WORK_DIR" "" "$reqs"
     fi
 }
 
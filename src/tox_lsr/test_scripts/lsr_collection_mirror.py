@@ -0,0 +1,309 @@
+#                                                         -*- coding: utf-8 -*-
+# SPDX-License-Identifier: MIT
+#
+"""
+Offline mirror of the collections used by the tests.
+
+The mirror is a directory of collection tarballs, as created by
+ansible-galaxy collection download.  The fill command downloads the
+collections from all of the requirements files in a role tree into the
+mirror.  The requirements command writes a requirements file which refers
+to the tarballs in the mirror instead, for ansible-galaxy collection install
+--no-deps, so that the collections can be installed without any network
+access.
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import subprocess  # nosec
+import sys
+import tarfile
+
+import yaml
+
+REQUIREMENTS_FILES = (
+    os.path.join("meta", "collection-requirements.yml"),
+    os.path.join("tests", "collection-requirements.yml"),
+    os.path.join("meta", "requirements.yml"),
+)
+# collections installed by the test scripts themselves, not from a
+# requirements file
+EXTRA_COLLECTIONS = (
+    os.environ.get("LSR_ANSIBLE_POSIX_VERSION", "ansible.posix"),
+    "containers.podman",
+)
+TARBALL_RE = re.compile(r"^([a-z0-9_]+)-([a-z0-9_]+)-(.+)\.tar\.gz$")
+VERSION_OP_RE = re.compile(r"^(==|!=|>=|<=|>|<|=)?\s*(.*)$")
+
+
+class MirrorError(Exception):
+    """A collection is not in the mirror."""
+
+
+def parse_version(version):
+    """Convert a semantic version into something that can be compared."""
+    core, _, prerelease = version.partition("-")
+    core = core.partition("+")[0]
+    parts = []
+    for part in core.split("."):
+        try:
+            parts.append(int(part))
+        except ValueError:
+            parts.append(0)
+    # a prerelease sorts before the release
+    return (parts, not prerelease, prerelease)
+
+
+def version_matches(version, spec):
+    """See if version matches a galaxy version spec like >=1.0.0,<2.0.0."""
+    if not spec or spec == "*":
+        return True
+    parsed = parse_version(version)
+    for clause in spec.split(","):
+        op, required = VERSION_OP_RE.match(clause.strip()).groups()
+        required = parse_version(required)
+        if op in (None, "=", "=="):
+            ok = parsed == required
+        elif op == "!=":
+            ok = parsed != required
+        elif op == ">=":
+            ok = parsed >= required
+        elif op == "<=":
+            ok = parsed <= required
+        elif op == ">":
+            ok = parsed > required
+        else:
+            ok = parsed < required
+        if not ok:
+            return False
+    return True
+
+
+def list_mirror(mirror):
+    """Return a dict of namespace.name to a list of (version, tarball)."""
+    tarballs = {}
+    for filename in os.listdir(mirror):
+        match = TARBALL_RE.match(filename)
+        if match:
+            name = match.group(1) + "." + match.group(2)
+            tarballs.setdefault(name, []).append(
+                (match.group(3), os.path.join(mirror, filename))
+            )
+    return tarballs
+
+
+def get_dependencies(tarball):
+    """Return the dependencies of the collection in tarball."""
+    with tarfile.open(tarball) as tf:
+        manifest = json.load(tf.extractfile("MANIFEST.json"))
+    return manifest["collection_info"].get("dependencies") or {}
+
+
+def parse_collection_arg(collection):
+    """Split a collection argument like ansible.posix:>=1.0 into its parts."""
+    name, _, spec = collection.partition(":")
+    return name, spec
+
+
+def read_requirements(reqfile):
+    """Return a list of (name, version spec) of the collections in reqfile."""
+    with open(reqfile) as rf:
+        requirements = yaml.safe_load(rf)
+    if not isinstance(requirements, dict):
+        # only roles, in the old format
+        return []
+    collections = []
+    for item in requirements.get("collections") or []:
+        if isinstance(item, dict):
+            if item.get("type", "galaxy") != "galaxy":
+                raise MirrorError(
+                    "Collection %s in %s is of type %s - only galaxy "
+                    "collections can be installed from the mirror"
+                    % (item.get("name"), reqfile, item.get("type"))
+                )
+            collections.append((item["name"], str(item.get("version", ""))))
+        else:
+            collections.append(parse_collection_arg(item))
+    return collections
+
+
+def resolve_collections(mirror, collections):
+    """
+    Return the tarballs in mirror for collections and their dependencies.
+
+    collections is a list of (name, version spec).  The newest version in
+    the mirror which matches the spec is used.  Like ansible-galaxy,
+    pre-releases are only used if the spec asks for one.  If a collection is
+    needed more than once, the first one wins.
+    """
+    available = list_mirror(mirror)
+    selected = {}
+    todo = list(collections)
+    while todo:
+        name, spec = todo.pop(0)
+        if name in selected:
+            continue
+        versions = [
+            (version, tarball)
+            for version, tarball in available.get(name, [])
+            if version_matches(version, spec)
+            and ("-" not in version or "-" in spec)
+        ]
+        if not versions:
+            raise MirrorError(
+                "Collection %s%s is not in the mirror %s - add it with %s "
+                "fill"
+                % (name, ":" + spec if spec else "", mirror, sys.argv[0])
+            )
+        version, tarball = max(
+            versions, key=lambda item: parse_version(item[0])
+        )
+        logging.debug("Using %s %s from %s", name, version, tarball)
+        selected[name] = tarball
+        todo.extend(get_dependencies(tarball).items())
+    return list(selected.values())
+
+
+def write_requirements(mirror, reqfiles, collections, output):
+    """
+    Write a requirements file with the tarballs in mirror to output.
+
+    The requirements file has the collections in the requirements files
+    reqfiles, the collections in collections e.g. ansible.posix:>=1.0, and
+    all of their dependencies, so it can be installed with --no-deps.
+    """
+    wanted = []
+    for reqfile in reqfiles:
+        wanted.extend(read_requirements(reqfile))
+    wanted.extend(parse_collection_arg(item) for item in collections)
+    tarballs = resolve_collections(os.path.abspath(mirror), wanted)
+    with open(output, "w") as of:
+        yaml.safe_dump(
+            {
+                "collections": [
+                    {"name": tarball, "type": "file"} for tarball in tarballs
+                ]
+            },
+            of,
+        )
+
+
+def find_requirements(topdirs):
+    """Find all of the requirements files in the role trees in topdirs."""
+    reqfiles = []
+    for topdir in topdirs:
+        for dirpath, dirnames, _ in os.walk(topdir):
+            dirnames[:] = [
+                dd for dd in sorted(dirnames) if not dd.startswith(".")
+            ]
+            for reqfile in REQUIREMENTS_FILES:
+                path = os.path.join(dirpath, reqfile)
+                if os.path.isfile(path):
+                    reqfiles.append(path)
+    return reqfiles
+
+
+def fill_mirror(mirror, topdirs, collections):
+    """Download the collections used in the role trees into mirror."""
+    os.makedirs(mirror, exist_ok=True)
+    ag_cmd = ["ansible-galaxy", "collection", "download", "-p", mirror]
+    for reqfile in find_requirements(topdirs):
+        if not read_requirements(reqfile):
+            continue
+        logging.info("Downloading the collections in %s", reqfile)
+        subprocess.check_call(ag_cmd + ["-r", reqfile])  # nosec
+    for collection in collections:
+        logging.info("Downloading %s", collection)
+        subprocess.check_call(ag_cmd + [collection])  # nosec
+    # ansible-galaxy collection download writes a requirements.yml for the
+    # last download only - it is not used
+    if os.path.exists(os.path.join(mirror, "requirements.yml")):
+        os.unlink(os.path.join(mirror, "requirements.yml"))
+
+
+def get_arg_parser():
+    """Get the command line argument parser."""
+    # options common to all commands
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument(
+        "--mirror",
+        default=os.environ.get("LSR_COLLECTION_MIRROR"),
+        required="LSR_COLLECTION_MIRROR" not in os.environ,
+        help=(
+            "Directory of the collection tarballs.  The default is the "
+            "value of the environment variable LSR_COLLECTION_MIRROR."
+        ),
+    )
+    common.add_argument(
+        "--collection",
+        action="append",
+        default=[],
+        help=(
+            "A collection to add, in addition to the requirements files, "
+            "e.g. ansible.posix or ansible.posix:>=1.5.0.  Can be given "
+            "more than once."
+        ),
+    )
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+    fill_parser = subparsers.add_parser(
+        "fill",
+        parents=[common],
+        help=(
+            "Download all of the collections used by the role trees into "
+            "the mirror, including %s" % ", ".join(EXTRA_COLLECTIONS)
+        ),
+    )
+    fill_parser.add_argument(
+        "topdirs",
+        nargs="*",
+        default=["."],
+        help="Role trees to look for requirements files in",
+    )
+    req_parser = subparsers.add_parser(
+        "requirements",
+        parents=[common],
+        help="Write a requirements file for the tarballs in the mirror",
+    )
+    req_parser.add_argument(
+        "-o",
+        "--output",
+        required=True,
+        help="The requirements file to write",
+    )
+    req_parser.add_argument(
+        "reqfiles",
+        nargs="*",
+        help="Requirements files with the collections to install",
+    )
+    return parser
+
+
+def main():
+    """Fill the mirror, or write a requirements file for the mirror."""
+    logging.basicConfig(
+        level=logging.INFO, format="%(levelname)s %(asctime)s %(message)s"
+    )
+    args = get_arg_parser().parse_args()
+    try:
+        if args.command == "fill":
+            fill_mirror(
+                args.mirror,
+                args.topdirs,
+                list(EXTRA_COLLECTIONS) + args.collection,
+            )
+        else:
+            write_requirements(
+                args.mirror, args.reqfiles, args.collection, args.output
+            )
+    except MirrorError as exc:
+        logging.critical("%s", exc)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
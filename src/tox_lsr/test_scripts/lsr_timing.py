@@ -0,0 +1,173 @@
+#                                                         -*- coding: utf-8 -*-
+# SPDX-License-Identifier: MIT
+#
+"""Ansible callback which records playbook and task durations in SQLite."""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import sqlite3
+import time
+
+from ansible.plugins.callback import CallbackBase
+from ansible.release import __version__ as ansible_version
+
+__metaclass__ = type
+
+DOCUMENTATION = """
+    name: lsr_timing
+    type: aggregate
+    short_description: records durations of playbooks and tasks
+    description:
+      - Records the duration of each playbook and each task in the SQLite
+        database given by the environment variable LSR_TIMING_DB, together
+        with the image given by LSR_TIMING_IMAGE and the ansible-core
+        version.  runqemu.py --timing-report reports on this database.
+    requirements:
+      - enable in configuration
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS playbooks (
+    id INTEGER PRIMARY KEY,
+    image TEXT,
+    playbook TEXT,
+    ansible_version TEXT,
+    start REAL,
+    duration REAL,
+    failed INTEGER
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    playbook_id INTEGER REFERENCES playbooks (id),
+    name TEXT,
+    path TEXT,
+    duration REAL
+);
+CREATE INDEX IF NOT EXISTS tasks_playbook_id ON tasks (playbook_id);
+"""
+
+
+class CallbackModule(CallbackBase):
+    """Record the durations of playbooks and tasks in a database."""
+
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = "aggregate"
+    CALLBACK_NAME = "lsr_timing"
+    CALLBACK_NEEDS_ENABLED = True
+    CALLBACK_NEEDS_WHITELIST = True
+
+    def __init__(self):
+        """Init the callback."""
+        super(CallbackModule, self).__init__()
+        self.timing_db = os.environ.get("LSR_TIMING_DB")
+        self.image = os.environ.get("LSR_TIMING_IMAGE", "")
+        self.playbooks = []
+        self.playbook = None
+        self.task = None
+        self.task_start = 0
+
+    def _end_task(self):
+        """Record the duration of the current task, if any."""
+        if self.task is not None and self.playbook is not None:
+            self.playbook["tasks"].append(
+                self.task + (time.time() - self.task_start,)
+            )
+        self.task = None
+
+    def _end_playbook(self):
+        """Record the duration of the current playbook, if any."""
+        self._end_task()
+        if self.playbook is not None:
+            self.playbook["duration"] = time.time() - self.playbook["start"]
+            self.playbooks.append(self.playbook)
+            self.playbook = None
+
+    def _write_playbooks(self, stats):
+        """
+        Write the playbooks and their tasks to the database.
+
+        A playbook failed if a host had a task fail in it, and the host
+        ended the run with failures, or unreachable.  Failures which were
+        rescued by a block are not counted as failures in @stats.
+        """
+        if not self.timing_db or not self.playbooks:
+            return
+        failed_hosts = set()
+        for host in stats.processed:
+            summary = stats.summarize(host)
+            if summary["failures"] or summary["unreachable"]:
+                failed_hosts.add(host)
+        try:
+            conn = sqlite3.connect(self.timing_db, timeout=60)
+            try:
+                conn.executescript(SCHEMA)
+                with conn:
+                    for playbook in self.playbooks:
+                        cursor = conn.execute(
+                            "INSERT INTO playbooks (image, playbook, "
+                            "ansible_version, start, duration, failed) "
+                            "VALUES (?, ?, ?, ?, ?, ?)",
+                            (
+                                self.image,
+                                playbook["name"],
+                                ansible_version,
+                                playbook["start"],
+                                playbook["duration"],
+                                int(bool(playbook["hosts"] & failed_hosts)),
+                            ),
+                        )
+                        conn.executemany(
+                            "INSERT INTO tasks VALUES (?, ?, ?, ?)",
+                            [
+                                (cursor.lastrowid,) + task
+                                for task in playbook["tasks"]
+                            ],
+                        )
+            finally:
+                conn.close()
+        except sqlite3.Error as exc:
+            self._display.warning(
+                "Could not record timing in %s: %s" % (self.timing_db, exc)
+            )
+        self.playbooks = []
+
+    def v2_playbook_on_start(self, playbook):
+        """Start timing the playbook."""
+        self._end_playbook()
+        self.playbook = {
+            # pylint: disable=protected-access
+            "name": os.path.basename(playbook._file_name),
+            "start": time.time(),
+            "tasks": [],
+            "hosts": set(),  # hosts which had a task fail
+        }
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        """Start timing the task - this ends the previous task."""
+        self._end_task()
+        self.task = (task.get_name(), task.get_path())
+        self.task_start = time.time()
+
+    def v2_playbook_on_handler_task_start(self, task):
+        """Start timing the handler."""
+        self.v2_playbook_on_task_start(task, False)
+
+    def _host_failed(self, result):
+        """Remember that a task failed on the host of result."""
+        if self.playbook is not None:
+            # pylint: disable=protected-access
+            self.playbook["hosts"].add(result._host.get_name())
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        """Remember the host - the stats tell if the failure was rescued."""
+        if not ignore_errors:
+            self._host_failed(result)
+
+    def v2_runner_on_unreachable(self, result):
+        """Remember the host."""
+        self._host_failed(result)
+
+    def v2_playbook_on_stats(self, stats):
+        """Record all of the playbooks of the run."""
+        self._end_playbook()
+        self._write_playbooks(stats)
@@ -2,6 +2,10 @@
 
 set -euo pipefail
 
+SCRIPTDIR=$(readlink -f "$(dirname "$0")")
+
+. "${SCRIPTDIR}/utils.sh"
+
 CONTAINER_OPTS=("--privileged" "--systemd=true" "--hostname" "${CONTAINER_HOSTNAME:-sut}")
 CONTAINER_MOUNTS=("-v" "/sys/fs/cgroup:/sys/fs/cgroup")
 #CONTAINER_ENTRYPOINT="/usr/sbin/init"
@@ -91,33 +95,20 @@ wait_for_container_running() {
 }
 
 install_requirements() {
-    local rq save_tar force upgrade coll_path
+    local rq rqs
     info Installing Collections in "$COLLECTION_BASE_PATH"
-    # see what capabilities ansible-galaxy has
-    if ansible-galaxy collection install --help 2>&1 | grep -q -- --force; then
-        force=--force
-    fi
-    if ansible-galaxy collection install --help 2>&1 | grep -q -- --upgrade; then
-        upgrade=--upgrade
-    fi
-    coll_path="$COLLECTION_BASE_PATH/ansible_collections"
-    if [ -d "$coll_path/$LOCAL_COLLECTION" ]; then
-        info saving local collection at "$coll_path/$LOCAL_COLLECTION"
-        save_tar="$WORKDIR/save.tar"
-        tar cfP "$save_tar" -C "$coll_path" "$LOCAL_COLLECTION"
-    fi
+    rqs=()
     for rq in meta/requirements.yml meta/collection-requirements.yml tests/collection-requirements.yml; do
         if [ -f "$rq" ]; then
             if [ "$rq" = meta/requirements.yml ]; then
                 warning use meta/collection-requirements.yml instead of "$rq"
             fi
-            # shellcheck disable=SC2086
-            galaxy_collection "$COLLECTION_BASE_PATH" install ${force:-} ${upgrade:-} -vv -r "$rq"
+            rqs+=("$rq")
         fi
     done
-    if [ -n "${save_tar:-}" ] && [ -f "${save_tar:-}" ]; then
-        tar xfP "$save_tar" -C "$coll_path" --overwrite
-        info restoring local collection at "$coll_path/$LOCAL_COLLECTION"
+    if [ "${#rqs[@]}" -gt 0 ]; then
+        # the local collection is kept, not overwritten with the one from Galaxy
+        lsr_galaxy_install_cached "$COLLECTION_BASE_PATH" "$LOCAL_COLLECTION" "${rqs[@]}"
     fi
     # for debugging
     info Installed Collections in "$COLLECTION_BASE_PATH"
@@ -144,9 +135,19 @@ setup_callback_plugins() {
         if [ "${LSR_CONTAINER_PROFILE:-true}" = true ] && [ ! -f "$profile_py" ]; then
             need_profile_py=1
         fi
-        if [ -n "${need_debug_py:-}" ] || [ -n "${need_profile_py:-}" ]; then
+        local plugins=()
+        if [ "${LSR_CONTAINER_PRETTY:-true}" = true ]; then
+            plugins+=(debug.py)
+        fi
+        if [ "${LSR_CONTAINER_PROFILE:-true}" = true ]; then
+            plugins+=(profile_tasks.py)
+        fi
+        if [ -n "$(lsr_get_collection_cache)" ]; then
+            info linking cached callback plugins into "$callback_plugin_dir"
+            lsr_link_cached_callback_plugins "$callback_plugin_dir" "${plugins[@]}"
+        elif [ -n "${need_debug_py:-}" ] || [ -n "${need_profile_py:-}" ]; then
             info installing callback plugins in "$callback_plugin_dir"
-            galaxy_collection "$LSR_TOX_ENV_TMP_DIR" install -vv "${LSR_ANSIBLE_POSIX_VERSION:-ansible.posix}"
+            lsr_galaxy_install "$LSR_TOX_ENV_TMP_DIR" --collection "${LSR_ANSIBLE_POSIX_VERSION:-ansible.posix}"
             tmp_debug_py="$LSR_TOX_ENV_TMP_DIR/ansible_collections/ansible/posix/plugins/callback/debug.py"
             tmp_profile_py="$LSR_TOX_ENV_TMP_DIR/ansible_collections/ansible/posix/plugins/callback/profile_tasks.py"
             if [ -n "${need_debug_py:-}" ]; then
@@ -210,7 +211,7 @@ setup_connection_plugin() {
             local collection_plugin_file="ansible_collections/containers/podman/plugins/connection/$con_plugin"
             if [ ! -f "$TOX_WORK_DIR/$collection_plugin_file" ]; then
                 info installing connection plugins in "$con_plugin_path"
-                galaxy_collection "$LSR_TOX_ENV_TMP_DIR" install -vv containers.podman
+                lsr_galaxy_install "$LSR_TOX_ENV_TMP_DIR" --collection containers.podman
                 mv "$LSR_TOX_ENV_TMP_DIR/$collection_plugin_file" "$con_plugin_path"
                 rm -rf "$LSR_TOX_ENV_TMP_DIR/ansible_collections"
             else
@@ -9,16 +9,23 @@ multiple VMs on a shared virtual network so they can reach each other.
 """
 
 import hashlib
+import json
 import logging
 import os
 import re
 import shlex
 import shutil
+import signal
+import socket
+import socketserver
 import subprocess  # nosec
 import sys
 import tempfile
+import threading
 import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 
 import defusedxml.ElementTree as ET
 import yaml
@@ -99,6 +106,21 @@ DEFAULT_LIBVIRT_URI = "qemu:///system"
 DEFAULT_MEMORY_MIB = 2048
 DEFAULT_VCPUS = 2
 SSH_WAIT_TIMEOUT = 600
+SHUTDOWN_WAIT_TIMEOUT = 120
+SSH_PORT = 22
+BOOT_POLL_INTERVAL = 1  # seconds between DHCP lease and SSH port checks
+EVENT_POLL_INTERVAL = 5  # seconds to wait for an event before checking
+SSH_CONTROL_PERSIST = 600  # seconds to keep an idle ssh master connection
+DEFAULT_POOL_SIZE = 2
+POOL_LEASE_TIMEOUT = 120  # seconds to wait for free VMs in the VM pool
+POOL_BOOT_RETRIES = 3  # times to try to boot a VM of the pool again
+REVERT_SSH_TIMEOUT = 30  # seconds to wait for SSH after reverting a VM
+# internal snapshot of the memory and of the qcow2 disks - the read-only
+# cloud-init ISO is left out
+RESET_VM_SNAPSHOT_XML = """<domainsnapshot>
+  <name>{}</name>
+  <memory snapshot='internal'/>
+</domainsnapshot>""".format(rq.RESET_VM_STATE)
 MIN_LIBVIRT_NVME_VERSION = 11006000
 HOSTS_MARKER_BEGIN = "# BEGIN lsr-libvirt-hosts"
 HOSTS_MARKER_END = "# END lsr-libvirt-hosts"
@@ -109,6 +131,56 @@ HOSTNAME_LABEL_RE = re.compile(
 MAX_HOSTNAME_LENGTH = 253
 
 
+_event_loop_lock = threading.Lock()
+_event_loop_thread = None
+
+
+def start_libvirt_event_loop():
+    """
+    Run the default libvirt event loop in a daemon thread, once.
+
+    This must be done before a connection is opened, in order to get
+    domain and network events on the connection.
+    """
+    global _event_loop_thread  # pylint: disable=global-statement
+    with _event_loop_lock:
+        if _event_loop_thread is not None:
+            return
+        libvirt.virEventRegisterDefaultImpl()
+
+        def run_event_loop():
+            while True:
+                libvirt.virEventRunDefaultImpl()
+
+        _event_loop_thread = threading.Thread(
+            target=run_event_loop, name="libvirt-events", daemon=True
+        )
+        _event_loop_thread.start()
+
+
+def ssh_banner_received(ipaddr):
+    """See if sshd on ipaddr answers, without spawning an ssh client."""
+    try:
+        with socket.create_connection((ipaddr, SSH_PORT), timeout=5) as sock:
+            return sock.recv(4).startswith(b"SSH-")
+    except OSError:
+        return False
+
+
+def send_pool_message(stream, message):
+    """Send a message of the VM pool protocol - a line of JSON."""
+    stream.write(json.dumps(message).encode("utf-8") + b"\n")
+    stream.flush()
+
+
+def receive_pool_message(stream):
+    """Receive a message of the VM pool protocol, or None at the end."""
+    line = stream.readline()
+    if not line:
+        return None
+    return json.loads(line.decode("utf-8"))
+
+
 def is_valid_hostname(hostname):
     """Return True if hostname is a valid DNS/RFC 1123 hostname."""
     if not hostname or len(hostname) > MAX_HOSTNAME_LENGTH:
@@ -243,6 +315,7 @@ class LibvirtProvisioner(object):
         session_id=None,
         tests_dir=None,
         skip_missing_device=False,
+        pool_socket=None,
     ):
         """Initialize a LibvirtProvisioner."""
         if libvirt is None:
@@ -272,9 +345,11 @@ class LibvirtProvisioner(object):
         self.vms = []
         self.workdir = os.path.join(cache, "libvirt-" + self.session_id)
         self.identity_dir = None
+        self.ssh_control_dir = None
         self.identity_file = None
         self.isomaker = find_isomaker()
         self._started = False
+        self.started_ts = 0  # when the VMs were up
         self.gateway = None
         self.dns_domain = None
         self.subnet_prefix = None
@@ -282,11 +357,18 @@ class LibvirtProvisioner(object):
         self.use_static_network = False
         self.tests_dir = tests_dir
         self.skip_missing_device = skip_missing_device
+        self.pool_socket = pool_socket
+        self._pool_conn = None
         self.effective_memory_mib = memory_mib
         self.primary_nic_model = "virtio"
         self.extra_nic_models = []
         self._temp_disk_files = []
         self._qemu_device_output = None
+        # libvirt events wake up the threads waiting for the domains
+        self._events = threading.Condition()
+        self._event_count = 0
+        self._event_callbacks = []
+        self._network_stopped = False
 
     def _apply_fmf_config(self):
         """Load VM settings from provision.fmf if present."""
@@ -353,19 +435,102 @@ class LibvirtProvisioner(object):
         )
 
     def connect(self):
-        """Open libvirt connection."""
+        """Open libvirt connection, and listen for domain events."""
+        start_libvirt_event_loop()
         self.conn = libvirt.open(self.uri)
         if self.conn is None:
             raise RuntimeError(
                 "Failed to connect to libvirt at {}".format(self.uri)
             )
+        try:
+            self._event_callbacks.append(
+                (
+                    self.conn.domainEventDeregisterAny,
+                    self.conn.domainEventRegisterAny(
+                        None,
+                        libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                        self._domain_lifecycle_event,
+                        None,
+                    ),
+                )
+            )
+        except libvirt.libvirtError as err:
+            logging.warning(
+                "Cannot get domain events, checking every %d seconds: %s",
+                EVENT_POLL_INTERVAL,
+                err,
+            )
 
     def close(self):
         """Close libvirt connection."""
         if self.conn is not None:
+            for deregister, callback_id in self._event_callbacks:
+                try:
+                    deregister(callback_id)
+                except libvirt.libvirtError as err:
+                    logging.debug("Error removing event callback: %s", err)
+            self._event_callbacks = []
             self.conn.close()
             self.conn = None
 
+    def _notify_event(self):
+        """Wake up the threads waiting for an event."""
+        with self._events:
+            self._event_count += 1
+            self._events.notify_all()
+
+    def _wait_for_event(self, seen, timeout, abort=None):
+        """
+        Wait for an event newer than @seen for up to @timeout seconds.
+
+        @seen is the number of events returned by the previous call, or
+        read before the checks for the state which is waited for, so that
+        no event is missed.  Returns the number of events so far.
+        """
+        with self._events:
+            if self._event_count == seen and not (abort and abort.is_set()):
+                self._events.wait(timeout)
+            return self._event_count
+
+    def _domain_lifecycle_event(self, conn, dom, event, detail, opaque):
+        """Handle a libvirt domain lifecycle event."""
+        logging.debug(
+            "Domain %s lifecycle event %d detail %d", dom.name(), event, detail
+        )
+        self._notify_event()
+
+    def _network_lifecycle_event(self, conn, net, event, detail, opaque):
+        """Handle a libvirt network lifecycle event."""
+        logging.debug(
+            "Network %s lifecycle event %d detail %d",
+            net.name(),
+            event,
+            detail,
+        )
+        if event in (
+            libvirt.VIR_NETWORK_EVENT_STOPPED,
+            libvirt.VIR_NETWORK_EVENT_UNDEFINED,
+        ):
+            self._network_stopped = True
+        self._notify_event()
+
+    def _register_network_events(self):
+        """Listen for the network being stopped while the VMs use it."""
+        try:
+            self._event_callbacks.append(
+                (
+                    self.conn.networkEventDeregisterAny,
+                    self.conn.networkEventRegisterAny(
+                        self.network,
+                        libvirt.VIR_NETWORK_EVENT_ID_LIFECYCLE,
+                        self._network_lifecycle_event,
+                        None,
+                    ),
+                )
+            )
+        except libvirt.libvirtError as err:
+            logging.warning("Cannot get network events: %s", err)
+
     def _mac_for_host(self, hostname):
         """Return a deterministic QEMU-style MAC address for a hostname."""
         digest = hashlib.sha256(
@@ -732,12 +897,17 @@ chpasswd:
         null.close()
         return cloudinit_iso
 
+    def _overlay_path(self, hostname):
+        """Return the path of the overlay of the image for a VM."""
+        return os.path.join(
+            self.workdir, sanitize_libvirt_name(hostname) + ".qcow2"
+        )
+
     def _disk_path_for_vm(self, hostname):
         """Return overlay disk path for a VM."""
         if self.write_to_image:
             return self.image_path
-        disk_name = sanitize_libvirt_name(hostname) + ".qcow2"
-        disk_path = os.path.join(self.workdir, disk_name)
+        disk_path = self._overlay_path(hostname)
         if not os.path.exists(disk_path):
             subprocess.check_call(  # nosec
                 [
@@ -849,8 +1019,50 @@ chpasswd:
         ]
         if self.extra_ssh_args:
             ssh_args.extend(shlex.split(self.extra_ssh_args))
+        ssh_args.extend(self._ssh_control_args())
         return ssh_args
 
+    def _ssh_control_args(self):
+        """
+        Return the SSH arguments to share one connection to each VM.
+
+        The provisioner and ansible-playbook use the same master connection
+        for a VM, so that only the first command pays for the handshake.
+        These come after TEST_EXTRA_SSH_ARGS, as the first value of an ssh
+        option is used, so that the user can override them.
+        """
+        if not self.ssh_control_dir:
+            return []
+        return [
+            "-o",
+            "ControlMaster=auto",
+            "-o",
+            "ControlPersist={}".format(SSH_CONTROL_PERSIST),
+            "-o",
+            "ControlPath=" + os.path.join(self.ssh_control_dir, "%C"),
+        ]
+
+    def _close_ssh_master(self, vm):
+        """Stop the ssh master connection to the VM, if any."""
+        if not self.ssh_control_dir or not vm.get("ipaddr"):
+            return
+        with open(os.devnull, "w") as null:
+            subprocess.call(  # nosec
+                self._ssh_base_args()
+                + ["-O", "exit", "{}@{}".format(DEF_USER, vm["ipaddr"])],
+                stdout=null,
+                stderr=null,
+            )
+
+    def _close_ssh_masters(self):
+        """Stop the ssh master connections, and remove their sockets."""
+        if not self.ssh_control_dir:
+            return
+        for vm in self.vms:
+            self._close_ssh_master(vm)
+        shutil.rmtree(self.ssh_control_dir, ignore_errors=True)
+        self.ssh_control_dir = None
+
     def _ssh_run(self, ipaddr, remote_command, check=True):
         """Run a command on a VM over SSH."""
         ssh_args = self._ssh_base_args()
@@ -867,14 +1079,13 @@ chpasswd:
                 )  # nosec
         return 0
 
-    def _wait_for_ssh(self, ipaddr):
-        """Wait until SSH is available on the VM."""
-        deadline = time.time() + SSH_WAIT_TIMEOUT
-        while time.time() < deadline:
-            if self._ssh_run(ipaddr, "/bin/true", check=False) == 0:
-                return
-            time.sleep(1)
-        raise RuntimeError("Timed out waiting for SSH on {}".format(ipaddr))
+    def _ssh_ready(self, ipaddr):
+        """See if the VM accepts SSH logins."""
+        # only spawn ssh once sshd is listening
+        return (
+            ssh_banner_received(ipaddr)
+            and self._ssh_run(ipaddr, "/bin/true", check=False) == 0
+        )
 
     def _configure_peer_hostnames(self):
         """Publish all VM hostnames in /etc/hosts on every VM."""
@@ -916,6 +1127,274 @@ rm -f "$TMP"
                 vm["ipaddr"],
             )
 
+    def _host_vars(self, ipaddr):
+        """Return the inventory host vars for the VM at ipaddr."""
+        ssh_common = (
+            "-o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no"
+        )
+        if self.extra_ssh_args:
+            ssh_common += " " + self.extra_ssh_args
+        if self.ssh_control_dir:
+            ssh_common += " " + " ".join(
+                shlex.quote(arg) for arg in self._ssh_control_args()
+            )
+        return {
+            "ansible_host": ipaddr,
+            "ansible_user": DEF_USER,
+            "ansible_ssh_pass": DEF_PASSWD,
+            "ansible_ssh_private_key_file": self.identity_file,
+            "ansible_ssh_common_args": ssh_common,
+        }
+
+    def _create_domain(self, hostname):
+        """Create and start the domain for hostname, return its VM dict."""
+        plan = self.host_plans[hostname]
+        domain_name = sanitize_libvirt_name(
+            "lsr-{}-{}".format(hostname, self.session_id)
+        )
+        vm_dir = os.path.join(self.workdir, hostname)
+        cloudinit_iso = self._make_cloud_init(hostname, vm_dir)
+        disk_path = self._disk_path_for_vm(hostname)
+        extra_controllers, extra_devices = self._build_extra_devices_xml(
+            hostname, vm_dir
+        )
+        xml = self._domain_xml(
+            domain_name,
+            disk_path,
+            cloudinit_iso,
+            plan["mac"],
+            extra_controllers + extra_devices,
+        )
+        logging.debug("Domain XML:\n%s", xml)
+        dom = self.conn.createXML(xml, 0)
+        if dom is None:
+            raise RuntimeError(
+                "Failed to create libvirt domain {}".format(domain_name)
+            )
+        logging.info(
+            "Started libvirt domain %s for hostname %s (mac %s)",
+            domain_name,
+            hostname,
+            plan["mac"],
+        )
+        return {
+            "hostname": hostname,
+            "inventory_name": self._host_inventory_name(hostname),
+            "domain_name": domain_name,
+            "dom": dom,
+            "ipaddr": None,
+            "host_vars": {},
+        }
+
+    def _wait_for_vm(self, vm, abort):
+        """
+        Wait until the VM has an IP address and is reachable over SSH.
+
+        Stops waiting if @abort, a threading.Event, is set because another
+        VM failed.
+        """
+        dom = vm["dom"]
+        domain_name = vm["domain_name"]
+        hostname = vm["hostname"]
+        expected_ip = self.host_plans[hostname].get("ip")
+        ipaddr = None
+        seen = self._event_count
+        deadline = time.time() + SSH_WAIT_TIMEOUT
+        while True:
+            # a lifecycle event wakes this up at once - libvirt has no
+            # events for DHCP leases or sshd, so check those periodically
+            if self._network_stopped:
+                raise RuntimeError(
+                    "Network {} stopped during boot".format(self.network_name)
+                )
+            state, _ = dom.state()
+            if state == libvirt.VIR_DOMAIN_SHUTDOWN:
+                raise RuntimeError(
+                    "Domain {} shut down during boot".format(domain_name)
+                )
+            if state == libvirt.VIR_DOMAIN_SHUTOFF:
+                raise RuntimeError(
+                    "Domain {} shut off during boot".format(domain_name)
+                )
+            if state == libvirt.VIR_DOMAIN_CRASHED:
+                raise RuntimeError(
+                    "Domain {} crashed during boot".format(domain_name)
+                )
+            if not ipaddr:
+                ipaddr = self._get_domain_ip(dom)
+                if ipaddr:
+                    if expected_ip and ipaddr != expected_ip:
+                        logging.warning(
+                            "VM %s got IP %s, expected %s",
+                            hostname,
+                            ipaddr,
+                            expected_ip,
+                        )
+                    deadline = time.time() + SSH_WAIT_TIMEOUT
+            if ipaddr and self._ssh_ready(ipaddr):
+                break
+            if time.time() > deadline:
+                if ipaddr:
+                    raise RuntimeError(
+                        "Timed out waiting for SSH on {}".format(ipaddr)
+                    )
+                raise RuntimeError(
+                    "Timed out waiting for IP address on domain {}".format(
+                        domain_name
+                    )
+                )
+            seen = self._wait_for_event(seen, BOOT_POLL_INTERVAL, abort)
+            if abort.is_set():
+                return
+        vm["ipaddr"] = ipaddr
+        vm["host_vars"] = self._host_vars(ipaddr)
+        logging.info(
+            "VM %s (%s) is reachable at %s",
+            hostname,
+            domain_name,
+            ipaddr,
+        )
+
+    def _wait_for_vms(self):
+        """
+        Wait for all of the VMs to boot at the same time.
+
+        If a VM fails to boot, stop waiting for the others, and raise one
+        error for all of the VMs which failed.
+        """
+        abort = threading.Event()
+
+        def wait_for_vm(vm):
+            try:
+                self._wait_for_vm(vm, abort)
+            except Exception:
+                abort.set()
+                self._notify_event()
+                raise
+
+        with ThreadPoolExecutor(max_workers=len(self.vms)) as executor:
+            futures = [executor.submit(wait_for_vm, vm) for vm in self.vms]
+        errors = [
+            "{}: {}".format(vm["hostname"], future.exception())
+            for vm, future in zip(self.vms, futures)
+            if future.exception() is not None
+        ]
+        if errors:
+            raise RuntimeError(
+                "Failed to boot VMs - {}".format("; ".join(errors))
+            )
+
+    def recreate_domain(self, vm, abort):
+        """
+        Destroy the domain of the VM, and boot it from a new overlay.
+
+        This reverts the VM to a clean copy of the image, for the VM pool.
+        Stops waiting for the boot if @abort, a threading.Event, is set.
+        """
+        self._close_ssh_master(vm)
+        self._destroy_domain(vm)
+        vm["dom"] = None
+        vm["ipaddr"] = None
+        overlay = self._overlay_path(vm["hostname"])
+        if os.path.exists(overlay):
+            os.unlink(overlay)
+        vm.update(self._create_domain(vm["hostname"]))
+        self._wait_for_vm(vm, abort)
+
+    def pool_config(self):
+        """
+        Return the settings of the VMs, as compared by the VM pool.
+
+        VMs are only leased from the pool if they have the same settings.
+        """
+        return {
+            "image": self.image_path,
+            "uri": self.uri,
+            "memory_mib": self.effective_memory_mib,
+            "vcpus": self.vcpus,
+            "nic_model": self.primary_nic_model,
+            "sshd_usedns_no": self.sshd_usedns_no,
+            "disable_ipv6": self.disable_ipv6,
+            "extra_devices": self._needs_extra_devices(),
+        }
+
+    def _needs_extra_devices(self):
+        """See if provision.fmf asks for extra disks or NICs."""
+        return bool(
+            self.extra_nic_models
+            or fmf_get(["qemu", "drive"], [], self.tests_dir)
+            or fmf_get(["qemu", "usb_drive"], [], self.tests_dir)
+        )
+
+    def _lease_from_pool(self):
+        """
+        Lease booted VMs from the VM pool at pool_socket, if any.
+
+        The lease is held until the connection to the pool is closed by
+        destroy().  Returns False if the VMs must be created instead.
+        """
+        if not self.pool_socket or self.debug or self.write_to_image:
+            return False
+        config = self.pool_config()
+        if config["extra_devices"]:
+            logging.info(
+                "provision.fmf asks for extra devices - not using the VM pool"
+            )
+            return False
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(POOL_LEASE_TIMEOUT + EVENT_POLL_INTERVAL)
+        try:
+            sock.connect(self.pool_socket)
+            with sock.makefile("rwb") as stream:
+                send_pool_message(
+                    stream,
+                    {
+                        "op": "lease",
+                        "count": len(self.hostnames),
+                        "config": config,
+                    },
+                )
+                reply = receive_pool_message(stream)
+        except (OSError, ValueError) as err:
+            reply = {"error": str(err)}
+        if not reply or "error" in reply:
+            sock.close()
+            logging.warning(
+                "Cannot lease VMs from the pool %s - creating them: %s",
+                self.pool_socket,
+                (reply or {}).get("error", "no reply"),
+            )
+            return False
+        sock.settimeout(None)
+        self._pool_conn = sock
+        for hostname, leased in zip(self.hostnames, reply["vms"]):
+            self.vms.append(
+                {
+                    "hostname": hostname,
+                    "inventory_name": self._host_inventory_name(hostname),
+                    "domain_name": leased["domain_name"],
+                    "dom": None,
+                    "ipaddr": leased["ipaddr"],
+                    "host_vars": self._host_vars(leased["ipaddr"]),
+                }
+            )
+            logging.info(
+                "Leased VM %s (%s) from the pool for hostname %s",
+                leased["domain_name"],
+                leased["ipaddr"],
+                hostname,
+            )
+        # the guests were booted with the hostnames of the pool
+        for vm in self.vms:
+            self._ssh_run(
+                vm["ipaddr"],
+                "hostnamectl set-hostname {0} || hostname {0}".format(
+                    shlex.quote(vm["hostname"])
+                ),
+            )
+        self._configure_peer_hostnames()
+        return True
+
     def start(self):
         """Create network, domains, and wait for SSH on all VMs."""
         if self._started:
@@ -932,118 +1411,31 @@ rm -f "$TMP"
         with open(self.identity_file, "w") as idf:
             idf.write(IDENTITY)
         os.chmod(self.identity_file, 0o600)
+        # not in the workdir - the path of a unix socket must be short
+        self.ssh_control_dir = tempfile.mkdtemp(prefix="lsr-ssh-")
 
-        self.connect()
         try:
             self._apply_fmf_config()
+            if self._lease_from_pool():
+                self._started = True
+                self.started_ts = time.time()
+                return
+            self.connect()
             self._plan_network()
             self._ensure_network()
+            self._register_network_events()
+            # create all of the domains first, then wait for all of them
+            # to boot at the same time
             for hostname in self.hostnames:
-                plan = self.host_plans[hostname]
-                domain_name = sanitize_libvirt_name(
-                    "lsr-{}-{}".format(hostname, self.session_id)
-                )
-                vm_dir = os.path.join(self.workdir, hostname)
-                cloudinit_iso = self._make_cloud_init(hostname, vm_dir)
-                disk_path = self._disk_path_for_vm(hostname)
-                extra_controllers, extra_devices = (
-                    self._build_extra_devices_xml(hostname, vm_dir)
-                )
-                xml = self._domain_xml(
-                    domain_name,
-                    disk_path,
-                    cloudinit_iso,
-                    plan["mac"],
-                    extra_controllers + extra_devices,
-                )
-                logging.debug("Domain XML:\n%s", xml)
-                dom = self.conn.createXML(xml, 0)
-                if dom is None:
-                    raise RuntimeError(
-                        "Failed to create libvirt domain {}".format(
-                            domain_name
-                        )
-                    )
-                logging.info(
-                    "Started libvirt domain %s for hostname %s (mac %s)",
-                    domain_name,
-                    hostname,
-                    plan["mac"],
-                )
-                ipaddr = None
-                expected_ip = plan.get("ip")
-                deadline = time.time() + SSH_WAIT_TIMEOUT
-                while time.time() < deadline:
-                    state, _ = dom.state()
-                    if state == libvirt.VIR_DOMAIN_SHUTDOWN:
-                        raise RuntimeError(
-                            "Domain {} shut down during boot".format(
-                                domain_name
-                            )
-                        )
-                    if state == libvirt.VIR_DOMAIN_SHUTOFF:
-                        raise RuntimeError(
-                            "Domain {} shut off during boot".format(
-                                domain_name
-                            )
-                        )
-                    if state == libvirt.VIR_DOMAIN_CRASHED:
-                        raise RuntimeError(
-                            "Domain {} crashed during boot".format(domain_name)
-                        )
-                    ipaddr = self._get_domain_ip(dom)
-                    if ipaddr:
-                        if expected_ip and ipaddr != expected_ip:
-                            logging.warning(
-                                "VM %s got IP %s, expected %s",
-                                hostname,
-                                ipaddr,
-                                expected_ip,
-                            )
-                        break
-                    time.sleep(1)
-                else:
-                    raise RuntimeError(
-                        "Timed out waiting for IP address on domain {}".format(
-                            domain_name
-                        )
-                    )
-                self._wait_for_ssh(ipaddr)
-                inv_name = self._host_inventory_name(hostname)
-                ssh_common = (
-                    "-o UserKnownHostsFile=/dev/null "
-                    "-o StrictHostKeyChecking=no"
-                )
-                if self.extra_ssh_args:
-                    ssh_common += " " + self.extra_ssh_args
-                self.vms.append(
-                    {
-                        "hostname": hostname,
-                        "inventory_name": inv_name,
-                        "domain_name": domain_name,
-                        "dom": dom,
-                        "ipaddr": ipaddr,
-                        "host_vars": {
-                            "ansible_host": ipaddr,
-                            "ansible_user": DEF_USER,
-                            "ansible_ssh_pass": DEF_PASSWD,
-                            "ansible_ssh_private_key_file": self.identity_file,
-                            "ansible_ssh_common_args": ssh_common,
-                        },
-                    }
-                )
-                logging.info(
-                    "VM %s (%s) is reachable at %s",
-                    hostname,
-                    domain_name,
-                    ipaddr,
-                )
+                self.vms.append(self._create_domain(hostname))
+            self._wait_for_vms()
             self._configure_peer_hostnames()
             write_cleanup_script(self)
         except Exception:
             self.destroy()
             raise
         self._started = True
+        self.started_ts = time.time()
 
     def write_inventory(self, inventory_path):
         """Write YAML Ansible inventory for all running VMs."""
@@ -1063,29 +1455,155 @@ rm -f "$TMP"
         logging.info("Wrote Ansible inventory to %s", inventory_path)
         return inventory_path
 
+    def shutdown(self, timeout=SHUTDOWN_WAIT_TIMEOUT):
+        """
+        Ask the guests to shut down, and wait until they are off.
+
+        Returns False if a guest is still running after @timeout seconds -
+        destroy then pulls the plug.
+        """
+        for vm in self.vms:
+            if not self._domain_is_active(vm):
+                continue
+            try:
+                vm["dom"].shutdown()
+            except libvirt.libvirtError as err:
+                logging.warning(
+                    "Error shutting down domain %s: %s", vm["domain_name"], err
+                )
+        return self.wait_for_shutdown(timeout)
+
+    def wait_for_shutdown(self, timeout=SHUTDOWN_WAIT_TIMEOUT):
+        """
+        Wait until the guests are shut down.
+
+        Returns False if a guest is still running after @timeout seconds.
+        """
+        deadline = time.time() + timeout
+        seen = self._event_count
+        while True:
+            active = [vm for vm in self.vms if self._domain_is_active(vm)]
+            if not active:
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                logging.warning(
+                    "Domain %s did not shut down in %d seconds",
+                    active[0]["domain_name"],
+                    timeout,
+                )
+                return False
+            # the shutdown events wake this up
+            seen = self._wait_for_event(
+                seen, min(remaining, EVENT_POLL_INTERVAL)
+            )
+
+    def save_state(self):
+        """
+        Take a disk and memory snapshot of every VM, for restore_state.
+
+        Returns False if a VM cannot be snapshotted, e.g. because it was
+        leased from the VM pool, or provision.fmf added raw disks.
+        """
+        # a reverted guest does not know about the connections opened after
+        # the snapshot, so do not take it with one open
+        for vm in self.vms:
+            self._close_ssh_master(vm)
+        for vm in self.vms:
+            if vm.get("dom") is None:
+                return False
+            try:
+                vm["snapshot"] = vm["dom"].snapshotCreateXML(
+                    RESET_VM_SNAPSHOT_XML, 0
+                )
+            except libvirt.libvirtError as err:
+                logging.warning(
+                    "Cannot snapshot domain %s: %s", vm["domain_name"], err
+                )
+                return False
+            logging.info("Saved the state of domain %s", vm["domain_name"])
+        return True
+
+    def restore_state(self):
+        """
+        Revert the VMs to the snapshots taken by save_state.
+
+        This also reverts the clock of the guests, so set it to the current
+        time, which also checks that the VMs can be reached.  Returns True
+        on success.
+        """
+        for vm in self.vms:
+            self._close_ssh_master(vm)
+        for vm in self.vms:
+            if vm.get("snapshot") is None:
+                return False
+            try:
+                vm["dom"].revertToSnapshot(
+                    vm["snapshot"], libvirt.VIR_DOMAIN_SNAPSHOT_REVERT_RUNNING
+                )
+            except libvirt.libvirtError as err:
+                logging.warning(
+                    "Cannot revert domain %s: %s", vm["domain_name"], err
+                )
+                return False
+        for vm in self.vms:
+            deadline = time.time() + REVERT_SSH_TIMEOUT
+            while (
+                self._ssh_run(
+                    vm["ipaddr"], "date -u -s @%d" % time.time(), check=False
+                )
+                != 0
+            ):
+                if time.time() > deadline:
+                    logging.warning(
+                        "Cannot reach VM %s after reverting it", vm["hostname"]
+                    )
+                    return False
+                time.sleep(BOOT_POLL_INTERVAL)
+            logging.info("Reverted domain %s", vm["domain_name"])
+        return True
+
+    def _domain_is_active(self, vm):
+        """See if the domain of the VM is running."""
+        dom = vm.get("dom")
+        if dom is None:
+            return False
+        try:
+            return dom.isActive()
+        except libvirt.libvirtError:
+            return False  # a transient domain is gone once it is shut off
+
+    def _destroy_domain(self, vm):
+        """Destroy and undefine the domain of the VM."""
+        dom = vm.get("dom")
+        if dom is None:
+            return
+        domain_name = vm["domain_name"]
+        try:
+            transient = not dom.isPersistent()
+            active = dom.isActive()
+            if active:
+                dom.destroy()
+            # if the domain is transient, then destroy will also
+            # undefine if we try to undefine it after destroy, we will
+            # get "Domain not found"
+            if not active or not transient:
+                dom.undefine()
+            logging.info("Destroyed libvirt domain %s", domain_name)
+        except libvirt.libvirtError as err:
+            logging.warning("Error destroying domain %s: %s", domain_name, err)
+
     def destroy(self):
         """Destroy domains, network, and temporary files."""
+        self._close_ssh_masters()
+        if self._pool_conn is not None:
+            # the pool recycles the leased VMs once the lease is closed
+            self._pool_conn.close()
+            self._pool_conn = None
+            logging.info("Returned the VMs to the pool %s", self.pool_socket)
         if self.conn is not None:
             for vm in self.vms:
-                dom = vm.get("dom")
-                if dom is None:
-                    continue
-                domain_name = vm["domain_name"]
-                try:
-                    transient = not dom.isPersistent()
-                    active = dom.isActive()
-                    if active:
-                        dom.destroy()
-                    # if the domain is transient, then destroy will also
-                    # undefine if we try to undefine it after destroy, we will
-                    # get "Domain not found"
-                    if not active or not transient:
-                        dom.undefine()
-                    logging.info("Destroyed libvirt domain %s", domain_name)
-                except libvirt.libvirtError as err:
-                    logging.warning(
-                        "Error destroying domain %s: %s", domain_name, err
-                    )
+                self._destroy_domain(vm)
             if self.created_network and self.network is not None:
                 try:
                     if self.network.isActive():
@@ -1177,6 +1695,10 @@ def write_cleanup_script(provisioner):
                 ),
             ]
         )
+    if provisioner.ssh_control_dir:
+        lines.append(
+            "rm -rf {}".format(shlex.quote(provisioner.ssh_control_dir))
+        )
     lines.extend(
         [
             "cd /",
@@ -1236,6 +1758,310 @@ def print_debug_cleanup_instructions(provisioner, inventory_path=None):
         print(line, file=sys.stderr)
 
 
+class LibvirtPool(object):
+    """
+    Keep booted VMs for runlibvirt to lease over a UNIX socket.
+
+    A lease lasts as long as the connection of the client.  Then the VMs
+    are booted again from new overlays of the image in the background, so
+    that the next client gets clean VMs without waiting for them to boot.
+    """
+
+    def __init__(self, provisioner, socket_path):
+        """Initialize a LibvirtPool for the VMs of provisioner."""
+        self.provisioner = provisioner
+        self.socket_path = socket_path
+        self.config = None
+        self._ready = []
+        self._leased = 0
+        self._available = threading.Condition()
+        self._stop = threading.Event()
+        self._booter = None
+
+    def _image_version(self):
+        """
+        Return the version of the image of the VMs, None if it is missing.
+
+        A refresh of the snapshot replaces the file, and writes a new
+        manifest - see rq.replace_snapshot.
+        """
+        image_path = self.provisioner.image_path
+        try:
+            inode = os.stat(image_path).st_ino
+        except OSError:
+            return None
+        try:
+            with open(image_path + rq.SNAPSHOT_MANIFEST_SUFFIX) as ff:
+                fingerprint = json.load(ff).get("fingerprint")
+        except (OSError, ValueError):
+            fingerprint = None
+        return (inode, fingerprint)
+
+    def _image_is_locked(self):
+        """See if the snapshot is being refreshed - see rq.cache_lock."""
+        with rq.try_cache_lock(self.provisioner.image_path) as locked:
+            return not locked
+
+    def _recycle(self, vm):
+        """Boot the VM again from a new overlay, in the background."""
+        with self._available:
+            if not self._stop.is_set():
+                self._booter.submit(self._reboot_vm, vm)
+
+    def _reboot_vm(self, vm):
+        """Boot the VM again, and add it to the ready VMs."""
+        for attempt in range(1, POOL_BOOT_RETRIES + 1):
+            if self._stop.is_set():
+                return
+            try:
+                vm["image_version"] = self._image_version()
+                self.provisioner.recreate_domain(vm, self._stop)
+                break
+            except Exception as err:
+                logging.error(
+                    "Attempt %d to boot pooled VM %s failed: %s",
+                    attempt,
+                    vm["hostname"],
+                    err,
+                )
+        else:
+            logging.error("Removed VM %s from the pool", vm["hostname"])
+            return
+        if vm["ipaddr"]:
+            with self._available:
+                self._ready.append(vm)
+                self._available.notify_all()
+            logging.info("VM %s is ready in the pool", vm["hostname"])
+
+    def _lease(self, count):
+        """Take count ready VMs, or return None if there are none in time."""
+        deadline = time.time() + POOL_LEASE_TIMEOUT
+        with self._available:
+            while True:
+                # the image changes when its snapshot is refreshed - keep
+                # the VMs of the old snapshot until the new one is done
+                version = self._image_version()
+                stale = [
+                    vm for vm in self._ready if vm["image_version"] != version
+                ]
+                if stale and version and not self._image_is_locked():
+                    for vm in stale:
+                        logging.info(
+                            "The image has changed - booting VM %s again",
+                            vm["hostname"],
+                        )
+                        self._ready.remove(vm)
+                        self._recycle(vm)
+                if len(self._ready) >= count:
+                    vms = self._ready[:count]
+                    del self._ready[:count]
+                    self._leased += count
+                    return vms
+                remaining = deadline - time.time()
+                if remaining <= 0 or self._stop.is_set():
+                    return None
+                self._available.wait(min(remaining, EVENT_POLL_INTERVAL))
+
+    def _release(self, vms):
+        """Boot the VMs of a lease which has ended again."""
+        with self._available:
+            self._leased -= len(vms)
+            for vm in vms:
+                self._recycle(vm)
+
+    def _serve_lease(self, request, rfile, wfile):
+        """Lease VMs to a client until it closes the connection."""
+        count = request.get("count", 1)
+        if request.get("config") != self.config:
+            send_pool_message(
+                wfile,
+                {
+                    "error": "The pool has VMs with {}, not {}".format(
+                        self.config, request.get("config")
+                    )
+                },
+            )
+            return
+        if count > len(self.provisioner.hostnames):
+            send_pool_message(
+                wfile,
+                {
+                    "error": "The pool only has {} VMs".format(
+                        len(self.provisioner.hostnames)
+                    )
+                },
+            )
+            return
+        vms = self._lease(count)
+        if vms is None:
+            send_pool_message(
+                wfile,
+                {
+                    "error": "No free VMs in the pool after {} seconds".format(
+                        POOL_LEASE_TIMEOUT
+                    )
+                },
+            )
+            return
+        try:
+            send_pool_message(
+                wfile,
+                {
+                    "vms": [
+                        {
+                            "domain_name": vm["domain_name"],
+                            "ipaddr": vm["ipaddr"],
+                        }
+                        for vm in vms
+                    ]
+                },
+            )
+            logging.info(
+                "Leased VMs %s",
+                ", ".join(vm["hostname"] for vm in vms),
+            )
+            # the lease lasts until the client closes the connection
+            while receive_pool_message(rfile) is not None:
+                pass
+        except (OSError, ValueError) as err:
+            logging.debug("Error talking to a pool client: %s", err)
+        finally:
+            logging.info(
+                "Lease of VMs %s ended",
+                ", ".join(vm["hostname"] for vm in vms),
+            )
+            self._release(vms)
+
+    def handle_client(self, rfile, wfile):
+        """Serve one client connection - a status request or a lease."""
+        try:
+            request = receive_pool_message(rfile)
+        except (OSError, ValueError) as err:
+            logging.debug("Bad request from a pool client: %s", err)
+            return
+        if request is None:
+            return
+        if request.get("op") == "lease":
+            self._serve_lease(request, rfile, wfile)
+        elif request.get("op") == "status":
+            with self._available:
+                status = {
+                    "size": len(self.provisioner.hostnames),
+                    "ready": len(self._ready),
+                    "leased": self._leased,
+                }
+            send_pool_message(wfile, status)
+        else:
+            send_pool_message(
+                wfile, {"error": "Unknown request {}".format(request)}
+            )
+
+    def _remove_stale_socket(self):
+        """Remove the socket of a pool which died, if any."""
+        if not os.path.exists(self.socket_path):
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket_path)
+        except OSError:
+            os.unlink(self.socket_path)
+        else:
+            raise RuntimeError(
+                "A VM pool is already serving {}".format(self.socket_path)
+            )
+        finally:
+            probe.close()
+
+    def serve(self):
+        """Boot the VMs, and serve leases until SIGTERM or SIGINT."""
+        self._remove_stale_socket()
+        image_version = self._image_version()
+        self.provisioner.start()
+        try:
+            self.config = self.provisioner.pool_config()
+            if self.config["extra_devices"]:
+                raise RuntimeError(
+                    "The VM pool cannot have the extra devices of "
+                    "provision.fmf"
+                )
+            for vm in self.provisioner.vms:
+                vm["image_version"] = image_version
+            self._ready = list(self.provisioner.vms)
+            self._booter = ThreadPoolExecutor(
+                max_workers=len(self.provisioner.vms)
+            )
+            pool = self
+
+            class Handler(socketserver.StreamRequestHandler):
+                def handle(self):
+                    pool.handle_client(self.rfile, self.wfile)
+
+            server = socketserver.ThreadingUnixStreamServer(
+                self.socket_path, Handler
+            )
+            server.daemon_threads = True
+            # stop on SIGTERM the same way as on ^C
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            try:
+                logging.info(
+                    "Serving %d VMs of %s on %s",
+                    len(self.provisioner.vms),
+                    self.provisioner.image_path,
+                    self.socket_path,
+                )
+                server.serve_forever()
+            except KeyboardInterrupt:
+                logging.info("Stopping the VM pool")
+            finally:
+                server.server_close()
+                os.unlink(self.socket_path)
+        finally:
+            with self._available:
+                self._stop.set()
+                self._available.notify_all()
+            if self._booter is not None:
+                self._booter.shutdown(wait=True)
+            self.provisioner.destroy()
+
+
+def serve_libvirt_pool(image, args):
+    """Run a VM pool for the image until it is stopped."""
+    with ExitStack() as in_use:
+        rq.download_image(
+            image,
+            args.cache,
+            rq.parse_size(args.cache_max_size),
+            args.download_connections,
+            args.offline,
+            args.image_url_ttl,
+            args.refresh_image_urls,
+            in_use,
+        )
+        image_file = image["file"]
+        if args.use_snapshot:
+            image_file += ".snap"
+            if not os.path.exists(image_file):
+                raise RuntimeError(
+                    "Snapshot {} does not exist - create it by running the "
+                    "tests with --use-snapshot once".format(image_file)
+                )
+        provisioner = LibvirtProvisioner(
+            image_file,
+            ["pool{:02d}".format(idx) for idx in range(1, args.pool_size + 1)],
+            args.cache,
+            os.path.abspath(args.artifacts or "artifacts"),
+            uri=args.libvirt_uri,
+            network_name=args.libvirt_network,
+            memory_mib=args.memory,
+            vcpus=args.vcpus,
+            extra_ssh_args=os.environ.get("TEST_EXTRA_SSH_ARGS", ""),
+            sshd_usedns_no=args.sshd_usedns_no,
+            disable_ipv6=args.disable_ipv6,
+            tests_dir=args.tests_dir,
+        )
+        LibvirtPool(provisioner, os.path.abspath(args.libvirt_pool)).serve()
+
+
 def resolve_hostnames(args):
     """Build hostname list from command-line arguments."""
     if args.hostnames:
@@ -1338,87 +2164,81 @@ def refresh_snapshot_libvirt(
     post_snap_sleep_time,
     log_file,
     ansible_container,
+    snapshot_max_age=0,
 ):
     """Create snapshot using a libvirt VM with write_to_image."""
-    need_refresh = False
-    if not os.path.isfile(snapfile):
-        need_refresh = True
-        logging.info("Creating snapshot because %s does not exist", snapfile)
-    else:
-        snap_stats = os.stat(snapfile)
-        file_stats = os.stat(image_file)
-        now = time.time()
-        if now - snap_stats.st_ctime > 86400:
-            need_refresh = True
-            logging.info("Creating snapshot because %s is too old", snapfile)
-        elif snap_stats.st_ctime < file_stats.st_ctime:
-            need_refresh = True
-            logging.info(
-                "Creating snapshot because %s is older than backing file %s",
-                snapfile,
-                image_file,
-            )
-    if not need_refresh:
-        return
-    with rq.file_or_stdout(log_file) as (stdout, stderr):
-        subprocess.check_call(  # nosec
-            [
-                "qemu-img",
-                "create",
-                "-f",
-                "qcow2",
-                "-b",
-                image_file,
-                "-F",
-                "qcow2",
-                snapfile,
-            ],
-            stdout=stdout,
-            stderr=stderr,
-        )
-    snap_kwargs = dict(provisioner_kwargs)
-    snap_kwargs["image_path"] = snapfile
-    snap_kwargs["hostnames"] = [snap_kwargs["hostnames"][0]]
-    snap_kwargs["write_to_image"] = True
-    snap_kwargs["debug"] = False
-    provisioner = LibvirtProvisioner(**snap_kwargs)
-    inventory_path = tempfile.NamedTemporaryFile(
-        suffix=".yml", delete=False
-    ).name
-    test_env_setup = {}
-    test_env_setup.update(test_env)
-    if "TEST_DEBUG" in test_env_setup:
-        del test_env_setup["TEST_DEBUG"]
-    if "TEST_ARTIFACTS" in test_env_setup:
-        test_env_setup["TEST_ARTIFACTS"] = (
-            test_env_setup["TEST_ARTIFACTS"] + ".snap"
-        )
-    if "LOCK_ON_FILE" in test_env_setup:
-        del test_env_setup["LOCK_ON_FILE"]
-    try:
-        internal_run_ansible_playbooks_libvirt(
-            provisioner,
-            inventory_path,
-            test_env_setup,
-            ansible_args,
-            setup_yml,
-            cwd,
-            ansible_container,
-            wait_on_vm=True,
-            log_file=log_file,
-            start_vms=True,
+    with rq.cache_lock(snapfile):
+        fingerprint = rq.get_snapshot_fingerprint(
+            image_file, test_env, ansible_args, setup_yml
         )
-    finally:
-        provisioner.destroy()
-        if os.path.exists(inventory_path):
-            os.unlink(inventory_path)
-    logging.info(
-        "Created snapshot %s - sleeping %d seconds to allow disk sync",
-        snapfile,
-        post_snap_sleep_time,
-    )
-    time.sleep(post_snap_sleep_time)
-    subprocess.check_call(["/bin/sync"])  # nosec
+        if not rq.snapshot_needs_refresh(
+            snapfile, fingerprint, snapshot_max_age
+        ):
+            return
+        with rq.replace_snapshot(snapfile) as new_snapfile:
+            with rq.file_or_stdout(log_file) as (stdout, stderr):
+                subprocess.check_call(  # nosec
+                    [
+                        "qemu-img",
+                        "create",
+                        "-f",
+                        "qcow2",
+                        "-b",
+                        image_file,
+                        "-F",
+                        "qcow2",
+                        new_snapfile,
+                    ],
+                    stdout=stdout,
+                    stderr=stderr,
+                )
+            snap_kwargs = dict(provisioner_kwargs)
+            snap_kwargs["image_path"] = new_snapfile
+            snap_kwargs["hostnames"] = [snap_kwargs["hostnames"][0]]
+            snap_kwargs["write_to_image"] = True
+            snap_kwargs["debug"] = False
+            provisioner = LibvirtProvisioner(**snap_kwargs)
+            inventory_path = tempfile.NamedTemporaryFile(
+                suffix=".yml", delete=False
+            ).name
+            test_env_setup = {}
+            test_env_setup.update(test_env)
+            if "TEST_DEBUG" in test_env_setup:
+                del test_env_setup["TEST_DEBUG"]
+            if "TEST_ARTIFACTS" in test_env_setup:
+                test_env_setup["TEST_ARTIFACTS"] = (
+                    test_env_setup["TEST_ARTIFACTS"] + ".snap"
+                )
+            if "LOCK_ON_FILE" in test_env_setup:
+                del test_env_setup["LOCK_ON_FILE"]
+            try:
+                internal_run_ansible_playbooks_libvirt(
+                    provisioner,
+                    inventory_path,
+                    test_env_setup,
+                    ansible_args,
+                    setup_yml,
+                    cwd,
+                    ansible_container,
+                    log_file=log_file,
+                    start_vms=True,
+                )
+                # let the guest finish writing to the snapshot instead of
+                # pulling the plug - destroy does that if it does not shut down
+                provisioner.shutdown()
+            finally:
+                provisioner.destroy()
+                if os.path.exists(inventory_path):
+                    os.unlink(inventory_path)
+            rq.flush_snapshot(new_snapfile, log_file)
+            if post_snap_sleep_time:
+                logging.info(
+                    "Created snapshot %s - sleeping %d seconds",
+                    snapfile,
+                    post_snap_sleep_time,
+                )
+                time.sleep(post_snap_sleep_time)
+        rq.write_snapshot_manifest(snapfile, fingerprint)
 
 
 def run_ansible_playbooks_libvirt(  # noqa: C901
@@ -1455,6 +2275,12 @@ def run_ansible_playbooks_libvirt(  # noqa: C901
     sshd_usedns_no,
     disable_ipv6,
     skip_missing_device=False,
+    snapshot_max_age=0,
+    fail_fast=False,
+    failed_first=False,
+    rerun_failed=False,
+    libvirt_pool=None,
+    reset_vm=False,
 ):
     """Run playbooks against libvirt-managed VMs."""
     test_env.update(dict(os.environ))
@@ -1463,7 +2289,12 @@ def run_ansible_playbooks_libvirt(  # noqa: C901
         batch_file = "batch.txt"
         batch_report = "batch.report"
         rq.make_batch_file(
-            batch_file, tests_dir, ansible_args, image, make_batch_file_order
+            batch_file,
+            tests_dir,
+            ansible_args,
+            image,
+            make_batch_file_order,
+            rq.load_test_durations(cache, image["name"]),
         )
     batches = rq.get_batches_from_playbooks_and_args(
         ansible_args,
@@ -1472,6 +2303,8 @@ def run_ansible_playbooks_libvirt(  # noqa: C901
         cleanup_yml,
         batch_file,
     )
+    if failed_first or rerun_failed:
+        batches = rq.order_failed_first(batches, batch_report, rerun_failed)
     batch_inventory = None
     rc = 0
     batch_rc = 0
@@ -1482,6 +2315,12 @@ def run_ansible_playbooks_libvirt(  # noqa: C901
             write_inventory = batch_inventory
         lock_on_file = tempfile.NamedTemporaryFile().name
         test_env["LOCK_ON_FILE"] = lock_on_file
+    if reset_vm and (not lock_on_file or wait_on_vm or ansible_container):
+        logging.warning(
+            "--reset-vm is only used with batches, and not with "
+            "--wait-on-vm or --ansible-container"
+        )
+        reset_vm = False
 
     image_file = image["file"]
     snapfile = image_file + ".snap"
@@ -1514,16 +2353,21 @@ def run_ansible_playbooks_libvirt(  # noqa: C901
         "image_alias": image_alias,
         "tests_dir": tests_dir,
         "skip_missing_device": skip_missing_device,
+        "pool_socket": libvirt_pool,
     }
     provisioner = None
     debug_provisioner = None
     debug_inventory_path = None
     vms_started = False
+    saved_state = None  # the image, setup, and args of the saved VM state
 
     try:
         for batch in batches:
             if not batch.playbooks:
                 continue
+            if fail_fast and batch_rc != 0 and not batch.cleanup:
+                logging.error("A batch failed - skipping the other batches")
+                break
             if batch.args and batch.args.debug:
                 test_env["TEST_DEBUG"] = "true"
             elif debug and not batch_file:
@@ -1580,10 +2424,35 @@ def run_ansible_playbooks_libvirt(  # noqa: C901
                     post_snap_sleep_time,
                     local_log_file,
                     ansible_container,
+                    snapshot_max_age,
                 )
                 playbooks_to_run = batch.playbooks
             else:
                 playbooks_to_run = batch.setup_playbooks + batch.playbooks
+            rq.handle_vault(
+                cwd, batch.ansible_args, playbooks_to_run, test_env
+            )
+            batch_playbooks = playbooks_to_run
+            if reset_vm:
+                # every batch starts with the VMs as they were right after
+                # the setup - revert them, or if that fails, create new ones
+                setup_playbooks = playbooks_to_run[: -len(batch.playbooks)]
+                # handle_vault changes batch.ansible_args in place - the
+                # key must not change with it
+                reset_key = (
+                    os.path.abspath(current_image),
+                    tuple(setup_playbooks),
+                    tuple(batch.ansible_args),
+                )
+                batch_playbooks = batch.playbooks
+                if vms_started and not (
+                    saved_state == reset_key and provisioner.restore_state()
+                ):
+                    logging.info("Creating new VMs for the batch")
+                    provisioner.destroy()
+                    provisioner = None
+                    vms_started = False
+                    saved_state = None
 
             if (
                 provisioner is None
@@ -1603,21 +2472,40 @@ def run_ansible_playbooks_libvirt(  # noqa: C901
                         inventory_path = provisioner.default_inventory_path()
                     debug_inventory_path = inventory_path
 
-            rq.handle_vault(
-                cwd, batch.ansible_args, playbooks_to_run, test_env
-            )
             if local_log_file:
                 logging.info("Running playbooks %s", str(playbooks_to_run))
             last_rc = rc
             rc = 0
             start_ts = time.time()
+            test_start_ts = start_ts
             try:
+                if reset_vm and not vms_started:
+                    provisioner.start()
+                    provisioner.write_inventory(inventory_path)
+                    vms_started = True
+                    if setup_playbooks:
+                        internal_run_ansible_playbooks_libvirt(
+                            provisioner,
+                            inventory_path,
+                            test_env,
+                            batch.ansible_args,
+                            setup_playbooks,
+                            cwd,
+                            ansible_container,
+                            log_file=local_log_file,
+                            last_rc=last_rc,
+                            batch_rc=batch_rc,
+                            start_vms=False,
+                        )
+                    if provisioner.save_state():
+                        saved_state = reset_key
+                    test_start_ts = time.time()
                 internal_run_ansible_playbooks_libvirt(
                     provisioner,
                     inventory_path,
                     test_env,
                     batch.ansible_args,
-                    playbooks_to_run,
+                    batch_playbooks,
                     cwd,
                     ansible_container,
                     wait_on_vm,
@@ -1626,6 +2514,8 @@ def run_ansible_playbooks_libvirt(  # noqa: C901
                     batch_rc,
                     start_vms=not vms_started,
                 )
+                # the duration of the test does not include the boot
+                test_start_ts = max(test_start_ts, provisioner.started_ts)
                 if wait_on_vm:
                     vms_started = False
                     provisioner = None
@@ -1655,6 +2545,13 @@ def run_ansible_playbooks_libvirt(  # noqa: C901
                             " ".join(playbooks_to_run),
                         )
                     )
+            if rc == 0 and not batch.cleanup and len(batch.playbooks) == 1:
+                rq.record_test_duration(
+                    cache,
+                    image["name"],
+                    os.path.basename(batch.playbooks[0]),
+                    time.time() - test_start_ts,
+                )
             if batch_inventory and debug_provisioner is None:
                 inventory_path = batch_inventory
     finally:
@@ -1720,6 +2617,18 @@ def runlibvirt(
     sshd_usedns_no=False,
     disable_ipv6=False,
     skip_missing_device=False,
+    cache_max_size=0,
+    download_connections=rq.DEFAULT_DOWNLOAD_CONNECTIONS,
+    offline=False,
+    image_url_ttl=rq.DEFAULT_IMAGE_URL_TTL,
+    refresh_image_urls=False,
+    snapshot_max_age=0,
+    fail_fast=False,
+    failed_first=False,
+    rerun_failed=False,
+    timing_db=None,
+    libvirt_pool=None,
+    reset_vm=False,
 ):
     """Download image, provision libvirt VMs, run playbooks."""
     if write_inventory:
@@ -1732,73 +2641,94 @@ def runlibvirt(
             errmsg = fmtstr.format(write_inventory)
             logging.critical(errmsg)
             raise Exception(errmsg)
-    rq.download_image(image, cache)
-    pre_setup_yml, post_setup_yml = rq.make_setup_yml(
-        image, cache, remove_cloud_init, use_snapshot, use_yum_cache
-    )
-    local_setup_yml = []
-    if pre_setup_yml:
-        local_setup_yml.append(pre_setup_yml)
-    if setup_yml:
-        local_setup_yml.extend(setup_yml)
-    if post_setup_yml:
-        local_setup_yml.append(post_setup_yml)
-    local_cleanup_yml = cleanup_yml or []
-    if collection_path is None and "TOX_WORK_DIR" in os.environ:
-        collection_path = os.environ["TOX_WORK_DIR"]
-    test_env = dict(image.get("env", {}))
-    test_env["ANSIBLE_INVENTORY_ANY_UNPARSED_IS_FAILED"] = "true"
-    test_env["ANSIBLE_INJECT_FACT_VARS"] = "false"
-    if use_yum_cache:
-        logging.warning(
-            "use-yum-cache is not yet supported with runlibvirt; ignoring"
+    with ExitStack() as in_use:
+        rq.download_image(
+            image,
+            cache,
+            cache_max_size,
+            download_connections,
+            offline,
+            image_url_ttl,
+            refresh_image_urls,
+            in_use,
         )
-    if not skip_requirements:
-        rq.install_requirements(
-            sourcedir, collection_path, test_env, collection
+        pre_setup_yml, post_setup_yml = rq.make_setup_yml(
+            image, cache, remove_cloud_init, use_snapshot, use_yum_cache
         )
-    if not skip_callback_plugins:
-        rq.setup_callback_plugins(
-            pretty, profile, profile_task_limit, test_env
+        local_setup_yml = []
+        if pre_setup_yml:
+            local_setup_yml.append(pre_setup_yml)
+        if setup_yml:
+            local_setup_yml.extend(setup_yml)
+        if post_setup_yml:
+            local_setup_yml.append(post_setup_yml)
+        local_cleanup_yml = cleanup_yml or []
+        if collection_path is None and "TOX_WORK_DIR" in os.environ:
+            collection_path = os.environ["TOX_WORK_DIR"]
+        test_env = dict(image.get("env", {}))
+        test_env["ANSIBLE_INVENTORY_ANY_UNPARSED_IS_FAILED"] = "true"
+        test_env["ANSIBLE_INJECT_FACT_VARS"] = "false"
+        if use_yum_cache:
+            logging.warning(
+                "use-yum-cache is not yet supported with runlibvirt; ignoring"
+            )
+        if not skip_requirements:
+            rq.install_requirements(
+                sourcedir, collection_path, test_env, collection
+            )
+        if not skip_callback_plugins:
+            rq.setup_callback_plugins(
+                pretty,
+                profile,
+                profile_task_limit,
+                test_env,
+                timing_db,
+                image["name"],
+            )
+        rq.get_lsr_report_errors_script(lsr_report_errors_url, test_env)
+        if ansible_args is None:
+            ansible_args = []
+        run_ansible_playbooks_libvirt(
+            image,
+            hostnames,
+            local_setup_yml,
+            local_cleanup_yml,
+            test_env,
+            debug,
+            image_alias,
+            collection_path,
+            artifacts,
+            ansible_args,
+            use_snapshot,
+            use_ansible_log,
+            wait_on_vm,
+            write_inventory,
+            erase_old_snapshot,
+            post_snap_sleep_time,
+            batch_file,
+            batch_report,
+            log_file,
+            tests_dir,
+            make_batch,
+            ansible_container,
+            make_batch_file_order,
+            libvirt_uri,
+            libvirt_network,
+            memory_mib,
+            vcpus,
+            remove_cloud_init,
+            use_yum_cache,
+            cache,
+            sshd_usedns_no,
+            disable_ipv6,
+            skip_missing_device,
+            snapshot_max_age,
+            fail_fast,
+            failed_first,
+            rerun_failed,
+            libvirt_pool,
+            reset_vm,
         )
-    rq.get_lsr_report_errors_script(lsr_report_errors_url, test_env)
-    if ansible_args is None:
-        ansible_args = []
-    run_ansible_playbooks_libvirt(
-        image,
-        hostnames,
-        local_setup_yml,
-        local_cleanup_yml,
-        test_env,
-        debug,
-        image_alias,
-        collection_path,
-        artifacts,
-        ansible_args,
-        use_snapshot,
-        use_ansible_log,
-        wait_on_vm,
-        write_inventory,
-        erase_old_snapshot,
-        post_snap_sleep_time,
-        batch_file,
-        batch_report,
-        log_file,
-        tests_dir,
-        make_batch,
-        ansible_container,
-        make_batch_file_order,
-        libvirt_uri,
-        libvirt_network,
-        memory_mib,
-        vcpus,
-        remove_cloud_init,
-        use_yum_cache,
-        cache,
-        sshd_usedns_no,
-        disable_ipv6,
-        skip_missing_device,
-    )
 
 
 def get_arg_parser():
@@ -1895,6 +2825,35 @@ def get_arg_parser():
             "of failing."
         ),
     )
+    parser.add_argument(
+        "--libvirt-pool",
+        default=os.environ.get("LSR_LIBVIRT_POOL"),
+        help=(
+            "UNIX socket of a VM pool started with --pool-serve.  The VMs "
+            "are leased from the pool instead of being created, if it has "
+            "VMs with the same image and settings."
+        ),
+    )
+    parser.add_argument(
+        "--pool-serve",
+        action="store_true",
+        default=False,
+        help=(
+            "Run a VM pool on the --libvirt-pool socket instead of running "
+            "tests.  The pool keeps --pool-size booted VMs of the image, "
+            "and boots them again from a clean overlay after each lease."
+        ),
+    )
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        default=int(
+            os.environ.get("LSR_LIBVIRT_POOL_SIZE", str(DEFAULT_POOL_SIZE))
+        ),
+        help="Number of VMs in the VM pool (default: {}).".format(
+            DEFAULT_POOL_SIZE
+        ),
+    )
     # Remove qemu-specific inventory option; libvirt writes YAML inventory.
     for action in list(parser._actions):
         if action.dest == "inventory":
@@ -1904,7 +2863,7 @@ def get_arg_parser():
     return parser
 
 
-def main():
+def main():  # noqa: C901
     """Execute the main function."""
     parser = get_arg_parser()
     args, ansible_args = parser.parse_known_args()
@@ -1918,6 +2877,17 @@ def main():
     elif not args.cleanup_yml and "LSR_QEMU_CLEANUP_YML" in os.environ:
         args.cleanup_yml = os.environ["LSR_QEMU_CLEANUP_YML"].split(",")
     logging.getLogger().setLevel(getattr(logging, args.log_level.upper()))
+    if args.timing_report:
+        rq.timing_report(
+            rq.get_timing_db(args), args.image_name, args.profile_task_limit
+        )
+        return
+    if args.prewarm:
+        logging.critical("--prewarm is only supported by runqemu.")
+        sys.exit(1)
+    if args.parallel > 1:
+        logging.critical("--parallel is only supported by runqemu.")
+        sys.exit(1)
     if not any([args.image_name, args.image_file]) or all(
         [args.image_name, args.image_file]
     ):
@@ -1925,8 +2895,6 @@ def main():
             "One, and only one, of --image-name or --image-file must be given."
         )
         sys.exit(1)
-    if args.post_snap_sleep_time == 0:
-        args.post_snap_sleep_time = rq.DEFAULT_POST_SNAP_SLEEP_TIME
     os.makedirs(args.cache, exist_ok=True)
     if args.make_batch_file_order:
         args.make_batch = True
@@ -1934,6 +2902,15 @@ def main():
         args.make_batch_file_order = "imagehash"
 
     rq.prep_el6(args)
+    if args.pool_serve:
+        if not args.libvirt_pool or args.pool_size < 1:
+            logging.critical(
+                "--pool-serve needs --libvirt-pool and a --pool-size of at "
+                "least 1."
+            )
+            sys.exit(1)
+        serve_libvirt_pool(rq.get_image_config(args), args)
+        return
     try:
         hostnames = resolve_hostnames(args)
     except ValueError as err:
@@ -1980,6 +2957,18 @@ def main():
         sshd_usedns_no=args.sshd_usedns_no,
         disable_ipv6=args.disable_ipv6,
         skip_missing_device=args.skip_missing_device,
+        cache_max_size=rq.parse_size(args.cache_max_size),
+        download_connections=args.download_connections,
+        offline=args.offline,
+        image_url_ttl=args.image_url_ttl,
+        refresh_image_urls=args.refresh_image_urls,
+        snapshot_max_age=args.snapshot_max_age,
+        fail_fast=args.fail_fast,
+        failed_first=args.failed_first,
+        rerun_failed=args.rerun_failed,
+        timing_db=rq.get_timing_db(args),
+        libvirt_pool=args.libvirt_pool,
+        reset_vm=args.reset_vm,
     )
 
 
@@ -3,28 +3,40 @@
 
 import argparse
 import errno
+import fcntl
+import fnmatch
 import glob
 import hashlib
 import json
 import logging
 import os
+import queue
 import re
 import shlex
 import shutil
+import socket
+import sqlite3
 import subprocess  # nosec
 import sys
 import tempfile
+import threading
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 try:
+    from http.client import HTTPException
+    from urllib.error import HTTPError
     from urllib.request import Request, urlopen
 except ImportError:
     # Python 2
+    from httplib import HTTPException
     from urllib import urlopen
-    from urllib2 import Request
-from contextlib import contextmanager
+    from urllib2 import HTTPError, Request
 
+from contextlib import ExitStack, contextmanager
+
+import lsr_collection_mirror
 import yaml
 
 try:
@@ -49,8 +61,14 @@ except NameError:
 
 
 # https://www.freedesktop.org/wiki/CommonExtendedAttributes/
+# images downloaded before IMAGE_SOURCE_SUFFIX files have their source here
 URL_XATTR = "user.xdg.origin.url"
 DATE_XATTR = "user.dublincore.date"
+# not in the list above - HTTP entity tag of the downloaded image
+ETAG_XATTR = "user.http.etag"
+DIGEST_XATTR = "user.checksum.sha256"
+# the size and mtime of the image when its sha256 was last computed
+VERIFIED_XATTR = "user.checksum.verified"
 DEFAULT_QEMU_INVENTORY = os.path.join(
     os.environ.get("LSR_SCRIPTDIR", "/"), "standard-inventory-qcow2"
 )
@@ -60,7 +78,45 @@ DEFAULT_LSR_QEMU_REPORT_ERRORS_URL = (
 )
 INVENTORY_FAIL_MSG = "ERROR: Inventory is empty, tests did not run"
 DEFAULT_PROFILE_TASK_LIMIT = 30  # report up to 30 tasks in profile
-DEFAULT_POST_SNAP_SLEEP_TIME = 1  # seconds
+DEFAULT_POST_SNAP_SLEEP_TIME = 0  # seconds
+IMAGE_STORE_DIR = ".store"  # content-addressed image store in the cache
+STORE_USED_SUFFIX = ".used"  # mtime of this file is the last use time
+HASH_CHUNK_SIZE = 1024 * 1024
+DEFAULT_DOWNLOAD_CONNECTIONS = 4
+MIN_RANGE_SIZE = 32 * 1024 * 1024  # do not split downloads smaller than this
+DOWNLOAD_RETRIES = 5
+IMAGE_URL_CACHE = ".image-urls.json"  # resolved compose/centoshtml urls
+DEFAULT_IMAGE_URL_TTL = 3600  # seconds
+# the VM uses 2048 MiB by default - allow some overhead for qemu
+PREWARM_VM_MEMORY = 2560 * 1024 * 1024
+PREWARM_DOWNLOADS = 4  # number of images to download at the same time
+LOCK_SUFFIX = ".lock"
+# url, Last-Modified and ETag of the image that a label was downloaded from
+IMAGE_SOURCE_SUFFIX = ".source"
+SNAPSHOT_MANIFEST_SUFFIX = ".manifest"
+# environment variables which do not change how a snapshot is set up
+SNAPSHOT_IGNORE_ENV = (
+    "TEST_ARTIFACTS",
+    "TEST_DEBUG",
+    "TEST_INVENTORY",
+    "TEST_WRITE_TO_IMAGE",
+    # parallel workers each add their own suffix to the cache disks
+    "TEST_YUM_CACHE_PATHS",
+    "TEST_YUM_VARLIB_PATHS",
+)
+# relative to the tests directory - see handle_vault
+VAULT_VARIABLES_FILE = os.path.join("vars", "vault-variables.yml")
+QMP_TIMEOUT = 60  # seconds to wait for qemu to answer or to exit
+POWERDOWN_TIMEOUT = 120  # seconds to wait for the guest to power off
+SAVEVM_TIMEOUT = 300  # seconds to wait for savevm or loadvm
+RESET_VM_STATE = "lsr-reset"  # name of the VM state saved for --reset-vm
+TEST_DURATIONS = ".test-durations.json"  # durations of tests in the cache
+TEST_DURATIONS_HISTORY = 5  # the number of durations kept for each test
+TIMING_DB = "timing.sqlite"  # default lsr_timing database in the cache
+TIMING_REGRESSION_FACTOR = 1.2  # report durations 20% over the average
+TIMING_REGRESSION_MIN = 1.0  # ignore increases of less than this many seconds
+COLLECTION_CACHE_MAX_AGE = 24  # hours before cached collections are updated
+CALLBACK_PLUGIN_CACHE_DIR = "callback_plugins"  # in the collection cache
 
 COLLECTION_NAMESPACE = "fedora"
 COLLECTION_NAME = "linux_system_roles"
@@ -143,25 +199,65 @@ def get_metadata_from_file(path, attr_key):
     return os.fsdecode(mdbytes)
 
 
+def read_image_source(path):
+    """
+    Get the url, Last-Modified and ETag of the image at path as a dict.
+
+    They are saved per label, in path + IMAGE_SOURCE_SUFFIX, because
+    several labels, downloaded from different urls, may be linked to the
+    same image in the image store.
+    """
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path + IMAGE_SOURCE_SUFFIX) as ff:
+            return json.load(ff)
+    except (OSError, ValueError):
+        pass
+    return {
+        "url": get_metadata_from_file(path, URL_XATTR),
+        "last_modified": get_metadata_from_file(path, DATE_XATTR),
+        "etag": get_metadata_from_file(path, ETAG_XATTR),
+    }
+
+
+def write_image_source(path, url, last_modified, etag):
+    """Save the source of the image at path - see read_image_source."""
+    source = {"url": url, "last_modified": last_modified, "etag": etag}
+    # other jobs may be reading the file - replace it atomically
+    with tempfile.NamedTemporaryFile(
+        "w", dir=os.path.dirname(path), delete=False
+    ) as ff:
+        json.dump(source, ff)
+    os.rename(ff.name, path + IMAGE_SOURCE_SUFFIX)
+
+
 def image_source_last_modified_by_file_metadata(path):
     """Get last update metadata from file at given path."""
-    return (
-        get_metadata_from_file(path, DATE_XATTR)
-        if os.path.exists(path)
-        else ""
-    )
+    return read_image_source(path).get("last_modified") or ""
 
 
 @contextmanager
-def urlopen_retry(url):
+def urlopen_retry(url, headers=None, method=None):
     """Retry opening url up to 5 times."""
-    request = Request(url)
+    request = Request(url, method=method)
     request.add_header("User-Agent", "linux-system-roles/runqemu")
     request.add_header("Accept", "*/*")
+    for key, value in (headers or {}).items():
+        request.add_header(key, value)
     for retry in range(1, 5):
         try:
-            yield urlopen(request)
-            return
+            response = urlopen(request)  # nosec
+            break
+        except HTTPError as e:
+            # e.g. 304 Not Modified is an answer, not a failure
+            if e.code < 400:
+                raise
+            last_error = e
+            logging.warning(
+                "Opening %s failed, retry #%i: %s", url, retry, str(e)
+            )
+            time.sleep(retry * retry)
         except OSError as e:
             last_error = e
             msg = str(e)
@@ -169,19 +265,78 @@ def urlopen_retry(url):
                 "Opening %s failed, retry #%i: %s", url, retry, msg
             )
             time.sleep(retry * retry)
+    else:
+        raise last_error
 
-    raise last_error
+    # errors while reading the response are for the caller to handle -
+    # do not retry them here
+    try:
+        yield response
+    finally:
+        response.close()
 
 
-def origurl(path):
-    """Return the original URL that a given file was downloaded from."""
-    return get_metadata_from_file(path, URL_XATTR)
+@contextmanager
+def cache_lock(path):
+    """
+    Hold an exclusive lock on path + LOCK_SUFFIX.
+
+    Only one process at a time may download an image or create a snapshot
+    in the cache.  The others wait for the lock, and then find the file up
+    to date.  The lock file is never removed, as another process may be
+    waiting on it.
+    """
+    with open(path + LOCK_SUFFIX, "a") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            logging.info("Waiting for another process to finish %s", path)
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def try_flock(lock_file):
+    """Take an exclusive flock on lock_file, return False if it is held."""
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError as e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        return False
+    return True
+
+
+@contextmanager
+def try_cache_lock(path):
+    """
+    Take the lock of cache_lock on path, if no other process holds it.
+
+    Yields True if the lock was taken, and False if it is held - the
+    caller must leave path alone then.
+    """
+    with open(path + LOCK_SUFFIX, "a") as lock_file:
+        yield try_flock(lock_file)
+
 
+@contextmanager
+def use_cached_image(path):
+    """
+    Hold a shared lock on the cached image at path while it is in use.
+
+    The lock is on the image itself, so it covers all the labels linked
+    to the image in the image store.  evict_store_image does not remove
+    an image which is locked.
+    """
+    with open(path, "rb") as image_file:
+        fcntl.flock(image_file, fcntl.LOCK_SH)
+        yield
 
-def get_metadata_from_url(url, metadata_key):
-    """Get metadata from given url."""
-    with urlopen_retry(url) as url_response:  # nosec
-        return url_response.getheader(metadata_key)
+
+def origurl(path):
+    """Return the original URL that a given file was downloaded from."""
+    return read_image_source(path).get("url")
 
 
 def get_inventory_script(inventory):
@@ -240,64 +395,621 @@ def get_lsr_report_errors_script(lsr_report_errors_url, test_env):
     os.chmod(lsr_report_errors_destfile, 0o644)
 
 
-def fetch_image(url, cache, label):
+def parse_size(val):
+    """Convert a size like 500M, 20G or 1T into bytes - 0 means no limit."""
+    if not val:
+        return 0
+    match = re.match(r"^\s*([0-9]+)\s*([KMGT]?)i?B?\s*$", str(val), re.I)
+    if not match:
+        raise ValueError("invalid size %r" % (val,))
+    exponent = " KMGT".index(match.group(2).upper() or " ")
+    return int(match.group(1)) * 1024**exponent
+
+
+def get_image_store(cache):
+    """Return the content-addressed image store dir in cache, create it."""
+    store = os.path.join(cache, IMAGE_STORE_DIR)
+    os.makedirs(store, exist_ok=True)
+    return store
+
+
+def hash_file(path):
+    """Return the sha256 hex digest of the file at path."""
+    sha = hashlib.sha256()
+    with open(path, "rb") as ff:
+        for chunk in iter(lambda: ff.read(HASH_CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def get_file_signature(path):
+    """Return the size and the mtime of the file at path as a string."""
+    stats = os.stat(path)
+    return "{}:{}".format(stats.st_size, stats.st_mtime_ns)
+
+
+def set_image_digest(path, digest):
+    """Save the sha256 of the image at path, and when it was computed."""
+    os.setxattr(path, DIGEST_XATTR, os.fsencode(digest))
+    os.setxattr(path, VERIFIED_XATTR, os.fsencode(get_file_signature(path)))
+
+
+def verify_cached_image(path):
+    """
+    Check that the cached image at path still has its saved sha256.
+
+    The image is hashed again only if its size or mtime changed since the
+    sha256 was computed, or if that is not known.
+    """
+    signature = get_file_signature(path)
+    if get_metadata_from_file(path, VERIFIED_XATTR) == signature:
+        return True
+    digest = get_metadata_from_file(path, DIGEST_XATTR)
+    logging.info("Verifying the sha256 of cached image %s", path)
+    if hash_file(path) != digest:
+        return False
+    os.setxattr(path, VERIFIED_XATTR, os.fsencode(signature))
+    return True
+
+
+def touch_store_image(store_path):
+    """Mark store_path as recently used for LRU eviction."""
+    # do not touch the image itself - changing the image ctime would
+    # invalidate any snapshot which uses the image as a backing file
+    with open(store_path + STORE_USED_SUFFIX, "a"):
+        pass
+    os.utime(store_path + STORE_USED_SUFFIX)
+
+
+def find_store_image(cache, path):
+    """Return the image in the store that path is linked to, or None."""
+    stats = os.stat(path)
+    if stats.st_nlink < 2:
+        return None
+    store = get_image_store(cache)
+    for name in os.listdir(store):
+        store_path = os.path.join(store, name)
+        store_stats = os.stat(store_path)
+        if (
+            store_stats.st_ino == stats.st_ino
+            and store_stats.st_dev == stats.st_dev
+        ):
+            return store_path
+    return None
+
+
+def link_label_to_store(store_path, path):
+    """Atomically replace path with a hardlink to store_path."""
+    if os.path.exists(path) and os.path.samefile(store_path, path):
+        return
+    link_tmp = path + ".link"
+    if os.path.lexists(link_tmp):
+        os.unlink(link_tmp)
+    os.link(store_path, link_tmp)
+    os.rename(link_tmp, path)
+
+
+def add_to_image_store(cache, path, digest, suffix):
+    """
+    Add the file at path to the image store as digest, return store path.
+
+    If the store already has an image with the same content, the new file
+    is discarded and the existing copy is used instead.
+    """
+    store_path = os.path.join(get_image_store(cache), digest + suffix)
+    if os.path.exists(store_path):
+        if not os.path.samefile(path, store_path):
+            os.unlink(path)
+    else:
+        os.rename(path, store_path)
+    return store_path
+
+
+def remove_store_image(store_path):
+    """Remove store_path from the image store, with its last use time."""
+    for file_path in (store_path, store_path + STORE_USED_SUFFIX):
+        if os.path.exists(file_path):
+            os.unlink(file_path)
+
+
+def get_store_labels(cache, store_path):
+    """Return the labels in cache which are linked to store_path."""
+    store_stats = os.stat(store_path)
+    labels = []
+    for name in os.listdir(cache):
+        label_path = os.path.join(cache, name)
+        try:
+            label_stats = os.lstat(label_path)
+        except OSError:
+            continue
+        if (
+            label_stats.st_ino == store_stats.st_ino
+            and label_stats.st_dev == store_stats.st_dev
+        ):
+            labels.append(label_path)
+    return labels
+
+
+def evict_store_image(cache, store_path):
+    """
+    Remove store_path, all labels linked to it, and their snapshots.
+
+    Returns False, and removes nothing, if another process holds the lock
+    of a label or of its snapshot - see cache_lock - or is using the
+    image - see use_cached_image.
+    """
+    labels = get_store_labels(cache, store_path)
+    with ExitStack() as locks:
+        image_file = locks.enter_context(open(store_path, "rb"))
+        if not try_flock(image_file):
+            logging.info(
+                "Not evicting image %s from cache - it is in use", store_path
+            )
+            return False
+        for label_path in labels:
+            for lock_path in (label_path, label_path + ".snap"):
+                if not locks.enter_context(try_cache_lock(lock_path)):
+                    logging.info(
+                        "Not evicting image %s from cache - %s is in use",
+                        label_path,
+                        lock_path,
+                    )
+                    return False
+        for label_path in labels:
+            logging.info("Evicting image %s from cache", label_path)
+            os.unlink(label_path)
+            for file_path in (
+                label_path + IMAGE_SOURCE_SUFFIX,
+                label_path + ".snap",
+                label_path + ".snap" + SNAPSHOT_MANIFEST_SUFFIX,
+            ):
+                if os.path.exists(file_path):
+                    os.unlink(file_path)
+        remove_store_image(store_path)
+    return True
+
+
+def prune_image_store(cache, max_size, keep=None):
+    """Evict least recently used images until the store fits in max_size."""
+    if max_size <= 0:
+        return
+    store = get_image_store(cache)
+    entries = []
+    total = 0
+    for name in os.listdir(store):
+        if name.endswith(STORE_USED_SUFFIX):
+            continue
+        store_path = os.path.join(store, name)
+        stats = os.stat(store_path)
+        used_file = store_path + STORE_USED_SUFFIX
+        if os.path.exists(used_file):
+            last_used = os.stat(used_file).st_mtime
+        else:
+            last_used = stats.st_mtime
+        size = stats.st_blocks * 512
+        total += size
+        entries.append((last_used, store_path, size))
+    for _, store_path, size in sorted(entries):
+        if total <= max_size:
+            break
+        if keep and os.path.samefile(store_path, keep):
+            continue
+        if evict_store_image(cache, store_path):
+            total -= size
+    if total > max_size:
+        logging.warning(
+            "Image cache %s uses %d bytes - more than max size %d",
+            store,
+            total,
+            max_size,
+        )
+
+
+class RangeNotSupported(HTTPException):
+    """The server returned the whole file for a range request."""
+
+
+def download_range(url, path, start, end, progress, changed, stop):
+    """
+    Download bytes start to end of url into the file at path.
+
+    If the transfer fails midway, the download is resumed from the last
+    byte written instead of starting over.  @progress[start] is set to
+    the offset up to which the data has been written to the file, and
+    the condition @changed is notified.  The download is abandoned when
+    the event @stop is set, e.g. because another part failed.
+    """
+    offset = start
+    for retry in range(1, DOWNLOAD_RETRIES + 1):
+        try:
+            range_hdr = {"Range": "bytes={}-{}".format(offset, end)}
+            with urlopen_retry(url, range_hdr) as response:  # nosec
+                if response.getcode() != 206:
+                    raise RangeNotSupported(
+                        "Server did not return a partial response"
+                    )
+                with open(path, "r+b") as ff:
+                    ff.seek(offset)
+                    while offset <= end:
+                        if stop.is_set():
+                            return
+                        chunk = response.read(
+                            min(HASH_CHUNK_SIZE, end + 1 - offset)
+                        )
+                        if not chunk:
+                            raise HTTPException(
+                                "Connection closed at byte {}".format(offset)
+                            )
+                        ff.write(chunk)
+                        ff.flush()
+                        offset += len(chunk)
+                        with changed:
+                            progress[start] = offset
+                            changed.notify_all()
+            return
+        except RangeNotSupported:
+            raise  # retrying does not help
+        except (OSError, HTTPException) as e:
+            if retry == DOWNLOAD_RETRIES:
+                raise
+            logging.warning(
+                "Download of %s failed at byte %d, resume #%i: %s",
+                url,
+                offset,
+                retry,
+                str(e),
+            )
+            if stop.wait(retry * retry):
+                return
+
+
+def hash_ranges(path, ranges, progress, changed, futures):
+    """
+    Hash the file at path while its ranges are being downloaded.
+
+    The file is read in order right behind the download of each range,
+    while the data is still in the page cache, so that the image does not
+    have to be read again after the download.  The condition @changed
+    is notified when a range makes progress, and when the download of a
+    range ends.  Raises the error of the first range which failed, as
+    soon as it fails.  Returns the sha256 hex digest of the file.
+    """
+    sha = hashlib.sha256()
+    # unbuffered - read ahead would return the preallocated zeros
+    with open(path, "rb", buffering=0) as ff:
+        for start, end in ranges:
+            pos = start
+            while pos <= end:
+                with changed:
+                    while progress[start] <= pos:
+                        for future in futures.values():
+                            if future.done():
+                                future.result()  # raises the download error
+                        changed.wait()
+                    available = progress[start]
+                chunk = ff.read(min(HASH_CHUNK_SIZE, available - pos))
+                sha.update(chunk)
+                pos += len(chunk)
+    return sha.hexdigest()
+
+
+def download_stream(response, path):
+    """Save the body of response to the file at path, return its sha256."""
+    sha = hashlib.sha256()
+    with open(path, "wb") as ff:
+        for chunk in iter(lambda: response.read(HASH_CHUNK_SIZE), b""):
+            sha.update(chunk)
+            ff.write(chunk)
+    return sha.hexdigest()
+
+
+def download_ranges(url, path, size, connections):
+    """
+    Download url into the file at path in up to connections parts.
+
+    Returns the sha256 hex digest of the file.
+    """
+    with open(path, "wb") as ff:
+        try:
+            os.posix_fallocate(ff.fileno(), 0, size)
+        except OSError:
+            ff.truncate(size)
+    parts = max(1, min(connections, size // MIN_RANGE_SIZE))
+    part_size = -(-size // parts)  # round up
+    ranges = [
+        (start, min(start + part_size, size) - 1)
+        for start in range(0, size, part_size)
+    ]
+    logging.info(
+        "Downloading %s - %d bytes in %d parts", url, size, len(ranges)
+    )
+    progress = {start: start for start, _ in ranges}
+    changed = threading.Condition()
+    stop = threading.Event()
+
+    def wake_hasher(_future):
+        """Let hash_ranges see that the download of a range ended."""
+        with changed:
+            changed.notify_all()
+
+    with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        futures = {
+            start: executor.submit(
+                download_range,
+                url,
+                path,
+                start,
+                end,
+                progress,
+                changed,
+                stop,
+            )
+            for start, end in ranges
+        }
+        for future in futures.values():
+            future.add_done_callback(wake_hasher)
+        try:
+            return hash_ranges(path, ranges, progress, changed, futures)
+        finally:
+            # if a part failed, do not wait for the others to finish
+            stop.set()
+            for future in futures.values():
+                future.cancel()
+
+
+def download_url(url, path, connections=1, headers=None):
+    """
+    Download url into the file at path, hashing it while downloading.
+
+    @headers are added to the request, e.g. If-Modified-Since.  Returns
+    None if the server replies 304 Not Modified, otherwise a tuple of the
+    sha256 hex digest of the file and the Last-Modified and ETag headers
+    of the response.
+
+    The first request asks for the first byte of the file only.  If the
+    server returns it, the file is preallocated and fetched in up to
+    @connections parallel parts, and each part is resumed after a failure
+    during this download.  Otherwise, the body of the first response is
+    saved in a single stream.  If the server returns the whole file for a
+    part, the file is downloaded again in a single stream.
+    """
+    probe_headers = dict(headers or {})
+    probe_headers["Range"] = "bytes=0-0"
+    try:
+        with urlopen_retry(url, probe_headers) as response:  # nosec
+            last_modified = response.getheader("Last-Modified")
+            etag = response.getheader("ETag")
+            if response.getcode() != 206:
+                logging.info("Downloading %s in a single stream", url)
+                digest = download_stream(response, path)
+                return digest, last_modified, etag
+            # e.g. bytes 0-0/1234 - the size may be unknown: bytes 0-0/*
+            match = re.match(
+                r"^bytes 0-0/([0-9]+)$",
+                response.getheader("Content-Range") or "",
+            )
+    except HTTPError as e:
+        if e.code == 304:
+            return None
+        raise
+    try:
+        if not match:
+            raise RangeNotSupported(
+                "Server did not return the size of the file"
+            )
+        digest = download_ranges(url, path, int(match.group(1)), connections)
+    except RangeNotSupported as e:
+        logging.warning(
+            "Cannot download %s in parts, downloading it in a single "
+            "stream: %s",
+            url,
+            str(e),
+        )
+        with urlopen_retry(url) as response:  # nosec
+            digest = download_stream(response, path)
+    return digest, last_modified, etag
+
+
+def get_store_image(cache, path, suffix):
+    """
+    Return the path in the image store of the cached image at path.
+
+    Images downloaded before the store existed are added to the store.
+    """
+    store_path = find_store_image(cache, path)
+    if store_path is None:
+        logging.info("Adding cached image %s to image store", path)
+        path_tmp = path + ".store"
+        if os.path.lexists(path_tmp):
+            os.unlink(path_tmp)
+        os.link(path, path_tmp)
+        digest = hash_file(path_tmp)
+        set_image_digest(path_tmp, digest)
+        store_path = add_to_image_store(cache, path_tmp, digest, suffix)
+        link_label_to_store(store_path, path)
+    elif get_metadata_from_file(path, DIGEST_XATTR) is None:
+        # the store object is named by the digest
+        digest = os.path.basename(store_path)[: -len(suffix) or None]
+        os.setxattr(path, DIGEST_XATTR, os.fsencode(digest))
+    return store_path
+
+
+def get_image_path(url, cache, label):
+    """Return the path of the image from url in cache - see fetch_image."""
+    suffix = os.path.splitext(url.split("/")[-1])[1]
+    return os.path.join(cache, label + suffix)
+
+
+def get_conditional_headers(path, url):
+    """
+    Get the request headers to check if the image at path is up to date.
+
+    Returns an empty dict if there is no image downloaded from url at path.
+    """
+    headers = {}
+    source = read_image_source(path)
+    if source.get("url") == url:
+        last_modified = source.get("last_modified")
+        etag = source.get("etag")
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        if etag:
+            headers["If-None-Match"] = etag
+    return headers
+
+
+def check_cached_image(path, store_path, checksum=None):
+    """
+    See if the cached image at path is intact, and has sha256 @checksum.
+
+    A corrupt image is removed, with its copy in the store at
+    @store_path, so that it is downloaded again, and its snapshot is set
+    up again.
+    """
+    digest = get_metadata_from_file(path, DIGEST_XATTR)
+    if not verify_cached_image(path):
+        logging.warning(
+            "Cached image %s does not match its sha256 %s, "
+            "downloading it again",
+            path,
+            digest,
+        )
+        os.unlink(path)
+        remove_store_image(store_path)
+        snap_manifest = path + ".snap" + SNAPSHOT_MANIFEST_SUFFIX
+        if os.path.exists(snap_manifest):
+            os.unlink(snap_manifest)
+        return False
+    if checksum and digest != checksum:
+        logging.warning(
+            "Cached image %s has sha256 %s instead of %s, "
+            "downloading it again",
+            path,
+            digest,
+            checksum,
+        )
+        return False
+    return True
+
+
+def fetch_image(
+    url,
+    cache,
+    label,
+    cache_max_size=0,
+    connections=DEFAULT_DOWNLOAD_CONNECTIONS,
+    offline=False,
+    checksum=None,
+):
     """
     Fetch an image from url into the cache with label.
 
     Fetches an image from @url into @cache as @label if a file with the
-    same name downloaded from the same URL doesn't yet exist. There is
-    no need for fancier caching, as image URLs are unique enough.
+    same name downloaded from the same URL doesn't yet exist, or if the
+    server says that the image was changed since it was downloaded.  The
+    check is a single conditional request using the Last-Modified and
+    ETag saved with the label - see read_image_source.  If @offline is
+    True, a cached image is used without asking the server.
 
     Labels are not unique enough, because the URL corresponding to
-    the label may get updated. And using a filename derived from URL
-    would lead to leftover image files filling up the cache directory,
-    as nobody would delete them when the URL changes.
+    the label may get updated.  The image data is kept in a content
+    addressed store in the cache, named by the sha256 of the image, and
+    each label is a hardlink to the image in the store.  Identical images
+    used by several labels are stored only once.  If @cache_max_size is
+    given, the least recently used images are removed from the store
+    until it fits.
+
+    The sha256 of the image is computed while downloading and saved with
+    the image, with the size and mtime of the image.  A cached image is
+    hashed again if its size or mtime changed, and is downloaded again if
+    it does not match its sha256 any more.  If @checksum, the expected
+    sha256, is given, a downloaded image which does not match is
+    discarded, and a cached image which does not match is downloaded
+    again.
 
-    Returns the full path to the image.
+    Returns the full path to the image, or None if it could not be
+    downloaded.
     """
 
     original_name = url.split("/")[-1]
     nameroot, suffix = os.path.splitext(original_name)
     image_name = label + suffix
     path = os.path.join(cache, image_name)
-    image_last_modified_by_src = get_metadata_from_url(url, "Last-Modified")
-    image_last_modified_by_file = image_source_last_modified_by_file_metadata(
-        path
-    )
-
-    if (
-        not os.path.exists(path)
-        or url != origurl(path)
-        or image_last_modified_by_src != image_last_modified_by_file
-    ):
-        logging.info("Fetch url %s for %s", url, image_name)
+    cached = os.path.exists(path)
+    if cached:
+        store_path = get_store_image(cache, path, suffix)
+        cached = check_cached_image(path, store_path, checksum)
+    if offline:
+        if not cached:
+            logging.critical("Offline - no valid cached image %s", path)
+            return None
+        if url != origurl(path):
+            logging.warning(
+                "Offline - using cached image %s downloaded from %s",
+                path,
+                origurl(path),
+            )
+        result = None
+    else:
+        headers = get_conditional_headers(path, url) if cached else {}
+        if headers:
+            logging.info("Check url %s for %s", url, image_name)
+        else:
+            logging.info("Fetch url %s for %s", url, image_name)
 
         image_tempfile = tempfile.NamedTemporaryFile(dir=cache, delete=False)
+        image_tempfile.close()
         try:
-            with urlopen_retry(url) as request:  # nosec
-                shutil.copyfileobj(request, image_tempfile)
-        except OSError:
+            result = download_url(
+                url, image_tempfile.name, connections, headers
+            )
+        except (OSError, HTTPException):
             logging.warning(traceback.format_exc())
             os.unlink(image_tempfile.name)
             return None
+        if not result:
+            os.unlink(image_tempfile.name)
+            if not cached:
+                logging.critical(
+                    "Server replied Not Modified to the download of %s",
+                    url,
+                )
+                return None
 
-        os.setxattr(image_tempfile.name, URL_XATTR, os.fsencode(url))
-        os.setxattr(
-            image_tempfile.name,
-            DATE_XATTR,
-            os.fsencode(image_last_modified_by_src),
+    if result:
+        digest, last_modified, etag = result
+        if checksum and digest != checksum:
+            logging.critical(
+                "Image downloaded from %s has sha256 %s instead of %s",
+                url,
+                digest,
+                checksum,
+            )
+            os.unlink(image_tempfile.name)
+            return None
+        set_image_digest(image_tempfile.name, digest)
+        store_path = add_to_image_store(
+            cache, image_tempfile.name, digest, suffix
         )
-        os.rename(image_tempfile.name, path)
+        link_label_to_store(store_path, path)
+        write_image_source(path, url, last_modified, etag)
     else:
         logging.info("Using cached image %s for %s", path, image_name)
 
+    touch_store_image(store_path)
+    prune_image_store(cache, cache_max_size, keep=store_path)
     return path
 
 
 def composeurl2images(  # noqa: C901
     composeurl, desiredarch, desiredvariant=None, desiredsubvariant=None
 ):
-    """Find the latest url for a compose link."""
+    """
+    Find the latest url for a compose link.
+
+    Returns a list of (url, sha256) tuples - sha256 is None if the compose
+    does not have the checksum of the image.
+    """
     # we will need to join it with a relative path component
     if composeurl.endswith("/"):
         composepath = composeurl
@@ -361,7 +1073,10 @@ def composeurl2images(  # noqa: C901
             if len(subvariantmatch) > 0:
                 candidates = subvariantmatch
 
-    return [(composepath + qcow2[0].path) for qcow2 in candidates]
+    return [
+        (composepath + qcow2[0].path, qcow2[0].checksums.get("sha256"))
+        for qcow2 in candidates
+    ]
 
 
 def centoshtml2image(url, desiredarch):
@@ -415,12 +1130,15 @@ def get_url(image):
             compose_url, "x86_64", variant, subvariant
         )
         if len(image_urls) == 1:
-            return image_urls[0]
+            image_url, sha256 = image_urls[0]
+            if sha256:
+                image.setdefault("checksum", "sha256:" + sha256)
+            return image_url
         else:
             if image_urls:
                 logging.error(
                     "Multiple images found: %s" "in compose %s",
-                    image_urls,
+                    [image_url for image_url, _ in image_urls],
                     compose_url,
                 )
             else:
@@ -435,6 +1153,120 @@ def get_url(image):
         )
 
 
+def parse_checksum_file(text, name):
+    """
+    Find the sha256 of the file name in the given CHECKSUM file text.
+
+    Both the BSD style "SHA256 (name) = hex" and the sha256sum style
+    "hex  name" lines are understood.  Returns None if name is not found.
+    """
+    bsd_re = re.compile(r"^SHA256 \((.+)\) = ([0-9a-fA-F]{64})$")
+    gnu_re = re.compile(r"^([0-9a-fA-F]{64}) [ *](.+)$")
+    for line in text.splitlines():
+        line = line.strip()
+        match = bsd_re.match(line)
+        if match and match.group(1) == name:
+            return match.group(2).lower()
+        match = gnu_re.match(line)
+        if match and match.group(2) == name:
+            return match.group(1).lower()
+    return None
+
+
+def get_image_checksum(image, image_url, offline=False):
+    """
+    Get the expected sha256 of the image downloaded from image_url.
+
+    The "checksum" of the image in the config is either "sha256:hex", or
+    the URL of a CHECKSUM file listing the image.  For compose images, the
+    checksum from the compose metadata is used if not given in the config.
+    Returns None if the checksum is not known.
+    """
+    checksum = image.get("checksum")
+    if not checksum:
+        return None
+    if checksum.startswith("sha256:"):
+        return checksum.split(":", 1)[1].lower()
+    if offline:
+        return None
+    name = image_url.split("/")[-1]
+    try:
+        with urlopen_retry(checksum) as response:  # nosec
+            text = response.read().decode("utf-8", "replace")
+    except (OSError, HTTPException) as e:
+        logging.warning("Could not get checksum file %s: %s", checksum, e)
+        return None
+    sha256 = parse_checksum_file(text, name)
+    if not sha256:
+        logging.warning("Image %s not found in %s", name, checksum)
+    return sha256
+
+
+def get_url_cache_key(image):
+    """Return the key of the image in the url cache, or None."""
+    if image.get("source"):
+        return None  # nothing to resolve
+    if image.get("compose"):
+        return "|".join(
+            [
+                image["compose"],
+                "x86_64",
+                image.get("variant") or "",
+                image.get("subvariant") or "",
+            ]
+        )
+    if image.get("centoshtml"):
+        return "|".join([image["centoshtml"], "x86_64"])
+    return None
+
+
+def resolve_image_url(
+    image,
+    cache,
+    ttl=DEFAULT_IMAGE_URL_TTL,
+    refresh=False,
+    offline=False,
+):
+    """
+    Get the url to use to download the given image, using the url cache.
+
+    Resolving compose and centoshtml images requires downloading and
+    parsing the compose metadata or the html image list.  The result is
+    saved in IMAGE_URL_CACHE in the @cache directory, and is used for
+    @ttl seconds, unless @refresh is True.  If @offline is True, the saved
+    result is used no matter how old it is.
+    """
+    key = get_url_cache_key(image)
+    if key is None:
+        return get_url(image)
+    url_cache_file = os.path.join(cache, IMAGE_URL_CACHE)
+    try:
+        with open(url_cache_file) as ff:
+            url_cache = json.load(ff)
+    except (OSError, ValueError):
+        url_cache = {}
+    entry = url_cache.get(key)
+    if entry and (
+        offline or (not refresh and time.time() - entry["time"] < ttl)
+    ):
+        logging.info("Using cached url %s for %s", entry["url"], key)
+        if entry.get("checksum"):
+            image.setdefault("checksum", entry["checksum"])
+        return entry["url"]
+    image_url = get_url(image)
+    if image_url:
+        url_cache[key] = {
+            "url": image_url,
+            "checksum": image.get("checksum"),
+            "time": time.time(),
+        }
+        # other jobs may be reading the file - replace it atomically
+        with tempfile.NamedTemporaryFile("w", dir=cache, delete=False) as ff:
+            json.dump(url_cache, ff, indent=2)
+        os.rename(ff.name, url_cache_file)
+    return image_url
+
+
 def get_image(images, image_name):
     """Get the image config for the given image_name, or None."""
     for image in images:
@@ -600,10 +1432,15 @@ def make_setup_yml(
     return pre_setup_yml, post_setup_yml
 
 
-def get_image_config(args):
-    """Get the image to use."""
-    images = {}
-    extra_images_not_found = False
+def load_images_config(args):
+    """
+    Load the list of images from the config file and extra images file.
+
+    Returns the list of images, and the path of the extra images file if
+    it was not found, or None.
+    """
+    images = []
+    extra_images_not_found = None
 
     if args.config != "NONE":
         with open(args.config) as configfile:
@@ -624,7 +1461,7 @@ def get_image_config(args):
                         r"No such file or directory: .*extra-images.json",
                         str(ioe),
                     ):
-                        extra_images_not_found = True
+                        extra_images_not_found = extra_images_file
                     else:
                         logging.critical(
                             "Could not read or load extra images file %s",
@@ -632,8 +1469,13 @@ def get_image_config(args):
                             exc_info=ioe,
                         )
                         sys.exit(1)
+    return images, extra_images_not_found
 
+
+def get_image_config(args):
+    """Get the image to use."""
     if args.image_name:
+        images, extra_images_not_found = load_images_config(args)
         image = get_image(images, args.image_name)
         if not image:
             logging.critical(
@@ -643,7 +1485,7 @@ def get_image_config(args):
             )
             if extra_images_not_found:
                 logging.critical(
-                    "Extra images file %s not found", extra_images_file
+                    "Extra images file %s not found", extra_images_not_found
                 )
             sys.exit(1)
     else:
@@ -687,46 +1529,239 @@ rh-allow-sha1-signatures = yes
     return
 
 
-def download_image(image, cache):
-    """Download the image to the cache."""
+def download_image(
+    image,
+    cache,
+    cache_max_size=0,
+    connections=DEFAULT_DOWNLOAD_CONNECTIONS,
+    offline=False,
+    image_url_ttl=DEFAULT_IMAGE_URL_TTL,
+    refresh_image_urls=False,
+    in_use=None,
+):
+    """
+    Download the image to the cache.
+
+    The image is locked, so that concurrent jobs download it only once.
+    If @in_use, an ExitStack, is given, the downloaded image is locked as
+    in use until it is closed, so that other jobs do not evict the image
+    from the cache while it is used - see use_cached_image.
+    """
     if "file" not in image:
-        image_url = get_url(image)
+        with cache_lock(os.path.join(cache, image["name"])):
+            image_url = resolve_image_url(
+                image, cache, image_url_ttl, refresh_image_urls, offline
+            )
         if not image_url:
             formatstr = "Could not determine download URL for {} from {}."
             errstr = formatstr.format(image["name"], image)
             logging.critical(errstr)
             raise Exception(errstr)
-        image_path = fetch_image(image_url, cache, image["name"])
-        if not image_path:
-            formatstr = "Could not download image {} from URL {}."
-            errstr = formatstr.format(image["name"], image_url)
-            logging.critical(errstr)
-            raise Exception(errstr)
-        image["file"] = image_path
+        with cache_lock(get_image_path(image_url, cache, image["name"])):
+            image_path = fetch_image(
+                image_url,
+                cache,
+                image["name"],
+                cache_max_size,
+                connections,
+                offline,
+                get_image_checksum(image, image_url, offline),
+            )
+            if not image_path:
+                formatstr = "Could not download image {} from URL {}."
+                errstr = formatstr.format(image["name"], image_url)
+                logging.critical(errstr)
+                raise Exception(errstr)
+            if in_use is not None:
+                # before the lock is released, so that the image cannot
+                # be evicted in between
+                in_use.enter_context(use_cached_image(image_path))
+            image["file"] = image_path
 
 
-def stop_qemu(test_env):
-    """Stop qemu using LOCK_ON_FILE and wait for it to exit."""
-    lock_on_file = test_env.get("LOCK_ON_FILE")
-    if lock_on_file and os.path.exists(lock_on_file):
-        del test_env["LOCK_ON_FILE"]
-        with open(lock_on_file) as lff:
-            try:
-                waitpid = int(lff.read())
-            except ValueError:
-                waitpid = -1
-        os.unlink(lock_on_file)
-        logging.info(
-            "Shutting down VM pid [%d] from lock_on_file [%s]",
-            waitpid,
-            lock_on_file,
-        )
-        if waitpid == -1:
-            return
-        while True:
-            try:
+def get_setup_playbooks(
+    image, cache, remove_cloud_init, use_snapshot, use_yum_cache, setup_yml
+):
+    """Get the list of setup playbooks for the image and the given ones."""
+    pre_setup_yml, post_setup_yml = make_setup_yml(
+        image, cache, remove_cloud_init, use_snapshot, use_yum_cache
+    )
+    local_setup_yml = []
+    if pre_setup_yml:
+        local_setup_yml.append(pre_setup_yml)
+    if setup_yml:
+        local_setup_yml.extend(setup_yml)
+    if post_setup_yml:
+        local_setup_yml.append(post_setup_yml)
+    return local_setup_yml
+
+
+def make_test_env(image, cache, use_yum_cache):
+    """Make the environment for the inventory and playbooks of the image."""
+    test_env = dict(image.get("env", {}))
+    # failures in inventory will force ansible-playbook to fail
+    test_env["ANSIBLE_INVENTORY_ANY_UNPARSED_IS_FAILED"] = "true"
+    # disable inject fact vars by default - will be overridden by env if set
+    test_env["ANSIBLE_INJECT_FACT_VARS"] = "false"
+    if use_yum_cache:
+        yum_cache_path = os.path.join(cache, image["name"] + "_yum_cache")
+        test_env["TEST_YUM_CACHE_PATHS"] = yum_cache_path
+        yum_varlib_path = os.path.join(cache, image["name"] + "_yum_varlib")
+        test_env["TEST_YUM_VARLIB_PATHS"] = yum_varlib_path
+    return test_env
+
+
+class QMPClient(object):
+    """Minimal client for the QEMU Machine Protocol on a unix socket."""
+
+    def __init__(self, path, timeout=QMP_TIMEOUT):
+        """Connect to the QMP socket path, and enter command mode."""
+        self.path = path
+        self.buf = b""
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.connect(path)
+            self.read()  # greeting
+            self.command("qmp_capabilities")
+        except Exception:
+            self.close()
+            raise
+
+    def read(self):
+        """Read one message from qemu."""
+        while b"\n" not in self.buf:
+            try:
+                data = self.sock.recv(4096)
+            except socket.timeout:
+                raise
+            except (OSError, socket.error):
+                data = b""  # e.g. connection reset when qemu exits
+            if not data:
+                raise EOFError("qemu closed the QMP socket " + self.path)
+            self.buf += data
+        line, self.buf = self.buf.split(b"\n", 1)
+        return json.loads(line.decode("utf-8"))
+
+    def command(self, name, **arguments):
+        """Execute the QMP command name and return its result."""
+        msg = {"execute": name}
+        if arguments:
+            msg["arguments"] = arguments
+        try:
+            self.sock.sendall(json.dumps(msg).encode("utf-8") + b"\n")
+        except (OSError, socket.error):
+            raise EOFError("qemu closed the QMP socket " + self.path)
+        while True:
+            resp = self.read()
+            if "error" in resp:
+                raise RuntimeError(
+                    "QMP command {0} failed: {1}".format(
+                        name, resp["error"].get("desc")
+                    )
+                )
+            if "return" in resp:
+                return resp["return"]
+
+    def hmp(self, command_line):
+        """Execute a human monitor command e.g. savevm or loadvm."""
+        output = self.command(
+            "human-monitor-command", **{"command-line": command_line}
+        )
+        if output.strip():
+            # these commands print nothing if they succeed
+            raise RuntimeError(
+                "{0} failed: {1}".format(command_line, output.strip())
+            )
+
+    def wait_exit(self, timeout):
+        """Wait for qemu to exit - return False after timeout seconds."""
+        deadline = time.time() + timeout
+        try:
+            while time.time() < deadline:
+                self.sock.settimeout(max(deadline - time.time(), 0.01))
+                self.read()  # discard events
+        except socket.timeout:
+            return False
+        except EOFError:
+            return True
+        return False
+
+    def close(self):
+        """Close the connection to qemu."""
+        self.sock.close()
+
+
+def qmp_stop_vm(qmp_socket, graceful):
+    """
+    Stop the VM using the QMP socket and wait for qemu to exit.
+
+    If graceful is True, the guest is asked to power off, so that it can
+    write out everything to the image.  Returns False if qemu did not exit.
+    """
+    qmp = QMPClient(qmp_socket)
+    try:
+        try:
+            status = qmp.command("query-status")["status"]
+            if graceful and status == "running":
+                qmp.command("system_powerdown")
+                if qmp.wait_exit(POWERDOWN_TIMEOUT):
+                    return True
+                logging.warning(
+                    "VM did not power off in %d seconds", POWERDOWN_TIMEOUT
+                )
+            qmp.command("quit")
+        except EOFError:
+            pass  # qemu is exiting
+        return qmp.wait_exit(QMP_TIMEOUT)
+    finally:
+        qmp.close()
+
+
+def read_lock_on_file(lock_on_file):
+    """Return the qemu pid, or -1, and the QMP socket, or None."""
+    with open(lock_on_file) as lff:
+        fields = lff.read().split()
+    try:
+        waitpid = int(fields[0])
+    except (IndexError, ValueError):
+        waitpid = -1
+    qmp_socket = fields[1] if len(fields) > 1 else None
+    return waitpid, qmp_socket
+
+
+def stop_qemu(test_env):
+    """
+    Stop qemu using LOCK_ON_FILE and wait for it to exit.
+
+    The watcher in the inventory script writes the pid of qemu and the path
+    of its QMP socket to LOCK_ON_FILE.  qemu is stopped using QMP, which also
+    tells right away when qemu exits.  Without QMP, removing LOCK_ON_FILE
+    tells the watcher to kill qemu.
+    """
+    lock_on_file = test_env.get("LOCK_ON_FILE")
+    if lock_on_file and os.path.exists(lock_on_file):
+        del test_env["LOCK_ON_FILE"]
+        waitpid, qmp_socket = read_lock_on_file(lock_on_file)
+        os.unlink(lock_on_file)
+        logging.info(
+            "Shutting down VM pid [%d] from lock_on_file [%s]",
+            waitpid,
+            lock_on_file,
+        )
+        if qmp_socket:
+            graceful = strtobool(test_env.get("TEST_WRITE_TO_IMAGE", "false"))
+            try:
+                if qmp_stop_vm(qmp_socket, graceful):
+                    return
+            except (OSError, socket.error, EOFError, RuntimeError) as exc:
+                logging.debug("Could not stop VM using QMP: %s", exc)
+        if waitpid == -1:
+            return
+        while True:
+            try:
                 os.kill(waitpid, 0)
-                time.sleep(1)
+                time.sleep(0.1)
             except ProcessLookupError as ple:
                 if ple.errno == 3:
                     break  # no such process
@@ -734,6 +1769,73 @@ def stop_qemu(test_env):
                     raise
 
 
+def qmp_vm_command(test_env, command_line):
+    """Run the savevm or loadvm command_line in the VM of LOCK_ON_FILE."""
+    try:
+        _, qmp_socket = read_lock_on_file(test_env["LOCK_ON_FILE"])
+        if not qmp_socket:
+            raise RuntimeError("the VM has no QMP socket")
+        qmp = QMPClient(qmp_socket, SAVEVM_TIMEOUT)
+        try:
+            qmp.hmp(command_line)
+        finally:
+            qmp.close()
+    except (OSError, socket.error, EOFError, RuntimeError) as exc:
+        logging.warning("Could not %s: %s", command_line, exc)
+        return False
+    return True
+
+
+def boot_vm(inventory, test_env, write_inventory, cwd, log_file):
+    """
+    Boot the VM, and leave it running.
+
+    The inventory script is called directly to boot the VM and write the
+    inventory to @write_inventory.
+    """
+    test_env["TEST_INVENTORY"] = write_inventory
+    with file_or_stdout(log_file) as (stdout, stderr):
+        subprocess.check_call(  # nosec
+            [inventory], env=test_env, cwd=cwd, stdout=stdout, stderr=stderr
+        )
+    del test_env["TEST_INVENTORY"]
+
+
+def save_vm(test_env):
+    """Save the state of the VM for restore_vm, return True on success."""
+    return qmp_vm_command(test_env, "savevm " + RESET_VM_STATE)
+
+
+def restore_vm(test_env, inventory, log_file):
+    """
+    Restore the VM to the state saved by save_vm.
+
+    This also restores the clock of the guest, so set it to the current time,
+    which also checks that the VM can be reached.  Returns True on success.
+    """
+    if not qmp_vm_command(test_env, "loadvm " + RESET_VM_STATE):
+        return False
+    with file_or_stdout(log_file) as (stdout, stderr):
+        rc = subprocess.call(  # nosec
+            [
+                "ansible",
+                "--inventory=" + inventory,
+                "all",
+                "--module-name",
+                "raw",
+                "--args",
+                "date -u -s @%d" % time.time(),
+            ],
+            env=test_env,
+            stdout=stdout,
+            stderr=stderr,
+        )
+    if rc != 0:
+        logging.warning("Could not set the clock of the VM after loadvm")
+        return False
+    return True
+
+
 @contextmanager
 def file_or_stdout(file_to_open, mode="a"):
     """Return a file handle or stdout, stderr for subprocess."""
@@ -890,6 +1992,139 @@ def internal_run_ansible_playbooks(
             stop_qemu(test_env)
 
 
+def get_snapshot_fingerprint(image_file, test_env, ansible_args, setup_yml):
+    """
+    Get the fingerprint of everything used to set up a snapshot.
+
+    This is the sha256 of the identity of the backing image, the
+    ansible-playbook arguments, the TEST_* environment variables, and the
+    contents of the setup playbooks.  The vault variables are not part of
+    it, because handle_vault adds or removes them for each batch.
+    """
+    image_id = get_metadata_from_file(image_file, DIGEST_XATTR)
+    if not image_id:
+        # not downloaded by us e.g. --image-file
+        stats = os.stat(image_file)
+        image_id = "{}:{}:{}".format(
+            stats.st_ino, stats.st_size, stats.st_mtime
+        )
+    inputs = {
+        "image": image_id,
+        "ansible_args": [
+            arg
+            for arg in ansible_args
+            if not (
+                arg.startswith("--extra-vars=@")
+                and arg.endswith(VAULT_VARIABLES_FILE)
+            )
+        ],
+        "env": {
+            key: value
+            for key, value in test_env.items()
+            if key.startswith("TEST_") and key not in SNAPSHOT_IGNORE_ENV
+        },
+        "setup": [],
+    }
+    for setup_file in setup_yml:
+        with open(setup_file, "rb") as ff:
+            inputs["setup"].append(
+                [
+                    os.path.basename(setup_file),
+                    hashlib.sha256(ff.read()).hexdigest(),
+                ]
+            )
+    return hashlib.sha256(
+        json.dumps(inputs, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def snapshot_needs_refresh(snapfile, fingerprint, max_age=0):
+    """
+    Check the manifest of the snapshot.
+
+    The snapshot must be created again if it does not exist, if it was set
+    up with a different fingerprint, or if it is older than @max_age
+    seconds, if given.  The old snapshot manifest is removed in that case.
+    """
+    manifest_file = snapfile + SNAPSHOT_MANIFEST_SUFFIX
+    try:
+        with open(manifest_file) as ff:
+            manifest = json.load(ff)
+    except (OSError, ValueError):
+        manifest = {}
+    reason = None
+    if not os.path.isfile(snapfile):
+        reason = "%s does not exist"
+    elif not manifest:
+        reason = "%s has no manifest"
+    elif manifest.get("fingerprint") != fingerprint:
+        reason = "the image or the setup of %s changed"
+    elif max_age and time.time() - manifest.get("created", 0) > max_age:
+        reason = "%s is too old"
+    if not reason:
+        return False
+    logging.info("Creating snapshot because " + reason, snapfile)
+    if os.path.exists(manifest_file):
+        os.unlink(manifest_file)
+    return True
+
+
+def write_snapshot_manifest(snapfile, fingerprint):
+    """Record that the snapshot was set up with the given fingerprint."""
+    with open(snapfile + SNAPSHOT_MANIFEST_SUFFIX, "w") as ff:
+        json.dump({"fingerprint": fingerprint, "created": time.time()}, ff)
+
+
+@contextmanager
+def replace_snapshot(snapfile):
+    """
+    Yield the path to create a new snapshot at, to replace snapfile.
+
+    The new snapshot has the same basename as snapfile, in a temporary
+    directory next to it, so that the VM which sets it up has the same
+    name.  If the block succeeds, the new snapshot is renamed to snapfile.
+    The old snapshot is never written to, so running VMs which use it as
+    their backing file are not affected.
+    """
+    tmpdir = tempfile.mkdtemp(
+        prefix=".snap-", dir=os.path.dirname(os.path.abspath(snapfile))
+    )
+    try:
+        new_snapfile = os.path.join(tmpdir, os.path.basename(snapfile))
+        yield new_snapfile
+        os.rename(new_snapfile, snapfile)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def flush_snapshot(snapfile, log_file=None):
+    """
+    Make sure the snapshot is consistent and on disk before it is used.
+
+    The VM which set up the snapshot must have exited.  qemu-img check
+    fails if another process still has the image open, or if the qcow2
+    metadata is corrupt.  Then only the snapshot file is fsynced.
+    """
+    with file_or_stdout(log_file) as (stdout, stderr):
+        rc = subprocess.call(  # nosec
+            ["qemu-img", "check", "-q", snapfile],
+            stdout=stdout,
+            stderr=stderr,
+        )
+    # 3 means leaked clusters - this only wastes some space
+    if rc not in (0, 3):
+        raise Exception(
+            "qemu-img check of snapshot {} failed with error {}".format(
+                snapfile, rc
+            )
+        )
+    fd = os.open(snapfile, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
 def refresh_snapshot(
     image_file,
     snapfile,
@@ -901,84 +2136,77 @@ def refresh_snapshot(
     post_snap_sleep_time,
     log_file,
     ansible_container,
+    snapshot_max_age=0,
 ):
-    """Create the snapshot if it is missing or too old."""
-    need_refresh = False
-    if not os.path.isfile(snapfile):
-        need_refresh = True
-        logging.info("Creating snapshot because %s does not exist", snapfile)
-    else:
-        snap_stats = os.stat(snapfile)
-        file_stats = os.stat(image_file)
-        now = time.time()
-        # snapshot is older than 1 day or backing file is newer
-        if now - snap_stats.st_ctime > 86400:
-            need_refresh = True
-            logging.info("Creating snapshot because %s is too old", snapfile)
-        elif snap_stats.st_ctime < file_stats.st_ctime:
-            need_refresh = True
-            logging.info(
-                "Creating snapshot because %s is older than backing file %s",
-                snapfile,
-                image_file,
-            )
-    if need_refresh:
+    """
+    Create the snapshot if it is missing or out of date.
+
+    The snapshot is out of date if the backing image or the setup changed
+    since it was created - see get_snapshot_fingerprint - or if it is older
+    than @snapshot_max_age seconds, if given.  The snapshot is locked while
+    checking and creating it, so that concurrent jobs create it only once,
+    and then use it.
+    """
+    with cache_lock(snapfile):
+        fingerprint = get_snapshot_fingerprint(
+            image_file, test_env, ansible_args, setup_yml
+        )
+        if not snapshot_needs_refresh(snapfile, fingerprint, snapshot_max_age):
+            return
         if "LOCK_ON_FILE" in test_env:
             stop_qemu(test_env)
             test_env["LOCK_ON_FILE"] = tempfile.NamedTemporaryFile().name
-        with file_or_stdout(log_file) as (stdout, stderr):
-            subprocess.check_call(  # nosec
-                [
-                    "qemu-img",
-                    "create",
-                    "-f",
-                    "qcow2",
-                    "-b",
-                    image_file,
-                    "-F",
-                    "qcow2",
-                    snapfile,
-                ],
-                stdout=stdout,
-                stderr=stderr,
-            )
-        test_env_setup = {}
-        test_env_setup.update(test_env)
-        test_env_setup["TEST_WRITE_TO_IMAGE"] = "True"
-        if "TEST_DEBUG" in test_env_setup:
-            del test_env_setup["TEST_DEBUG"]
-        if "TEST_ARTIFACTS" in test_env_setup:
-            test_env_setup["TEST_ARTIFACTS"] = (
-                test_env_setup["TEST_ARTIFACTS"] + ".snap"
+        with replace_snapshot(snapfile) as new_snapfile:
+            with file_or_stdout(log_file) as (stdout, stderr):
+                subprocess.check_call(  # nosec
+                    [
+                        "qemu-img",
+                        "create",
+                        "-f",
+                        "qcow2",
+                        "-b",
+                        image_file,
+                        "-F",
+                        "qcow2",
+                        new_snapfile,
+                    ],
+                    stdout=stdout,
+                    stderr=stderr,
+                )
+            test_env_setup = {}
+            test_env_setup.update(test_env)
+            test_env_setup["TEST_SUBJECTS"] = new_snapfile
+            test_env_setup["TEST_WRITE_TO_IMAGE"] = "True"
+            if "TEST_DEBUG" in test_env_setup:
+                del test_env_setup["TEST_DEBUG"]
+            if "TEST_ARTIFACTS" in test_env_setup:
+                test_env_setup["TEST_ARTIFACTS"] = (
+                    test_env_setup["TEST_ARTIFACTS"] + ".snap"
+                )
+            if "LOCK_ON_FILE" in test_env_setup:
+                del test_env_setup["LOCK_ON_FILE"]
+            if "TEST_INVENTORY" in test_env_setup:
+                del test_env_setup["TEST_INVENTORY"]
+            internal_run_ansible_playbooks(
+                test_env_setup,
+                inventory,
+                ansible_args,
+                setup_yml,
+                cwd,
+                ansible_container,
+                wait_on_qemu=True,
+                log_file=log_file,
             )
-        if "LOCK_ON_FILE" in test_env_setup:
-            del test_env_setup["LOCK_ON_FILE"]
-        if "TEST_INVENTORY" in test_env_setup:
-            del test_env_setup["TEST_INVENTORY"]
-        internal_run_ansible_playbooks(
-            test_env_setup,
-            inventory,
-            ansible_args,
-            setup_yml,
-            cwd,
-            ansible_container,
-            wait_on_qemu=True,
-            log_file=log_file,
-        )
-        # there is still some sort of race condition here even with the
-        # wait_on_qemu - can get a kernel panic in the guest if started too
-        # soon after this - not sure what's going on, perhaps the OS is
-        # still flushing the changes to the qcow2.snap file in the background
-        # after the qemu process has exited - so the last resort of the
-        # desperate is the sleep with the magic number :-(
-        logging.info(
-            "Created snapshot %s - sleeping %d seconds to allow disk sync",
-            snapfile,
-            post_snap_sleep_time,
-        )
-        time.sleep(post_snap_sleep_time)
-        # sync on the host as well
-        subprocess.check_call(["/bin/sync"])  # nosec
+            # wait_on_qemu waited for qemu to exit
+            flush_snapshot(new_snapfile, log_file)
+            if post_snap_sleep_time:
+                logging.info(
+                    "Created snapshot %s - sleeping %d seconds",
+                    snapfile,
+                    post_snap_sleep_time,
+                )
+                time.sleep(post_snap_sleep_time)
+        write_snapshot_manifest(snapfile, fingerprint)
 
 
 def split_args_and_playbooks(args_and_playbooks):
@@ -1006,7 +2234,7 @@ def handle_vault(tests_dir, ansible_args, playbooks, test_env):
         vault_pwd_file,
     )
     vault_variables_file = os.path.abspath(
-        os.path.join(tests_dir, "vars", "vault-variables.yml")
+        os.path.join(tests_dir, VAULT_VARIABLES_FILE)
     )
     ev_arg = "--extra-vars=@{}".format(vault_variables_file)
     if os.path.exists(vault_pwd_file) and os.path.exists(vault_variables_file):
@@ -1044,12 +2272,16 @@ def handle_vault(tests_dir, ansible_args, playbooks, test_env):
 class Batch(object):
     """The data for each batch of playbooks."""
 
-    def __init__(self, args, ansible_args, playbooks, setup_playbooks):
+    def __init__(
+        self, args, ansible_args, playbooks, setup_playbooks, cleanup=False
+    ):
         """Init the batch object."""
         self.args = args
         self.ansible_args = ansible_args
         self.playbooks = [os.path.abspath(pb) for pb in playbooks]
         self.setup_playbooks = [os.path.abspath(pb) for pb in setup_playbooks]
+        # cleanup batches must run in the same VM as the batch before them
+        self.cleanup = cleanup
 
 
 def get_batches_from_playbooks_and_args(
@@ -1100,6 +2332,7 @@ def get_batches_from_playbooks_and_args(
                                 ansible_args,
                                 args.cleanup_yml + cleanup_yml,
                                 [],
+                                cleanup=True,
                             )
                         )
         elif cleanup_yml:
@@ -1107,16 +2340,156 @@ def get_batches_from_playbooks_and_args(
             for batch in batches:
                 batches_with_cleanup.append(batch)
                 batches_with_cleanup.append(
-                    Batch(batch.args, batch.ansible_args, cleanup_yml, [])
+                    Batch(
+                        batch.args,
+                        batch.ansible_args,
+                        cleanup_yml,
+                        [],
+                        cleanup=True,
+                    )
                 )
             batches = batches_with_cleanup
     return batches
 
 
+def group_batches(batches):
+    """Group each batch with the cleanup batches which follow it."""
+    groups = []
+    for batch in batches:
+        if batch.cleanup and groups:
+            groups[-1].append(batch)
+        elif batch.playbooks:
+            groups.append([batch])
+    return groups
+
+
+def get_queued_batches(work):
+    """Yield the batches of the groups in the queue work until it is empty."""
+    while True:
+        try:
+            group = work.get_nowait()
+        except queue.Empty:
+            return
+        for batch in group:
+            yield batch
+
+
+def load_test_durations(cache, image_name):
+    """
+    Get the durations in seconds of the tests run on the given image.
+
+    The duration of a test is the average of its recorded durations - see
+    record_test_duration.
+    """
+    try:
+        with open(os.path.join(cache, TEST_DURATIONS)) as ff:
+            tests = json.load(ff).get(image_name, {})
+    except (OSError, ValueError):
+        return {}
+    return {
+        test: sum(runs) / len(runs)
+        for test, runs in tests.items()
+        if isinstance(runs, list) and runs
+    }
+
+
+def record_test_duration(cache, image_name, test, duration):
+    """
+    Record the duration in seconds of the test run on the given image.
+
+    The last TEST_DURATIONS_HISTORY durations of each test are kept, so
+    that one slow run does not count too much.  They are kept in the
+    cache, as the batch.report does not say which image a test ran on.
+    """
+    durations_file = os.path.join(cache, TEST_DURATIONS)
+    with cache_lock(durations_file):
+        try:
+            with open(durations_file) as ff:
+                durations = json.load(ff)
+        except (OSError, ValueError):
+            durations = {}
+        tests = durations.setdefault(image_name, {})
+        runs = tests.get(test)
+        if not isinstance(runs, list):
+            runs = []
+        runs.append(round(duration, 1))
+        tests[test] = runs[-TEST_DURATIONS_HISTORY:]
+        with tempfile.NamedTemporaryFile("w", dir=cache, delete=False) as ff:
+            json.dump(durations, ff, indent=2, sort_keys=True)
+        os.rename(ff.name, durations_file)
+
+
+def read_batch_report(batch_report):
+    """
+    Get the return code of the last run of each playbook in the batch report.
+
+    Returns a dict of playbook path to return code, or None if there is no
+    batch report.
+    """
+    try:
+        with open(batch_report) as br:
+            lines = br.readlines()
+    except (OSError, TypeError):
+        return None
+    rcs = {}
+    for line in lines:
+        # rc start_ts end_ts [batch_id] playbook...
+        fields = line.split()
+        try:
+            rc = int(fields[0])
+        except (IndexError, ValueError):
+            continue
+        for field in fields[3:]:
+            # skip the batch_id, if any
+            if field.endswith((".yml", ".yaml")):
+                rcs[field] = rc
+    return rcs
+
+
+def order_failed_first(batches, batch_report, rerun_failed=False):
+    """
+    Put the batches which failed in the last run first.
+
+    A batch failed if one of its playbooks failed the last time it was run
+    according to @batch_report.  If @rerun_failed is True, return only the
+    batches which failed.  Cleanup batches stay with their batch.
+    """
+    rcs = read_batch_report(batch_report)
+    if rcs is None:
+        logging.warning(
+            "No batch report %s - cannot tell which batches failed",
+            batch_report,
+        )
+        return batches
+    failed = []
+    passed = []
+    for group in group_batches(batches):
+        if not group[0].cleanup and any(
+            rcs.get(pb, 0) != 0 for pb in group[0].playbooks
+        ):
+            failed.append(group)
+        else:
+            passed.append(group)
+    logging.info("%d batches failed in the last run", len(failed))
+    if not rerun_failed:
+        failed.extend(passed)
+    return [batch for group in failed for batch in group]
+
+
 def make_batch_file(
-    batch_file, tests_dir, ansible_args, image, make_batch_file_order
+    batch_file,
+    tests_dir,
+    ansible_args,
+    image,
+    make_batch_file_order,
+    durations=None,
 ):
-    """Create a batch file from the tests_*.yml."""
+    """
+    Create a batch file from the tests_*.yml.
+
+    For the longest-first order, @durations are the recorded durations of
+    the tests - see load_test_durations.
+    """
     if tests_dir is None:
         tests_dir = "tests"
     tests = glob.glob(tests_dir + "/tests_*.yml")
@@ -1129,6 +2502,16 @@ def make_batch_file(
             image["name"].encode(), usedforsecurity=False
         ).digest()
         tests = sorted(tests, reverse=bool(sha[0] & 1))
+    elif make_batch_file_order == "longest-first":
+        # tests never run before go first, as they may take the longest
+        durations = durations or {}
+        tests = sorted(
+            sorted(tests),
+            key=lambda test: durations.get(
+                os.path.basename(test), float("inf")
+            ),
+            reverse=True,
+        )
     elif make_batch_file_order != "natural":
         raise ValueError("unknown order: %s" % make_batch_file_order)
     fmtstr = "--tests-dir {} --log-file {{}} ".format(tests_dir)
@@ -1165,16 +2548,35 @@ def run_ansible_playbooks(  # noqa: C901
     make_batch,
     ansible_container,
     make_batch_file_order,
+    snapshot_max_age=0,
+    reset_vm=False,
+    parallel=0,
+    cache=None,
+    fail_fast=False,
+    failed_first=False,
+    rerun_failed=False,
 ):
-    """Run the given playbooks."""
+    """
+    Run the given playbooks.
+
+    If @cache is given, the durations of the tests are recorded there.
+    """
     test_env.update(dict(os.environ))
     orig_inventory = inventory
     ansible_args, playbooks = split_args_and_playbooks(ansible_args)
     if make_batch:
         batch_file = "batch.txt"
         batch_report = "batch.report"
+        durations = {}
+        if cache:
+            durations = load_test_durations(cache, image["name"])
         make_batch_file(
-            batch_file, tests_dir, ansible_args, image, make_batch_file_order
+            batch_file,
+            tests_dir,
+            ansible_args,
+            image,
+            make_batch_file_order,
+            durations,
         )
     batches = get_batches_from_playbooks_and_args(
         ansible_args,
@@ -1183,14 +2585,27 @@ def run_ansible_playbooks(  # noqa: C901
         cleanup_yml,
         batch_file,
     )
+    if failed_first or rerun_failed:
+        batches = order_failed_first(batches, batch_report, rerun_failed)
     batch_inventory = None
-    rc = 0
-    batch_rc = 0
     if batch_file or cleanup_yml or ansible_container:
         if not write_inventory:
             batch_inventory = tempfile.NamedTemporaryFile(suffix=".yml").name
             write_inventory = batch_inventory
         test_env["LOCK_ON_FILE"] = tempfile.NamedTemporaryFile().name
+    if reset_vm and (
+        "LOCK_ON_FILE" not in test_env or wait_on_qemu or ansible_container
+    ):
+        logging.warning(
+            "--reset-vm is only used with batches, and not with "
+            "--wait-on-qemu or --ansible-container"
+        )
+        reset_vm = False
+    control_path_base = None
+    if reset_vm:
+        # a restored VM does not know about the ssh connections opened
+        # after its state was saved, so do not reuse them
+        control_path_base = tempfile.mkdtemp()
 
     test_env["TEST_SUBJECTS"] = image["file"]
     snapfile = test_env["TEST_SUBJECTS"] + ".snap"
@@ -1200,187 +2615,541 @@ def run_ansible_playbooks(  # noqa: C901
         test_env[COLL_PATH_ENV_VAR] = collection_path
     if write_inventory:
         test_env["TEST_INVENTORY"] = write_inventory
-    for batch in batches:
-        if not batch.playbooks:
-            continue  # i.e. user specified playbooks only in batch_file
-        if batch.args and batch.args.debug:
-            test_env["TEST_DEBUG"] = "true"
-        elif debug and not batch_file:
-            test_env["TEST_DEBUG"] = "true"
-        elif "TEST_DEBUG" in test_env:
-            del test_env["TEST_DEBUG"]
-        if batch.args and batch.args.artifacts:
-            test_env["TEST_ARTIFACTS"] = batch.args.artifacts
-        elif artifacts:
-            test_env["TEST_ARTIFACTS"] = artifacts
-        elif "TEST_ARTIFACTS" not in test_env:
-            test_env["TEST_ARTIFACTS"] = "artifacts"
-        test_env["TEST_ARTIFACTS"] = os.path.abspath(
-            test_env["TEST_ARTIFACTS"]
-        )
-        if use_ansible_log and "ANSIBLE_LOG_PATH" not in os.environ:
-            test_env["ANSIBLE_LOG_PATH"] = os.path.join(
-                test_env["TEST_ARTIFACTS"], "ansible.log"
-            )
-        os.makedirs(test_env["TEST_ARTIFACTS"], exist_ok=True)
+    report_lock = threading.Lock()
+    failed = threading.Event()  # for fail_fast
 
-        if batch.args and batch.args.log_file:
-            local_log_file = os.path.abspath(batch.args.log_file)
-        elif log_file:
-            local_log_file = os.path.abspath(log_file)
-        else:
-            local_log_file = None
-
-        # the cwd for the playbook process is the directory
-        # of the first playbook - so that we can find the
-        # provision.fmf, if any - this means we have to use
-        # abs paths for the playbooks
-        if batch.args and batch.args.tests_dir:
-            cwd = batch.args.tests_dir
-        elif tests_dir:
-            cwd = tests_dir
-        else:
-            cwd = os.path.dirname(batch.playbooks[0])
-        if (
-            (batch.args and batch.args.erase_old_snapshot)
-            or erase_old_snapshot
-        ) and os.path.exists(snapfile):
-            os.unlink(snapfile)
-        if (batch.args and batch.args.use_snapshot) or use_snapshot:
-            test_env["TEST_SUBJECTS"] = snapfile
-            refresh_snapshot(
-                image["file"],
-                snapfile,
-                orig_inventory,
-                test_env,
-                batch.ansible_args,
-                batch.setup_playbooks,
-                cwd,
-                post_snap_sleep_time,
-                local_log_file,
-                ansible_container,
-            )
-            playbooks = batch.playbooks
-        else:
-            playbooks = batch.setup_playbooks + batch.playbooks
-        handle_vault(cwd, batch.ansible_args, playbooks, test_env)
-        if local_log_file:
-            logging.info("Running playbooks %s", str(playbooks))
-        last_rc = rc
+    def run_batches(  # noqa: C901
+        batches,
+        test_env,
+        inventory,
+        batch_inventory,
+        write_inventory,
+        artifacts,
+    ):
+        """
+        Run the batches one after the other in the same VM.
+
+        Returns the return code of the first batch which failed, or 0.
+        """
         rc = 0
-        start_ts = time.time()
-        try:
-            internal_run_ansible_playbooks(
-                test_env,
-                inventory,
-                batch.ansible_args,
-                playbooks,
-                cwd,
-                ansible_container,
-                wait_on_qemu,
-                local_log_file,
-                last_rc,
-                batch_rc,
+        batch_rc = 0
+        saved_state = None
+        for batch in batches:
+            if not batch.playbooks:
+                continue  # i.e. user specified playbooks only in batch_file
+            if fail_fast and failed.is_set() and not batch.cleanup:
+                logging.error("A batch failed - skipping the other batches")
+                break
+            if batch.args and batch.args.debug:
+                test_env["TEST_DEBUG"] = "true"
+            elif debug and not batch_file:
+                test_env["TEST_DEBUG"] = "true"
+            elif "TEST_DEBUG" in test_env:
+                del test_env["TEST_DEBUG"]
+            if batch.args and batch.args.artifacts:
+                test_env["TEST_ARTIFACTS"] = batch.args.artifacts
+            elif artifacts:
+                test_env["TEST_ARTIFACTS"] = artifacts
+            elif "TEST_ARTIFACTS" not in test_env:
+                test_env["TEST_ARTIFACTS"] = "artifacts"
+            test_env["TEST_ARTIFACTS"] = os.path.abspath(
+                test_env["TEST_ARTIFACTS"]
             )
-            if local_log_file:
-                logging.info("Playbook run was successful")
-        except subprocess.CalledProcessError as cpe:
-            rc = cpe.returncode
-            if batch_rc == 0:
-                batch_rc = rc
-            if local_log_file:
-                logging.error("Playbook run failed with error %d", rc)
-        if batch_report:
-            if batch.args and batch.args.batch_id:
-                batch_id_str = " " + batch.args.batch_id
+            if use_ansible_log and "ANSIBLE_LOG_PATH" not in os.environ:
+                test_env["ANSIBLE_LOG_PATH"] = os.path.join(
+                    test_env["TEST_ARTIFACTS"], "ansible.log"
+                )
+            os.makedirs(test_env["TEST_ARTIFACTS"], exist_ok=True)
+
+            if batch.args and batch.args.log_file:
+                local_log_file = os.path.abspath(batch.args.log_file)
+            elif log_file:
+                local_log_file = os.path.abspath(log_file)
             else:
-                batch_id_str = ""
-            with open(batch_report, "a") as br:
-                br.write(
-                    "%d %f %f%s %s\n"
-                    % (
-                        rc,
-                        start_ts,
-                        time.time(),
-                        batch_id_str,
-                        " ".join(playbooks),
+                local_log_file = None
+
+            # the cwd for the playbook process is the directory
+            # of the first playbook - so that we can find the
+            # provision.fmf, if any - this means we have to use
+            # abs paths for the playbooks
+            if batch.args and batch.args.tests_dir:
+                cwd = batch.args.tests_dir
+            elif tests_dir:
+                cwd = tests_dir
+            else:
+                cwd = os.path.dirname(batch.playbooks[0])
+            if (
+                (batch.args and batch.args.erase_old_snapshot)
+                or erase_old_snapshot
+            ) and os.path.exists(snapfile):
+                os.unlink(snapfile)
+            if (batch.args and batch.args.use_snapshot) or use_snapshot:
+                test_env["TEST_SUBJECTS"] = snapfile
+                refresh_snapshot(
+                    image["file"],
+                    snapfile,
+                    orig_inventory,
+                    test_env,
+                    batch.ansible_args,
+                    batch.setup_playbooks,
+                    cwd,
+                    post_snap_sleep_time,
+                    local_log_file,
+                    ansible_container,
+                    snapshot_max_age,
+                )
+                playbooks = batch.playbooks
+            else:
+                playbooks = batch.setup_playbooks + batch.playbooks
+            handle_vault(cwd, batch.ansible_args, playbooks, test_env)
+            batch_playbooks = playbooks
+            vm_booted = False
+            if reset_vm:
+                # every batch starts with the VM as it was right after the
+                # setup - restore the saved state, or if that fails, boot a
+                # new VM and run the setup in it
+                setup_playbooks = playbooks[: -len(batch.playbooks)]
+                # handle_vault changes batch.ansible_args in place - the
+                # key must not change with it
+                reset_key = (
+                    os.path.abspath(test_env["TEST_SUBJECTS"]),
+                    tuple(setup_playbooks),
+                    tuple(batch.ansible_args),
+                )
+                batch_playbooks = batch.playbooks
+                test_env["ANSIBLE_SSH_CONTROL_PATH_DIR"] = tempfile.mkdtemp(
+                    dir=control_path_base
+                )
+                if os.path.exists(test_env["LOCK_ON_FILE"]) and not (
+                    saved_state == reset_key
+                    and restore_vm(test_env, inventory, local_log_file)
+                ):
+                    stop_qemu(test_env)
+                    test_env["LOCK_ON_FILE"] = (
+                        tempfile.NamedTemporaryFile().name
                     )
+                    saved_state = None
+                if not os.path.exists(test_env["LOCK_ON_FILE"]):
+                    boot_vm(
+                        orig_inventory,
+                        test_env,
+                        write_inventory,
+                        cwd,
+                        local_log_file,
+                    )
+                    inventory = write_inventory
+                    vm_booted = True
+            if local_log_file:
+                logging.info("Running playbooks %s", str(playbooks))
+            last_rc = rc
+            rc = 0
+            start_ts = time.time()
+            test_start_ts = start_ts
+            try:
+                if vm_booted:
+                    if setup_playbooks:
+                        internal_run_ansible_playbooks(
+                            test_env,
+                            inventory,
+                            batch.ansible_args,
+                            setup_playbooks,
+                            cwd,
+                            ansible_container,
+                            log_file=local_log_file,
+                            last_rc=last_rc,
+                            batch_rc=batch_rc,
+                        )
+                    if save_vm(test_env):
+                        saved_state = reset_key
+                    test_start_ts = time.time()
+                internal_run_ansible_playbooks(
+                    test_env,
+                    inventory,
+                    batch.ansible_args,
+                    batch_playbooks,
+                    cwd,
+                    ansible_container,
+                    wait_on_qemu,
+                    local_log_file,
+                    last_rc,
+                    batch_rc,
                 )
-        if batch_inventory:
-            inventory = batch_inventory
-            if "TEST_INVENTORY" in test_env:
-                del test_env["TEST_INVENTORY"]
-    stop_qemu(test_env)
+                if local_log_file:
+                    logging.info("Playbook run was successful")
+            except subprocess.CalledProcessError as cpe:
+                rc = cpe.returncode
+                if batch_rc == 0:
+                    batch_rc = rc
+                failed.set()
+                if local_log_file:
+                    logging.error("Playbook run failed with error %d", rc)
+            if batch_report:
+                if batch.args and batch.args.batch_id:
+                    batch_id_str = " " + batch.args.batch_id
+                else:
+                    batch_id_str = ""
+                with report_lock, open(batch_report, "a") as br:
+                    br.write(
+                        "%d %f %f%s %s\n"
+                        % (
+                            rc,
+                            start_ts,
+                            time.time(),
+                            batch_id_str,
+                            " ".join(playbooks),
+                        )
+                    )
+            if (
+                cache
+                and rc == 0
+                and not batch.cleanup
+                and len(batch.playbooks) == 1
+            ):
+                # the first batch in a VM also boots it - the inventory
+                # writes LOCK_ON_FILE once the VM is up
+                lock_on_file = test_env.get("LOCK_ON_FILE")
+                if lock_on_file and os.path.exists(lock_on_file):
+                    test_start_ts = max(
+                        test_start_ts, os.stat(lock_on_file).st_mtime
+                    )
+                record_test_duration(
+                    cache,
+                    image["name"],
+                    os.path.basename(batch.playbooks[0]),
+                    time.time() - test_start_ts,
+                )
+            if batch_inventory:
+                inventory = batch_inventory
+                if "TEST_INVENTORY" in test_env:
+                    del test_env["TEST_INVENTORY"]
+        stop_qemu(test_env)
+        return batch_rc
+
+    if parallel > 1 and batch_file:
+        if write_inventory != batch_inventory:
+            logging.warning("--write-inventory is not used with --parallel")
+        # erase the snapshot only once, not in every VM
+        if erase_old_snapshot and os.path.exists(snapfile):
+            os.unlink(snapfile)
+        erase_old_snapshot = False
+        work = queue.Queue()
+        for group in group_batches(batches):
+            work.put(group)
+
+        def run_worker(num):
+            """Run batches from the queue in VM number num."""
+            worker_env = dict(test_env)
+            worker_env["LOCK_ON_FILE"] = tempfile.NamedTemporaryFile().name
+            worker_inventory = tempfile.NamedTemporaryFile(suffix=".yml").name
+            worker_env["TEST_INVENTORY"] = worker_inventory
+            for key in ("TEST_YUM_CACHE_PATHS", "TEST_YUM_VARLIB_PATHS"):
+                if key in worker_env:
+                    # the raw cache disks cannot be shared between VMs
+                    worker_env[key] += ".%d" % num
+            worker_artifacts = os.path.join(
+                artifacts or test_env.get("TEST_ARTIFACTS", "artifacts"),
+                "vm%d" % num,
+            )
+            try:
+                return run_batches(
+                    get_queued_batches(work),
+                    worker_env,
+                    orig_inventory,
+                    worker_inventory,
+                    worker_inventory,
+                    worker_artifacts,
+                )
+            finally:
+                if os.path.exists(worker_inventory):
+                    os.unlink(worker_inventory)
+
+        logging.info("Running batches in %d VMs", parallel)
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            rcs = list(executor.map(run_worker, range(parallel)))
+        batch_rc = next((rc for rc in rcs if rc), 0)
+    else:
+        batch_rc = run_batches(
+            batches,
+            test_env,
+            inventory,
+            batch_inventory,
+            write_inventory,
+            artifacts,
+        )
+    if control_path_base:
+        shutil.rmtree(control_path_base, ignore_errors=True)
     if batch_inventory and os.path.exists(batch_inventory):
         os.unlink(batch_inventory)
     if batch_rc != 0:
         raise Exception("One or more tests failed")
 
 
-def install_requirements(sourcedir, collection_path, test_env, collection):
-    """Install reqs from {meta,tests}/collection-requirements.yml, if any."""
-    collection_save_file = None
-    if collection:
-        save_collection = os.path.join(
-            collection_path,
-            "ansible_collections",
-            COLLECTION_NAMESPACE,
-            COLLECTION_NAME,
-        )
-        if os.path.exists(save_collection):
-            # ansible-galaxy collection install will overwrite
-            # fedora/linux_system_roles
-            # so we have to save a copy and restore it later
-            collection_save_file = os.path.join(
-                collection_path, "collection.save.tar"
-            )
-            subprocess.check_call(  # nosec
-                [
-                    "tar",
-                    "cfP",
-                    collection_save_file,
-                    save_collection,
-                ]
-            )
-    coll_rqf = os.path.join(sourcedir, "meta", "collection-requirements.yml")
-    tests_rqf = os.path.join(sourcedir, "tests", "collection-requirements.yml")
+def get_collection_cache():
+    """
+    Return the dir of the collection cache shared by all tox envs.
+
+    The cache is disabled if LSR_COLLECTION_CACHE is set to an empty string.
+    """
+    return os.environ.get(
+        "LSR_COLLECTION_CACHE",
+        os.path.join(
+            os.environ["HOME"], ".cache", "linux-system-roles", "collections"
+        ),
+    )
+
+
+def get_collection_cache_key(reqfiles):
+    """
+    Return the key of the cache entry for the given requirements files.
+
+    The key is the hash of the requirements and of the ansible-core version,
+    computed the same way as lsr_galaxy_install_cached in utils.sh, so that
+    the shell scripts and runqemu share the cache entries.
+    """
+    sha = hashlib.sha256()
+    for reqfile in reqfiles:
+        with open(reqfile, "rb") as ff:
+            sha.update(ff.read())
+    ansible_version = subprocess.check_output(  # nosec
+        ["ansible", "--version"], universal_newlines=True
+    ).splitlines()[0]
+    sha.update((ansible_version + "\n").encode("utf-8"))
+    return sha.hexdigest()
+
+
+def galaxy_install_requirements(reqfiles, collection_path, collections=None):
+    """
+    Install the collections in reqfiles into collection_path.
+
+    collections are additional collections to install, e.g. ansible.posix.
+    If LSR_COLLECTION_MIRROR is set, the collections are installed from the
+    tarballs in that directory instead of from Galaxy.
+    """
     galaxy_env = {}
     galaxy_env.update(dict(os.environ))
     galaxy_env[COLL_PATH_ENV_VAR] = collection_path
-    for reqfile in [coll_rqf, tests_rqf]:
-        if os.path.isfile(reqfile):
-            ag_cmd = [
-                "ansible-galaxy",
-                "collection",
-                "install",
-                get_galaxy_force_flag(),
-                "-p",
-                collection_path,
-                "-vv",
-                "-r",
-                reqfile,
-            ]
+    ag_cmd = [
+        "ansible-galaxy",
+        "collection",
+        "install",
+        get_galaxy_force_flag(),
+        "-p",
+        collection_path,
+        "-vv",
+    ]
+    mirror = os.environ.get("LSR_COLLECTION_MIRROR")
+    if mirror:
+        mirror_reqfile = tempfile.NamedTemporaryFile(suffix=".yml").name
+        lsr_collection_mirror.write_requirements(
+            mirror, reqfiles, collections or [], mirror_reqfile
+        )
+        # the dependencies are in mirror_reqfile too
+        ag_cmds = [ag_cmd + ["--no-deps", "-r", mirror_reqfile]]
+    else:
+        mirror_reqfile = None
+        ag_cmds = [ag_cmd + ["-r", reqfile] for reqfile in reqfiles]
+        ag_cmds.extend(ag_cmd + [coll] for coll in collections or [])
+    try:
+        for cmd in ag_cmds:
             subprocess.check_call(  # nosec
-                ag_cmd,
+                cmd,
                 stdout=sys.stdout,
                 stderr=sys.stderr,
                 env=galaxy_env,
             )
-            test_env[COLL_PATH_ENV_VAR] = collection_path
-    if collection_save_file:
-        subprocess.check_call(  # nosec
-            [
-                "tar",
-                "xfP",
-                collection_save_file,
-                "--overwrite",
-            ]
+    finally:
+        if mirror_reqfile and os.path.exists(mirror_reqfile):
+            os.unlink(mirror_reqfile)
+
+
+def copy_collections(src_path, collection_path, keep=None):
+    """
+    Copy the collections installed in src_path into collection_path.
+
+    Collections already in collection_path are replaced, except for the
+    collection keep, given as a (namespace, name) tuple, if it exists.
+    """
+    src_root = os.path.join(src_path, "ansible_collections")
+    dest_root = os.path.join(collection_path, "ansible_collections")
+    if not os.path.isdir(src_root):
+        return
+    copies = []
+    for top in os.listdir(src_root):
+        src_top = os.path.join(src_root, top)
+        if "." in top or not os.path.isdir(src_top):
+            # e.g. the namespace.name-version.info dirs
+            copies.append((src_top, os.path.join(dest_root, top)))
+            continue
+        for name in os.listdir(src_top):
+            dest = os.path.join(dest_root, top, name)
+            if (top, name) == keep and os.path.exists(dest):
+                logging.info("Keeping the installed collection %s", dest)
+                continue
+            copies.append((os.path.join(src_top, name), dest))
+    for src, dest in copies:
+        if os.path.isdir(dest) and not os.path.islink(dest):
+            shutil.rmtree(dest)
+        elif os.path.lexists(dest):
+            os.unlink(dest)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        if os.path.isdir(src):
+            shutil.copytree(src, dest, symlinks=True)
+        else:
+            shutil.copy2(src, dest)
+
+
+def install_cached_collections(reqfiles, collection_path, keep=None):
+    """
+    Install the collections in reqfiles into collection_path.
+
+    The collections are installed from Galaxy only once for each set of
+    requirements and ansible-core version into the collection cache, and
+    are copied from there.  The cache entry is updated from Galaxy when it
+    is older than LSR_COLLECTION_CACHE_MAX_AGE hours, as the requirements
+    usually do not pin the versions of the collections.
+    """
+    collection_cache = get_collection_cache()
+    if not collection_cache:
+        tmpdir = tempfile.mkdtemp()
+        try:
+            galaxy_install_requirements(reqfiles, tmpdir)
+            copy_collections(tmpdir, collection_path, keep)
+        finally:
+            shutil.rmtree(tmpdir)
+        return
+    os.makedirs(collection_cache, exist_ok=True)
+    entry = os.path.join(collection_cache, get_collection_cache_key(reqfiles))
+    max_age = int(
+        os.environ.get(
+            "LSR_COLLECTION_CACHE_MAX_AGE", str(COLLECTION_CACHE_MAX_AGE)
+        )
+    )
+    with cache_lock(entry):
+        if not os.path.isdir(entry) or (
+            max_age > 0
+            and time.time() - os.stat(entry).st_mtime > max_age * 3600
+        ):
+            logging.info("Installing collections into cache %s", entry)
+            tmp_entry = entry + ".tmp"
+            if os.path.exists(tmp_entry):
+                shutil.rmtree(tmp_entry)
+            os.makedirs(tmp_entry)
+            galaxy_install_requirements(reqfiles, tmp_entry)
+            if os.path.exists(entry):
+                shutil.rmtree(entry)
+            os.rename(tmp_entry, entry)
+        else:
+            logging.info("Using collections from cache %s", entry)
+        copy_collections(entry, collection_path, keep)
+
+
+def install_requirements(sourcedir, collection_path, test_env, collection):
+    """Install reqs from {meta,tests}/collection-requirements.yml, if any."""
+    coll_rqf = os.path.join(sourcedir, "meta", "collection-requirements.yml")
+    tests_rqf = os.path.join(sourcedir, "tests", "collection-requirements.yml")
+    reqfiles = [rqf for rqf in [coll_rqf, tests_rqf] if os.path.isfile(rqf)]
+    if not reqfiles:
+        return
+    # ansible-galaxy collection install would overwrite
+    # fedora/linux_system_roles with the one from Galaxy
+    if collection:
+        keep = (COLLECTION_NAMESPACE, COLLECTION_NAME)
+    else:
+        keep = None
+    install_cached_collections(reqfiles, collection_path, keep)
+    test_env[COLL_PATH_ENV_VAR] = collection_path
+
+
+def install_callback_plugins(tmpdir, dest_dir, plugins):
+    """Install the callback plugins from ansible.posix into dest_dir."""
+    galaxy_install_requirements(
+        [],
+        tmpdir,
+        [os.environ.get("LSR_ANSIBLE_POSIX_VERSION", "ansible.posix")],
+    )
+    for plugin in plugins:
+        os.rename(
+            os.path.join(
+                tmpdir,
+                "ansible_collections",
+                "ansible",
+                "posix",
+                "plugins",
+                "callback",
+                plugin,
+            ),
+            os.path.join(dest_dir, plugin),
+        )
+    shutil.rmtree(os.path.join(tmpdir, "ansible_collections"))
+
+
+def link_cached_callback_plugins(callback_plugin_dir, plugins):
+    """
+    Link the callback plugins in the collection cache into the plugin dir.
+
+    The plugins are installed into the cache only once for each
+    LSR_ANSIBLE_POSIX_VERSION, instead of once for each tox work dir, and
+    are updated like the cached collections.  The links are updated every
+    time, so that each tox env uses the plugins from its own
+    LSR_ANSIBLE_POSIX_VERSION.
+    """
+    posix_version = os.environ.get(
+        "LSR_ANSIBLE_POSIX_VERSION", "ansible.posix"
+    )
+    entry = os.path.join(
+        get_collection_cache(),
+        CALLBACK_PLUGIN_CACHE_DIR,
+        "%s-%s"
+        % (
+            re.sub(r"[^A-Za-z0-9_.-]", "_", posix_version),
+            hashlib.sha256(posix_version.encode("utf-8")).hexdigest()[:12],
+        ),
+    )
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+    max_age = int(
+        os.environ.get(
+            "LSR_COLLECTION_CACHE_MAX_AGE", str(COLLECTION_CACHE_MAX_AGE)
         )
-        os.unlink(collection_save_file)
+    )
+    with cache_lock(entry):
+        if not os.path.isdir(entry) or (
+            max_age > 0
+            and time.time() - os.stat(entry).st_mtime > max_age * 3600
+        ):
+            logging.info("Installing callback plugins into cache %s", entry)
+            tmp_entry = entry + ".tmp"
+            if os.path.exists(tmp_entry):
+                shutil.rmtree(tmp_entry)
+            os.makedirs(tmp_entry)
+            install_callback_plugins(
+                tmp_entry, tmp_entry, ["debug.py", "profile_tasks.py"]
+            )
+            if os.path.exists(entry):
+                shutil.rmtree(entry)
+            os.rename(tmp_entry, entry)
+    for plugin in plugins:
+        plugin_link = os.path.join(callback_plugin_dir, plugin)
+        link_tmp = plugin_link + ".%d.link" % os.getpid()
+        if os.path.lexists(link_tmp):
+            os.unlink(link_tmp)
+        os.symlink(os.path.join(entry, plugin), link_tmp)
+        os.rename(link_tmp, plugin_link)
+
 
+def setup_callback_plugins(
+    pretty,
+    profile,
+    profile_task_limit,
+    test_env,
+    timing_db=None,
+    image_name=None,
+):
+    """
+    Install and configure debug and profile_tasks.
 
-def setup_callback_plugins(pretty, profile, profile_task_limit, test_env):
-    """Install and configure debug and profile_tasks."""
+    If @timing_db is given, also the lsr_timing callback, which records the
+    durations of the playbooks and tasks run on @image_name in @timing_db.
+    """
     if (
         "ANSIBLE_CALLBACK_PLUGINS" in os.environ
         or "ANSIBLE_CALLBACK_WHITELIST" in os.environ
@@ -1390,65 +3159,42 @@ def setup_callback_plugins(pretty, profile, profile_task_limit, test_env):
     if not pretty and not profile:
         return
     callback_plugin_dir = get_callback_plugin_dir(test_env)
-    galaxy_env = {}
-    galaxy_env.update(dict(os.environ))
-    galaxy_env[COLL_PATH_ENV_VAR] = os.environ["LSR_TOX_ENV_TMP_DIR"]
-    debug_py = os.path.join(callback_plugin_dir, "debug.py")
-    profile_py = os.path.join(callback_plugin_dir, "profile_tasks.py")
-    if (pretty and not os.path.isfile(debug_py)) or (
-        profile and not os.path.isfile(profile_py)
-    ):
-        subprocess.check_call(  # nosec
-            [
-                "ansible-galaxy",
-                "collection",
-                "install",
-                "-p",
-                os.environ["LSR_TOX_ENV_TMP_DIR"],
-                "-vv",
-                get_galaxy_force_flag(),
-                os.environ.get("LSR_ANSIBLE_POSIX_VERSION", "ansible.posix"),
-            ],
-            stdout=sys.stdout,
-            stderr=sys.stderr,
-            env=galaxy_env,
-        )
-        tmp_debug_py = os.path.join(
-            os.environ["LSR_TOX_ENV_TMP_DIR"],
-            "ansible_collections",
-            "ansible",
-            "posix",
-            "plugins",
-            "callback",
-            "debug.py",
-        )
-        tmp_profile_py = os.path.join(
-            os.environ["LSR_TOX_ENV_TMP_DIR"],
-            "ansible_collections",
-            "ansible",
-            "posix",
-            "plugins",
-            "callback",
-            "profile_tasks.py",
-        )
-        if pretty:
-            if not os.path.isfile(debug_py):
-                os.rename(tmp_debug_py, debug_py)
-        if profile:
-            if not os.path.isfile(profile_py):
-                os.rename(tmp_profile_py, profile_py)
-        shutil.rmtree(
-            os.path.join(
-                os.environ["LSR_TOX_ENV_TMP_DIR"], "ansible_collections"
+    plugins = []
+    if pretty:
+        plugins.append("debug.py")
+    if profile:
+        plugins.append("profile_tasks.py")
+    if get_collection_cache():
+        link_cached_callback_plugins(callback_plugin_dir, plugins)
+    else:
+        plugins = [
+            plugin
+            for plugin in plugins
+            if not os.path.isfile(os.path.join(callback_plugin_dir, plugin))
+        ]
+        if plugins:
+            install_callback_plugins(
+                os.environ["LSR_TOX_ENV_TMP_DIR"], callback_plugin_dir, plugins
             )
-        )
     if pretty:
         test_env["ANSIBLE_STDOUT_CALLBACK"] = "debug"
     if profile:
+        callbacks = "profile_tasks"
+        if timing_db:
+            shutil.copy(
+                os.path.join(
+                    os.path.dirname(os.path.abspath(__file__)),
+                    "lsr_timing.py",
+                ),
+                callback_plugin_dir,
+            )
+            callbacks += ",lsr_timing"
+            test_env["LSR_TIMING_DB"] = os.path.abspath(timing_db)
+            test_env["LSR_TIMING_IMAGE"] = image_name or ""
         if is_ansible_env_var_supported("ANSIBLE_CALLBACKS_ENABLED"):
-            test_env["ANSIBLE_CALLBACKS_ENABLED"] = "profile_tasks"
+            test_env["ANSIBLE_CALLBACKS_ENABLED"] = callbacks
         else:
-            test_env["ANSIBLE_CALLBACK_WHITELIST"] = "profile_tasks"
+            test_env["ANSIBLE_CALLBACK_WHITELIST"] = callbacks
         if profile_task_limit > -1:
             val = str(profile_task_limit)
             test_env["PROFILE_TASKS_TASK_OUTPUT_LIMIT"] = val
@@ -1488,6 +3234,18 @@ def runqemu(
     lsr_report_errors_url=None,
     skip_requirements=False,
     skip_callback_plugins=False,
+    cache_max_size=0,
+    download_connections=DEFAULT_DOWNLOAD_CONNECTIONS,
+    offline=False,
+    image_url_ttl=DEFAULT_IMAGE_URL_TTL,
+    refresh_image_urls=False,
+    snapshot_max_age=0,
+    reset_vm=False,
+    parallel=0,
+    fail_fast=False,
+    failed_first=False,
+    rerun_failed=False,
+    timing_db=None,
 ):
     """Download the image, set up, run playbooks."""
     if write_inventory:
@@ -1500,65 +3258,300 @@ def runqemu(
             errmsg = fmtstr.format(write_inventory)
             logging.critical(errmsg)
             raise Exception(errmsg)
-    download_image(image, cache)
-    pre_setup_yml, post_setup_yml = make_setup_yml(
-        image, cache, remove_cloud_init, use_snapshot, use_yum_cache
-    )
-    local_setup_yml = []
-    if pre_setup_yml:
-        local_setup_yml.append(pre_setup_yml)
-    if setup_yml:
-        local_setup_yml.extend(setup_yml)
-    if post_setup_yml:
-        local_setup_yml.append(post_setup_yml)
-    local_cleanup_yml = []
-    if cleanup_yml:
-        local_cleanup_yml.extend(cleanup_yml)
-    if collection_path is None and "TOX_WORK_DIR" in os.environ:
-        collection_path = os.environ["TOX_WORK_DIR"]
-    test_env = dict(image.get("env", {}))
-    # failures in inventory will force ansible-playbook to fail
-    test_env["ANSIBLE_INVENTORY_ANY_UNPARSED_IS_FAILED"] = "true"
-    # disable inject fact vars by default - will be overridden by env if set
-    test_env["ANSIBLE_INJECT_FACT_VARS"] = "false"
-    if use_yum_cache:
-        yum_cache_path = os.path.join(cache, image["name"] + "_yum_cache")
-        test_env["TEST_YUM_CACHE_PATHS"] = yum_cache_path
-        yum_varlib_path = os.path.join(cache, image["name"] + "_yum_varlib")
-        test_env["TEST_YUM_VARLIB_PATHS"] = yum_varlib_path
-    if not skip_requirements:
-        install_requirements(sourcedir, collection_path, test_env, collection)
-    inventory = get_inventory_script(inventory)
-    if not skip_callback_plugins:
-        setup_callback_plugins(pretty, profile, profile_task_limit, test_env)
-    get_lsr_report_errors_script(lsr_report_errors_url, test_env)
-    if ansible_args is None:
-        ansible_args = []
-    run_ansible_playbooks(
-        image,
-        local_setup_yml,
-        local_cleanup_yml,
-        test_env,
-        debug,
-        image_alias,
-        collection_path,
-        artifacts,
-        ansible_args,
-        use_snapshot,
-        inventory,
-        use_ansible_log,
-        wait_on_qemu,
-        write_inventory,
-        erase_old_snapshot,
-        post_snap_sleep_time,
-        batch_file,
-        batch_report,
-        log_file,
-        tests_dir,
-        make_batch,
-        ansible_container,
-        make_batch_file_order,
+    with ExitStack() as in_use:
+        download_image(
+            image,
+            cache,
+            cache_max_size,
+            download_connections,
+            offline,
+            image_url_ttl,
+            refresh_image_urls,
+            in_use,
+        )
+        local_setup_yml = get_setup_playbooks(
+            image,
+            cache,
+            remove_cloud_init,
+            use_snapshot,
+            use_yum_cache,
+            setup_yml,
+        )
+        local_cleanup_yml = []
+        if cleanup_yml:
+            local_cleanup_yml.extend(cleanup_yml)
+        if collection_path is None and "TOX_WORK_DIR" in os.environ:
+            collection_path = os.environ["TOX_WORK_DIR"]
+        test_env = make_test_env(image, cache, use_yum_cache)
+        if not skip_requirements:
+            install_requirements(
+                sourcedir, collection_path, test_env, collection
+            )
+        inventory = get_inventory_script(inventory)
+        if not skip_callback_plugins:
+            setup_callback_plugins(
+                pretty,
+                profile,
+                profile_task_limit,
+                test_env,
+                timing_db,
+                image["name"],
+            )
+        get_lsr_report_errors_script(lsr_report_errors_url, test_env)
+        if ansible_args is None:
+            ansible_args = []
+        run_ansible_playbooks(
+            image,
+            local_setup_yml,
+            local_cleanup_yml,
+            test_env,
+            debug,
+            image_alias,
+            collection_path,
+            artifacts,
+            ansible_args,
+            use_snapshot,
+            inventory,
+            use_ansible_log,
+            wait_on_qemu,
+            write_inventory,
+            erase_old_snapshot,
+            post_snap_sleep_time,
+            batch_file,
+            batch_report,
+            log_file,
+            tests_dir,
+            make_batch,
+            ansible_container,
+            make_batch_file_order,
+            snapshot_max_age,
+            reset_vm,
+            parallel,
+            cache,
+            fail_fast,
+            failed_first,
+            rerun_failed,
+        )
+
+
+def get_timing_db(args):
+    """Get the lsr_timing database from the args."""
+    return args.timing_db or os.path.join(args.cache, TIMING_DB)
+
+
+def find_regressions(rows):
+    """
+    Find the keys whose last duration is much longer than the earlier ones.
+
+    @rows are (key, duration) in the order they were run.  Returns a list
+    of (increase, key, average of earlier durations, last duration), the
+    largest increase first.
+    """
+    durations = {}
+    for key, duration in rows:
+        durations.setdefault(key, []).append(duration)
+    regressions = []
+    for key, values in durations.items():
+        if len(values) < 2:
+            continue
+        last = values[-1]
+        average = sum(values[:-1]) / (len(values) - 1)
+        increase = last - average
+        if (
+            last > average * TIMING_REGRESSION_FACTOR
+            and increase >= TIMING_REGRESSION_MIN
+        ):
+            regressions.append((increase, key, average, last))
+    return sorted(regressions, reverse=True)
+
+
+def timing_report(
+    timing_db, image_name=None, limit=DEFAULT_PROFILE_TASK_LIMIT
+):
+    """
+    Print a report of the durations recorded by lsr_timing in @timing_db.
+
+    The report has the playbooks and tasks which took much longer the last
+    time they were run than on average, and the slowest tasks.  Only the
+    playbooks which did not fail are used.  If @image_name is given, only
+    the runs on that image are used.
+    """
+    if not os.path.exists(timing_db):
+        logging.critical("No timing database %s", timing_db)
+        sys.exit(1)
+    # the image filter is a parameter too, so that the queries are fixed
+    params = [image_name, image_name]
+    conn = sqlite3.connect(timing_db, timeout=60)
+    try:
+        playbook_rows = conn.execute(
+            "SELECT p.image, p.playbook, p.ansible_version, p.duration "
+            "FROM playbooks p "
+            "WHERE p.failed = 0 AND (? IS NULL OR p.image = ?) "
+            "ORDER BY p.start",
+            params,
+        ).fetchall()
+        task_rows = conn.execute(
+            "SELECT p.image, p.ansible_version, t.path, t.name, t.duration "
+            "FROM tasks t JOIN playbooks p ON t.playbook_id = p.id "
+            "WHERE p.failed = 0 AND (? IS NULL OR p.image = ?) "
+            "ORDER BY p.start",
+            params,
+        ).fetchall()
+        slowest = conn.execute(
+            "SELECT t.name, t.path, COUNT(*), AVG(t.duration), "
+            "MAX(t.duration) FROM tasks t "
+            "JOIN playbooks p ON t.playbook_id = p.id "
+            "WHERE p.failed = 0 AND (? IS NULL OR p.image = ?) "
+            "GROUP BY t.path, t.name ORDER BY AVG(t.duration) DESC "
+            "LIMIT ?",
+            params + [limit],
+        ).fetchall()
+    finally:
+        conn.close()
+    print("Playbooks slower in their last run than on average:")
+    for increase, key, average, last in find_regressions(
+        (row[:3], row[3]) for row in playbook_rows
+    )[:limit]:
+        print(
+            "  +%.1fs %.1fs -> %.1fs %s on %s with ansible-core %s"
+            % ((increase, average, last, key[1], key[0], key[2]))
+        )
+    print("Tasks slower in their last run than on average:")
+    for increase, key, average, last in find_regressions(
+        (row[:4], row[4]) for row in task_rows
+    )[:limit]:
+        print(
+            "  +%.1fs %.1fs -> %.1fs %s (%s) on %s with ansible-core %s"
+            % ((increase, average, last, key[3], key[2], key[0], key[1]))
+        )
+    print("Slowest tasks:")
+    for name, path, count, average, longest in slowest:
+        print(
+            "  %.1fs average %.1fs longest %d runs %s (%s)"
+            % (average, longest, count, name, path)
+        )
+
+
+def get_prewarm_jobs():
+    """Get the number of snapshots which can be created at the same time."""
+    cpus = os.cpu_count() or 1
+    try:
+        memory = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError):
+        memory = PREWARM_VM_MEMORY
+    # the setup is mostly waiting for the network, but each VM is started
+    # with all of the host cores, so do not use all of them
+    return max(1, min(cpus // 2, memory // PREWARM_VM_MEMORY))
+
+
+def prewarm_image(image, args, inventory, download_slots, snapshot_slots):
+    """Download the image and create its snapshot."""
+    with ExitStack() as in_use:
+        with download_slots:
+            download_image(
+                image,
+                args.cache,
+                parse_size(args.cache_max_size),
+                args.download_connections,
+                args.offline,
+                args.image_url_ttl,
+                args.refresh_image_urls,
+                in_use,
+            )
+        setup_yml = get_setup_playbooks(
+            image,
+            args.cache,
+            args.remove_cloud_init,
+            True,
+            args.use_yum_cache,
+            args.setup_yml,
+        )
+        snapfile = image["file"] + ".snap"
+        test_env = make_test_env(image, args.cache, args.use_yum_cache)
+        test_env.update(dict(os.environ))
+        test_env["TEST_SUBJECTS"] = snapfile
+        test_env["TEST_ARTIFACTS"] = os.path.abspath(
+            os.path.join(
+                args.artifacts or "artifacts", "prewarm-" + image["name"]
+            )
+        )
+        os.makedirs(test_env["TEST_ARTIFACTS"], exist_ok=True)
+        log_file = os.path.join(test_env["TEST_ARTIFACTS"], "prewarm.log")
+        if args.erase_old_snapshot and os.path.exists(snapfile):
+            os.unlink(snapfile)
+        ansible_args, _ = split_args_and_playbooks(args.ansible_args)
+        with snapshot_slots:
+            logging.info("Prewarming snapshot %s - see %s", snapfile, log_file)
+            refresh_snapshot(
+                image["file"],
+                snapfile,
+                inventory,
+                test_env,
+                ansible_args,
+                setup_yml,
+                args.cache,
+                args.post_snap_sleep_time,
+                log_file,
+                args.ansible_container,
+                args.snapshot_max_age,
+            )
+
+
+def prewarm(args):
+    """
+    Download the images in the config and create their snapshots.
+
+    If --image-name is given, it is a comma separated list of shell style
+    patterns of the images to use.  The images are downloaded at the same
+    time, and up to --prewarm-jobs snapshots are created at the same time.
+    """
+    images, _ = load_images_config(args)
+    # some images are only for containers or other clouds
+    images = [
+        image
+        for image in images
+        if any(key in image for key in ("source", "compose", "centoshtml"))
+    ]
+    if args.image_name:
+        patterns = args.image_name.split(",")
+        images = [
+            image
+            for image in images
+            if any(fnmatch.fnmatch(image["name"], pat) for pat in patterns)
+        ]
+    if not images:
+        logging.critical("No images to prewarm in config %s", args.config)
+        sys.exit(1)
+    jobs = args.prewarm_jobs or get_prewarm_jobs()
+    logging.info(
+        "Prewarming images %s - %d snapshots at a time",
+        ", ".join(image["name"] for image in images),
+        jobs,
     )
+    inventory = get_inventory_script(args.inventory)
+    download_slots = threading.BoundedSemaphore(PREWARM_DOWNLOADS)
+    snapshot_slots = threading.BoundedSemaphore(jobs)
+    failed = []
+    with ThreadPoolExecutor(max_workers=len(images)) as executor:
+        futures = {
+            image["name"]: executor.submit(
+                prewarm_image,
+                image,
+                args,
+                inventory,
+                download_slots,
+                snapshot_slots,
+            )
+            for image in images
+        }
+        for name, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                logging.error("Prewarming image %s failed", name, exc_info=e)
+                failed.append(name)
+    if failed:
+        raise Exception("Prewarming failed for images " + ", ".join(failed))
 
 
 def help_epilog():
@@ -1593,6 +3586,100 @@ def get_arg_parser():
         ),
         help="Directory for caching VM images",
     )
+    parser.add_argument(
+        "--cache-max-size",
+        default=os.environ.get("LSR_QEMU_CACHE_MAX_SIZE", "0"),
+        help=(
+            "Maximum disk space for the downloaded images in the cache "
+            "e.g. 20G.  The least recently used images are removed "
+            "when the cache is larger.  The default 0 means no limit."
+        ),
+    )
+    parser.add_argument(
+        "--download-connections",
+        type=int,
+        default=int(
+            os.environ.get(
+                "LSR_QEMU_DOWNLOAD_CONNECTIONS",
+                str(DEFAULT_DOWNLOAD_CONNECTIONS),
+            )
+        ),
+        help=(
+            "Number of parallel connections to use to download an image, "
+            "if the server supports range requests (default: 4)."
+        ),
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        default=bool(strtobool(os.environ.get("LSR_QEMU_OFFLINE", "False"))),
+        help=(
+            "Use the cached images without checking whether they were "
+            "updated on the server."
+        ),
+    )
+    parser.add_argument(
+        "--image-url-ttl",
+        type=int,
+        default=int(
+            os.environ.get(
+                "LSR_QEMU_IMAGE_URL_TTL", str(DEFAULT_IMAGE_URL_TTL)
+            )
+        ),
+        help=(
+            "Number of seconds to use the cached download URL of compose "
+            "and centoshtml images before resolving it again "
+            "(default: 3600)."
+        ),
+    )
+    parser.add_argument(
+        "--refresh-image-urls",
+        action="store_true",
+        default=bool(
+            strtobool(os.environ.get("LSR_QEMU_REFRESH_IMAGE_URLS", "False"))
+        ),
+        help="Resolve the image download URL even if it is cached.",
+    )
+    parser.add_argument(
+        "--prewarm",
+        action="store_true",
+        default=bool(strtobool(os.environ.get("LSR_QEMU_PREWARM", "False"))),
+        help=(
+            "Download all of the images in the config, or the ones "
+            "matching the comma separated patterns in --image-name, create "
+            "their snapshots, and exit.  No tests are run."
+        ),
+    )
+    parser.add_argument(
+        "--prewarm-jobs",
+        type=int,
+        default=int(os.environ.get("LSR_QEMU_PREWARM_JOBS", "0")),
+        help=(
+            "Number of snapshots to create at the same time with "
+            "--prewarm.  The default 0 means a number based on the "
+            "CPUs and the available memory."
+        ),
+    )
+    parser.add_argument(
+        "--timing-db",
+        default=os.environ.get("LSR_QEMU_TIMING_DB"),
+        help=(
+            "SQLite database where the durations of the playbooks and tasks "
+            "are recorded when using --profile.  The default is %s in the "
+            "cache directory." % TIMING_DB
+        ),
+    )
+    parser.add_argument(
+        "--timing-report",
+        action="store_true",
+        default=False,
+        help=(
+            "Show the playbooks and tasks which got slower, and the slowest "
+            "tasks, from the --timing-db, and exit.  Use --image-name to "
+            "show only one image, and --profile-task-limit to show more or "
+            "fewer entries."
+        ),
+    )
     parser.add_argument(
         "--inventory",
         default=os.environ.get(
@@ -1738,16 +3825,26 @@ def get_arg_parser():
             "to ensure snapshot is new."
         ),
     )
+    parser.add_argument(
+        "--snapshot-max-age",
+        type=int,
+        default=int(os.environ.get("LSR_QEMU_SNAPSHOT_MAX_AGE", "0")),
+        help=(
+            "Create the snapshot again if it is older than this many "
+            "seconds.  The default 0 means that the snapshot is created "
+            "again only if the image or the setup changed."
+        ),
+    )
     parser.add_argument(
         "--post-snap-sleep-time",
         type=int,
         default=int(os.environ.get("LSR_QEMU_POST_SNAP_SLEEP_TIME", "0")),
         help=(
-            "There is a race condition when using snapshot.  If you attempt "
-            "to use the snapshot too soon after creation, you will get a "
-            "hang, a guest crash, or similar.  This behavior is very platform "
-            "dependent.  The only remedy so far is to figure out how much "
-            "time to sleep post snap creation."
+            "Seconds to sleep after creating the snapshot.  This should not "
+            "be needed, as the snapshot is checked with qemu-img check and "
+            "flushed to disk after the VM exits, but is kept for platforms "
+            "where using the snapshot too soon causes a hang, a guest crash, "
+            "or similar.  The default is 0."
         ),
     )
     parser.add_argument(
@@ -1829,16 +3926,72 @@ def get_arg_parser():
     parser.add_argument(
         "--make-batch-file-order",
         default=os.environ.get("LSR_QEMU_MAKE_BATCH_FILE_ORDER", ""),
-        choices=["ascending", "descending", "imagehash", "natural"],
+        choices=[
+            "ascending",
+            "descending",
+            "imagehash",
+            "natural",
+            "longest-first",
+        ],
         help=(
             "The sort order for the tests/tests_*.yml files for make-batch.  "
             "ascending/descending are en.US ASCII order.  "
             "imagehash is ascending or descending depending on an 1-bit hash "
             "of the image name.  "
             "natural is the filesystem inode order.  "
+            "longest-first uses the durations of previous runs of the tests "
+            "on the image.  "
             "Implies --make-batch."
         ),
     )
+    parser.add_argument(
+        "--reset-vm",
+        action="store_true",
+        default=bool(strtobool(os.environ.get("LSR_QEMU_RESET_VM", "False"))),
+        help=(
+            "When running batches, save the state of the VM after it boots "
+            "and the setup playbooks are run, and restore it before each "
+            "batch, so that every batch starts with a clean VM without "
+            "booting it and running the setup again."
+        ),
+    )
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        default=int(os.environ.get("LSR_QEMU_PARALLEL", "0")),
+        help=(
+            "When running batches, run them in this many VMs at the same "
+            "time.  Each VM takes the next batch from a queue."
+        ),
+    )
+    parser.add_argument(
+        "--fail-fast",
+        action="store_true",
+        default=bool(strtobool(os.environ.get("LSR_QEMU_FAIL_FAST", "False"))),
+        help="Do not run any more batches after a batch fails.",
+    )
+    parser.add_argument(
+        "--failed-first",
+        action="store_true",
+        default=bool(
+            strtobool(os.environ.get("LSR_QEMU_FAILED_FIRST", "False"))
+        ),
+        help=(
+            "Run the batches which failed in the last run, according to the "
+            "batch report, before the others."
+        ),
+    )
+    parser.add_argument(
+        "--rerun-failed",
+        action="store_true",
+        default=bool(
+            strtobool(os.environ.get("LSR_QEMU_RERUN_FAILED", "False"))
+        ),
+        help=(
+            "Run only the batches which failed in the last run, according to "
+            "the batch report."
+        ),
+    )
     parser.add_argument(
         "--ansible-container",
         default=os.environ.get("LSR_QEMU_ANSIBLE_CONTAINER"),
@@ -1887,6 +4040,19 @@ def main():
     if not args.cleanup_yml and "LSR_QEMU_CLEANUP_YML" in os.environ:
         args.cleanup_yml = os.environ["LSR_QEMU_CLEANUP_YML"].split(",")
     logging.getLogger().setLevel(getattr(logging, args.log_level.upper()))
+    if args.timing_report:
+        timing_report(
+            get_timing_db(args), args.image_name, args.profile_task_limit
+        )
+        return
+    if args.prewarm:
+        if args.image_file:
+            logging.critical("--image-file cannot be used with --prewarm.")
+            sys.exit(1)
+        os.makedirs(args.cache, exist_ok=True)
+        prep_el6(args)
+        prewarm(args)
+        return
     # either image-name or image-file must be given
     if not any([args.image_name, args.image_file]) or all(
         [args.image_name, args.image_file]
@@ -1895,8 +4061,6 @@ def main():
             "One, and only one, of --image-name or --image-file must be given."
         )
         sys.exit(1)
-    if args.post_snap_sleep_time == 0:
-        args.post_snap_sleep_time = DEFAULT_POST_SNAP_SLEEP_TIME
     os.makedirs(args.cache, exist_ok=True)
     if args.make_batch_file_order:
         args.make_batch = True
@@ -1937,6 +4101,18 @@ def main():
         lsr_report_errors_url=args.lsr_report_errors_url,
         skip_requirements=args.skip_requirements,
         skip_callback_plugins=args.skip_callback_plugins,
+        cache_max_size=parse_size(args.cache_max_size),
+        download_connections=args.download_connections,
+        offline=args.offline,
+        image_url_ttl=args.image_url_ttl,
+        refresh_image_urls=args.refresh_image_urls,
+        snapshot_max_age=args.snapshot_max_age,
+        reset_vm=args.reset_vm,
+        parallel=args.parallel,
+        fail_fast=args.fail_fast,
+        failed_first=args.failed_first,
+        rerun_failed=args.rerun_failed,
+        timing_db=get_timing_db(args),
     )
 
 
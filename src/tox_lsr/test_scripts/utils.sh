@@ -233,6 +233,204 @@ function lsr_molecule_supports_ansible() {
   return 0
 }
 
+##
+# __lsr_copy_collections $1 $2 $3
+#
+#   $1 - collection path to copy the collections from
+#   $2 - collection path to copy the collections to
+#   $3 - collection to keep if already installed e.g.
+#        fedora/linux_system_roles, or empty
+#
+# Copy the collections from $1 to $2, replacing the ones in $2, except $3.
+function __lsr_copy_collections() {
+  local src_root dest_root keep src src_coll top dest
+  src_root="$1/ansible_collections"
+  dest_root="$2/ansible_collections"
+  keep="$3"
+  mkdir -p "$dest_root"
+  for src in "$src_root"/*; do
+    if [ ! -e "$src" ]; then
+      continue  # nothing installed
+    fi
+    top=$(basename "$src")
+    if [[ "$top" == *.* ]] || [ ! -d "$src" ]; then
+      # e.g. the namespace.name-version.info dirs
+      rm -rf "${dest_root:?}/$top"
+      cp -a "$src" "$dest_root/$top"
+      continue
+    fi
+    mkdir -p "$dest_root/$top"
+    for src_coll in "$src"/*; do
+      dest="$dest_root/$top/$(basename "$src_coll")"
+      if [ "$top/$(basename "$src_coll")" = "$keep" ] && [ -d "$dest" ]; then
+        lsr_info keeping the installed collection "$dest"
+        continue
+      fi
+      rm -rf "$dest"
+      cp -a "$src_coll" "$dest"
+    done
+  done
+}
+
+##
+# lsr_galaxy_install $1 [$2 ...]
+#
+#   $1 - collection path to install the collections into
+#   $2 ... - requirements files, and collections given as --collection NAME
+#            e.g. --collection ansible.posix
+#
+# Install the collections with ansible-galaxy.  If LSR_COLLECTION_MIRROR is
+# set, the collections are installed from the tarballs in that directory
+# instead of from Galaxy, without any network access - see
+# lsr_collection_mirror.py.
+function lsr_galaxy_install() {
+  local coll_path rq force mirror_rq
+  local -a reqfiles=() mirror_args=()
+  coll_path="$1"; shift
+  while [ $# -gt 0 ]; do
+    if [ "$1" = --collection ]; then
+      mirror_args+=("$1" "$2")
+      shift 2
+    else
+      reqfiles+=("$1")
+      shift
+    fi
+  done
+  if ansible-galaxy collection install --help 2>&1 | grep -q -- --force; then
+    force=--force
+  fi
+  if [ -n "${LSR_COLLECTION_MIRROR:-}" ]; then
+    mirror_rq=$(mktemp --suffix .yml)
+    python "$(dirname "${BASH_SOURCE[0]}")/lsr_collection_mirror.py" requirements \
+      -o "$mirror_rq" ${mirror_args[@]+"${mirror_args[@]}"} ${reqfiles[@]+"${reqfiles[@]}"}
+    # the dependencies are in $mirror_rq too
+    # shellcheck disable=SC2086
+    ansible-galaxy collection install ${force:-} -p "$coll_path" -vv --no-deps -r "$mirror_rq"
+    rm -f "$mirror_rq"
+    return 0
+  fi
+  for rq in ${reqfiles[@]+"${reqfiles[@]}"}; do
+    # shellcheck disable=SC2086
+    ansible-galaxy collection install ${force:-} -p "$coll_path" -vv -r "$rq"
+  done
+  set -- ${mirror_args[@]+"${mirror_args[@]}"}
+  while [ $# -gt 0 ]; do
+    # shellcheck disable=SC2086
+    ansible-galaxy collection install ${force:-} -p "$coll_path" -vv "$2"
+    shift 2
+  done
+}
+
+##
+# lsr_get_collection_cache
+#
+# Print the directory of the collection cache, or nothing if the cache is
+# disabled.
+function lsr_get_collection_cache() {
+  echo "${LSR_COLLECTION_CACHE-$HOME/.cache/linux-system-roles/collections}"
+}
+
+##
+# __lsr_cache_entry_is_stale $1
+#
+#   $1 - cache entry
+#
+# Exit with 0 if the cache entry $1 does not exist, or is older than
+# $LSR_COLLECTION_CACHE_MAX_AGE hours.
+function __lsr_cache_entry_is_stale() {
+  local max_age
+  max_age="${LSR_COLLECTION_CACHE_MAX_AGE:-24}"
+  if [ ! -d "$1" ]; then
+    return 0
+  fi
+  [ "$max_age" -gt 0 ] && [ -n "$(find "$1" -maxdepth 0 -mmin +$(( max_age * 60 )))" ]
+}
+
+##
+# lsr_galaxy_install_cached $1 $2 [$3 ...]
+#
+#   $1 - collection path to install the collections into
+#   $2 - collection to keep if already installed e.g.
+#        fedora/linux_system_roles, or empty
+#   $3 ... - requirements files
+#
+# Install the collections from the requirements files into $1.  The
+# collections are installed from Galaxy only once for each set of requirements
+# and ansible-core version into the cache $LSR_COLLECTION_CACHE (default
+# ~/.cache/linux-system-roles/collections), and are copied from there.  The
+# cache entry is updated from Galaxy when it is older than
+# $LSR_COLLECTION_CACHE_MAX_AGE hours (default 24, 0 means never).  Set
+# LSR_COLLECTION_CACHE to an empty string to disable the cache.  The cache
+# entries are shared with runqemu.py.
+function lsr_galaxy_install_cached() {
+  local coll_path keep cache key entry tmpdir
+  coll_path="$1"; shift
+  keep="$1"; shift
+  cache=$(lsr_get_collection_cache)
+  if [ -z "$cache" ]; then
+    tmpdir=$(mktemp -d)
+    lsr_galaxy_install "$tmpdir" "$@"
+    __lsr_copy_collections "$tmpdir" "$coll_path" "$keep"
+    rm -rf "$tmpdir"
+    return 0
+  fi
+  mkdir -p "$cache"
+  key=$({ cat "$@"; ansible --version | sed -n 1p; } | sha256sum | cut -d " " -f 1)
+  entry="$cache/$key"
+  (
+    # same lock as runqemu.py uses for the entry
+    flock 9
+    if __lsr_cache_entry_is_stale "$entry"; then
+      lsr_info installing collections into cache "$entry"
+      rm -rf "$entry.tmp"
+      mkdir -p "$entry.tmp"
+      lsr_galaxy_install "$entry.tmp" "$@"
+      rm -rf "$entry"
+      mv "$entry.tmp" "$entry"
+    else
+      lsr_info using collections from cache "$entry"
+    fi
+    __lsr_copy_collections "$entry" "$coll_path" "$keep"
+  ) 9>> "$entry.lock"
+}
+
+##
+# lsr_link_cached_callback_plugins $1 [$2 ...]
+#
+#   $1 - callback plugin dir
+#   $2 ... - callback plugins from ansible.posix e.g. debug.py
+#
+# Link the callback plugins for $LSR_ANSIBLE_POSIX_VERSION in the collection
+# cache into $1.  The plugins are installed into the cache only once for each
+# LSR_ANSIBLE_POSIX_VERSION, and are updated like the cached collections.  The
+# cache entries are shared with runqemu.py.
+function lsr_link_cached_callback_plugins() {
+  local callback_plugin_dir posix_version entry plugin tmpdir
+  callback_plugin_dir="$1"; shift
+  posix_version="${LSR_ANSIBLE_POSIX_VERSION:-ansible.posix}"
+  entry="$(lsr_get_collection_cache)/callback_plugins/$(printf %s "$posix_version" | tr -c 'A-Za-z0-9_.-' _)-$(printf %s "$posix_version" | sha256sum | cut -c 1-12)"
+  mkdir -p "$(dirname "$entry")"
+  (
+    flock 9
+    if __lsr_cache_entry_is_stale "$entry"; then
+      lsr_info installing callback plugins into cache "$entry"
+      rm -rf "$entry.tmp"
+      mkdir -p "$entry.tmp"
+      lsr_galaxy_install "$entry.tmp" --collection "$posix_version"
+      for plugin in debug.py profile_tasks.py; do
+        mv "$entry.tmp/ansible_collections/ansible/posix/plugins/callback/$plugin" "$entry.tmp"
+      done
+      rm -rf "$entry.tmp/ansible_collections"
+      rm -rf "$entry"
+      mv "$entry.tmp" "$entry"
+    fi
+  ) 9>> "$entry.lock"
+  for plugin in "$@"; do
+    ln -sfn "$entry/$plugin" "$callback_plugin_dir/$plugin.$$.link"
+    mv -T "$callback_plugin_dir/$plugin.$$.link" "$callback_plugin_dir/$plugin"
+  done
+}
+
 # set TOPDIR
 # shellcheck disable=SC2034
 ME=${ME:-"$(basename "$0")"}
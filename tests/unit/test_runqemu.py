@@ -0,0 +1,459 @@
+#                                                         -*- coding: utf-8 -*-
+# SPDX-License-Identifier: MIT
+#
+"""Tests for the runqemu test script."""
+
+import hashlib
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+
+try:
+    from unittest2 import SkipTest, TestCase
+except ImportError:
+    from unittest import SkipTest, TestCase
+except AttributeError:
+    from unittest import SkipTest, TestCase
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+TEST_SCRIPTS_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "..",
+    "src",
+    "tox_lsr",
+    "test_scripts",
+)
+
+
+def import_test_script(name):
+    """Import the test script name from the test_scripts directory."""
+    if sys.version_info < (3, 6):
+        raise SkipTest("the test scripts require python 3.6 or later")
+    if TEST_SCRIPTS_DIR not in sys.path:
+        sys.path.insert(0, TEST_SCRIPTS_DIR)
+    # runqemu runs ansible-config list when it is imported
+    with patch("subprocess.check_output", return_value=""):
+        return importlib.import_module(name)
+
+
+rq = import_test_script("runqemu")
+
+
+class SnapshotFingerprintTestCase(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.image = os.path.join(self.tmpdir, "image.qcow2")
+        with open(self.image, "wb") as ff:
+            ff.write(b"image")
+        self.setup_yml = os.path.join(self.tmpdir, "setup.yml")
+        with open(self.setup_yml, "wb") as ff:
+            ff.write(b"- hosts: all\n")
+        self.test_env = {
+            "TEST_SUBJECTS": self.image + ".snap",
+            "TEST_YUM_CACHE_PATHS": "/cache/yum",
+            "TEST_YUM_VARLIB_PATHS": "/cache/varlib",
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def fingerprint(self, test_env=None, ansible_args=None):
+        return rq.get_snapshot_fingerprint(
+            self.image,
+            test_env or self.test_env,
+            ansible_args or [],
+            [self.setup_yml],
+        )
+
+    def test_parallel_workers(self):
+        """Test that all of the parallel workers use the same snapshot."""
+        fingerprints = set([self.fingerprint()])
+        for num in range(2):
+            worker_env = dict(self.test_env)
+            suffix = "." + str(num)
+            worker_env["LOCK_ON_FILE"] = self.image + ".lock" + suffix
+            worker_env["TEST_INVENTORY"] = self.image + ".yml" + suffix
+            for key in ("TEST_YUM_CACHE_PATHS", "TEST_YUM_VARLIB_PATHS"):
+                # this is what run_worker in runqemu does
+                worker_env[key] += suffix
+            fingerprints.add(self.fingerprint(worker_env))
+        self.assertEqual(1, len(fingerprints))
+
+    def test_setup_changed(self):
+        """Test that a change of the setup changes the fingerprint."""
+        fingerprint = self.fingerprint()
+        test_env = dict(self.test_env)
+        test_env["TEST_HOSTALIASES"] = self.image + ".hosts"
+        self.assertNotEqual(fingerprint, self.fingerprint(test_env))
+        self.assertNotEqual(
+            fingerprint, self.fingerprint(ansible_args=["-e", "x=1"])
+        )
+        with open(self.setup_yml, "ab") as ff:
+            ff.write(b"  tasks: []\n")
+        self.assertNotEqual(fingerprint, self.fingerprint())
+
+    def test_vault_variables(self):
+        """Test that the vault variables of a batch are not used."""
+        os.mkdir(os.path.join(self.tmpdir, "vars"))
+        for path in ("vault_pwd", rq.VAULT_VARIABLES_FILE):
+            with open(os.path.join(self.tmpdir, path), "wb") as ff:
+                ff.write(b"secret\n")
+        ansible_args = ["-e", "x=1"]
+        fingerprint = self.fingerprint(ansible_args=ansible_args)
+        test_env = dict(self.test_env)
+        rq.handle_vault(self.tmpdir, ansible_args, [self.setup_yml], test_env)
+        self.assertEqual(3, len(ansible_args))
+        self.assertEqual(fingerprint, self.fingerprint(test_env, ansible_args))
+
+
+class ParseSizeTestCase(TestCase):
+    def test_parse_size(self):
+        """Test the sizes which parse_size understands."""
+        self.assertEqual(0, rq.parse_size(None))
+        self.assertEqual(0, rq.parse_size(""))
+        self.assertEqual(0, rq.parse_size("0"))
+        self.assertEqual(512, rq.parse_size(512))
+        self.assertEqual(500 * 1024**2, rq.parse_size("500M"))
+        self.assertEqual(20 * 1024**3, rq.parse_size("20G"))
+        self.assertEqual(20 * 1024**3, rq.parse_size(" 20 gib "))
+        self.assertEqual(1024**4, rq.parse_size("1TB"))
+        self.assertEqual(4096, rq.parse_size("4k"))
+
+    def test_parse_size_invalid(self):
+        """Test that parse_size rejects what it does not understand."""
+        for val in ("G", "1.5G", "-1G", "10X", "10 G B"):
+            self.assertRaises(ValueError, rq.parse_size, val)
+
+
+class PruneImageStoreTestCase(TestCase):
+    def setUp(self):
+        self.cache = tempfile.mkdtemp()
+        self.store = rq.get_image_store(self.cache)
+        self.size = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.cache)
+
+    def add_image(self, label, last_used):
+        """Add an image with a label and a snapshot, used at last_used."""
+        store_path = os.path.join(self.store, label + ".qcow2")
+        with open(store_path, "wb") as ff:
+            ff.write(b"x" * 8192)
+        self.size = os.stat(store_path).st_blocks * 512
+        rq.touch_store_image(store_path)
+        os.utime(store_path + rq.STORE_USED_SUFFIX, (last_used, last_used))
+        label_path = os.path.join(self.cache, label + ".qcow2")
+        os.link(store_path, label_path)
+        with open(label_path + ".snap", "wb") as ff:
+            ff.write(b"snap")
+        return store_path
+
+    def labels(self):
+        return sorted(
+            name[: -len(".qcow2")]
+            for name in os.listdir(self.cache)
+            if name.startswith("image") and name.endswith(".qcow2")
+        )
+
+    def test_prune_least_recently_used(self):
+        """Test that the least recently used images are evicted first."""
+        store_paths = [
+            self.add_image("image1", 3000),
+            self.add_image("image2", 1000),
+            self.add_image("image3", 2000),
+        ]
+        rq.prune_image_store(self.cache, 2 * self.size)
+        self.assertEqual(["image1", "image3"], self.labels())
+        self.assertFalse(os.path.exists(store_paths[1]))
+        self.assertFalse(os.path.exists(store_paths[1] + rq.STORE_USED_SUFFIX))
+        self.assertFalse(
+            os.path.exists(os.path.join(self.cache, "image2.qcow2.snap"))
+        )
+        rq.prune_image_store(self.cache, self.size, keep=store_paths[2])
+        self.assertEqual(["image3"], self.labels())
+        rq.prune_image_store(self.cache, 0)
+        self.assertEqual(["image3"], self.labels())
+
+    def test_prune_skips_locked(self):
+        """Test that images locked by another process are not evicted."""
+        self.add_image("image1", 1000)
+        self.add_image("image2", 2000)
+        self.add_image("image3", 3000)
+        # the lock which download_image holds while fetching the image
+        label_path = rq.get_image_path(
+            "https://example.com/images/image.qcow2", self.cache, "image1"
+        )
+        with rq.cache_lock(label_path):
+            rq.prune_image_store(self.cache, 2 * self.size)
+        self.assertEqual(["image1", "image3"], self.labels())
+        with rq.cache_lock(label_path + ".snap"):
+            rq.prune_image_store(self.cache, self.size)
+        self.assertEqual(["image1"], self.labels())
+
+    def test_prune_skips_used(self):
+        """Test that images which a job is using are not evicted."""
+        store_path = self.add_image("image1", 1000)
+        self.add_image("image2", 2000)
+        other_label = os.path.join(self.cache, "other.qcow2")
+        os.link(store_path, other_label)
+        # the lock covers all of the labels of the image
+        with rq.use_cached_image(other_label):
+            rq.prune_image_store(self.cache, self.size)
+            self.assertEqual(["image1"], self.labels())
+        rq.prune_image_store(self.cache, 1)
+        self.assertEqual([], self.labels())
+        self.assertFalse(os.path.exists(other_label))
+        self.assertFalse(os.path.exists(store_path))
+
+
+class FetchImageTestCase(TestCase):
+    URL = "https://example.com/images/image.qcow2"
+
+    def setUp(self):
+        self.cache = tempfile.mkdtemp()
+        self.path = os.path.join(self.cache, "image.qcow2")
+        self.content = b"image"
+        self.downloads = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.cache)
+
+    def download_url(self, url, path, _connections=1, headers=None):
+        self.assertEqual(self.URL, url)
+        self.downloads += 1
+        if headers:
+            return None  # 304 Not Modified
+        with open(path, "wb") as ff:
+            ff.write(self.content)
+        return hashlib.sha256(self.content).hexdigest(), None, None
+
+    def fetch_image(self):
+        with patch.object(rq, "download_url", self.download_url):
+            return rq.fetch_image(self.URL, self.cache, "image")
+
+    def test_verify_cached_image(self):
+        """Test that a cached image is hashed again only if it changed."""
+        self.assertEqual(self.path, self.fetch_image())
+        with patch.object(rq, "hash_file", wraps=rq.hash_file) as hash_file:
+            self.assertEqual(self.path, self.fetch_image())
+            self.assertEqual(0, hash_file.call_count)
+            # same size, but different content and mtime
+            with open(self.path, "r+b") as ff:
+                ff.write(b"IMAGE")
+            self.assertEqual(self.path, self.fetch_image())
+            self.assertEqual(1, hash_file.call_count)
+        self.assertEqual(3, self.downloads)
+        with open(self.path, "rb") as ff:
+            self.assertEqual(self.content, ff.read())
+
+    def test_labels_of_the_same_image(self):
+        """Test labels downloaded from different urls with the same image."""
+        urls = {
+            "image": self.URL,
+            "other": "https://example.org/other.qcow2",
+        }
+        requests = []
+
+        def download_url(url, path, _connections=1, headers=None):
+            requests.append((url, headers))
+            if headers:
+                return None
+            with open(path, "wb") as ff:
+                ff.write(self.content)
+            etag = '"' + url + '"'
+            return hashlib.sha256(self.content).hexdigest(), None, etag
+
+        with patch.object(rq, "download_url", download_url):
+            for label, url in urls.items():
+                rq.fetch_image(url, self.cache, label)
+            requests = []
+            for label, url in urls.items():
+                rq.fetch_image(url, self.cache, label)
+        self.assertTrue(
+            os.path.samefile(
+                self.path, os.path.join(self.cache, "other.qcow2")
+            )
+        )
+        self.assertEqual(
+            [
+                (url, {"If-None-Match": '"' + url + '"'})
+                for url in urls.values()
+            ],
+            requests,
+        )
+
+    def test_not_modified_without_cached_image(self):
+        """Test a 304 reply to a request which was not conditional."""
+        with patch.object(rq, "download_url", return_value=None):
+            self.assertIsNone(rq.fetch_image(self.URL, self.cache, "image"))
+        self.assertFalse(os.path.exists(self.path))
+
+
+class TestDurationsTestCase(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.tests_dir = os.path.join(self.tmpdir, "tests")
+        os.mkdir(self.tests_dir)
+        for name in ("a", "b", "c", "d"):
+            path = os.path.join(self.tests_dir, "tests_" + name + ".yml")
+            with open(path, "wb") as ff:
+                ff.write(b"- hosts: all\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_batch_file(self, order, durations=None):
+        batch_file = os.path.join(self.tmpdir, "batch.txt")
+        rq.make_batch_file(
+            batch_file,
+            self.tests_dir,
+            ["-e", "x=1"],
+            {"name": "fedora-42"},
+            order,
+            durations,
+        )
+        with open(batch_file, "rb") as ff:
+            return [
+                os.path.basename(line.split()[-1].decode())
+                for line in ff.readlines()
+            ]
+
+    def test_longest_first(self):
+        """Test that the longest tests, or those never run, go first."""
+        durations = {"tests_a.yml": 10, "tests_b.yml": 30, "tests_c.yml": 20}
+        self.assertEqual(
+            ["tests_d.yml", "tests_b.yml", "tests_c.yml", "tests_a.yml"],
+            self.make_batch_file("longest-first", durations),
+        )
+        self.assertEqual(
+            ["tests_a.yml", "tests_b.yml", "tests_c.yml", "tests_d.yml"],
+            self.make_batch_file("longest-first"),
+        )
+
+    def test_record_test_duration(self):
+        """Test that the last runs of a test are averaged."""
+        for duration in (100, 10, 20, 30, 40, 50):
+            rq.record_test_duration(
+                self.tmpdir, "fedora-42", "tests_a.yml", duration
+            )
+        rq.record_test_duration(self.tmpdir, "centos-9", "tests_a.yml", 5)
+        self.assertEqual(
+            {"tests_a.yml": 30},
+            rq.load_test_durations(self.tmpdir, "fedora-42"),
+        )
+        self.assertEqual(
+            {"tests_a.yml": 5}, rq.load_test_durations(self.tmpdir, "centos-9")
+        )
+        self.assertEqual({}, rq.load_test_durations(self.tmpdir, "centos-10"))
+
+
+class FailedFirstTestCase(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.batch_report = os.path.join(self.tmpdir, "batch.report")
+        self.tests = {
+            name: os.path.join(self.tmpdir, "tests_" + name + ".yml")
+            for name in ("a", "b", "c")
+        }
+        self.setup_yml = os.path.join(self.tmpdir, "setup.yml")
+        self.cleanup_yml = os.path.join(self.tmpdir, "cleanup.yml")
+        self.batches = []
+        for name in ("a", "b", "c"):
+            self.batches.append(
+                rq.Batch(None, [], [self.tests[name]], [self.setup_yml])
+            )
+            self.batches.append(
+                rq.Batch(None, [], [self.cleanup_yml], [], cleanup=True)
+            )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_report(self, *lines):
+        with open(self.batch_report, "wb") as ff:
+            for line in lines:
+                ff.write(line.encode() + b"\n")
+
+    def order(self, rerun_failed=False):
+        return [
+            os.path.basename(batch.playbooks[0])
+            for batch in rq.order_failed_first(
+                self.batches, self.batch_report, rerun_failed
+            )
+        ]
+
+    def test_read_batch_report(self):
+        """Test that the last result of each playbook is used."""
+        self.write_report(
+            "",
+            "garbage",
+            "x 1.0 2.0 " + self.tests["c"],
+            "1",
+            "2 1.0 2.0 " + self.setup_yml + " " + self.tests["a"],
+            "0 1.0 2.0 my_batch " + self.tests["b"],
+            "0 3.0 4.0 " + self.setup_yml + " " + self.tests["a"],
+            "3 3.0 4.0 my_batch " + self.tests["b"],
+        )
+        self.assertEqual(
+            {
+                self.setup_yml: 0,
+                self.tests["a"]: 0,
+                self.tests["b"]: 3,
+            },
+            rq.read_batch_report(self.batch_report),
+        )
+
+    def test_no_batch_report(self):
+        """Test that the order is kept if there is no batch report."""
+        self.assertIsNone(rq.read_batch_report(self.batch_report))
+        self.assertIsNone(rq.read_batch_report(None))
+        order = [
+            "tests_a.yml",
+            "cleanup.yml",
+            "tests_b.yml",
+            "cleanup.yml",
+            "tests_c.yml",
+            "cleanup.yml",
+        ]
+        self.assertEqual(order, self.order())
+        self.assertEqual(order, self.order(rerun_failed=True))
+
+    def test_failed_first(self):
+        """Test that failed batches go first, with their cleanup."""
+        self.write_report(
+            "0 1.0 2.0 " + self.setup_yml + " " + self.tests["a"],
+            "0 1.0 2.0 " + self.cleanup_yml,
+            "0 1.0 2.0 my_batch " + self.setup_yml + " " + self.tests["b"],
+            "1 1.0 2.0 " + self.cleanup_yml,
+            "2 1.0 2.0 my_batch " + self.setup_yml + " " + self.tests["c"],
+            "0 1.0 2.0 " + self.cleanup_yml,
+        )
+        self.assertEqual(
+            [
+                "tests_c.yml",
+                "cleanup.yml",
+                "tests_a.yml",
+                "cleanup.yml",
+                "tests_b.yml",
+                "cleanup.yml",
+            ],
+            self.order(),
+        )
+        self.assertEqual(
+            ["tests_c.yml", "cleanup.yml"], self.order(rerun_failed=True)
+        )
+
+    def test_rerun_failed_without_failures(self):
+        """Test that nothing is run again if nothing failed."""
+        self.write_report(
+            "0 1.0 2.0 " + self.tests["a"],
+            "0 1.0 2.0 " + self.tests["b"],
+        )
+        self.assertEqual([], self.order(rerun_failed=True))